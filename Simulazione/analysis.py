@@ -1,51 +1,128 @@
 import numpy as np
-import plots as pt
-import pandas as pd
-from scipy.stats import norm
-from scipy.optimize import curve_fit
+import profiling as pf
 
+# Matplotlib viene importato solo nelle funzioni che lo usano, per avviare velocemente il programma
+
+
+def vd_stats(v_drift, v_drift_th, blocks=None):
 
-def vd_fit(v_drift, v_drift_th):
-    
     """
-    Funzione che calcola e stampa la velocità di drift media e la deviazione standard
+    Funzione che calcola la velocità di drift media e il suo errore senza stampare o disegnare nulla
     Vengono calcolate le componenti medie e la deviazione standard delle velocità di drift
-    Si ricava dunque il modulo della velocità di drift media e il suo errore da confrontare con la teoria
-    
+    Si ricava dunque il modulo della velocità di drift media e il suo errore tramite propagazione
+    Con i campionamenti a varianza ridotta le particelle non sono indipendenti e sigma/sqrt(N) non è corretto:
+    se sono dati i blocchi, campionati in modo indipendente, l'errore delle componenti è ricavato dalla
+    dispersione delle medie dei blocchi, che resta una stima non distorta
+
     Parametri:
     ----------
     v_drift    : Array delle velocità di drift ricavate per ogni particella [m/s]
     v_drift_th : Array delle velocità di drift teoriche per ogni particella [m/s]
+    blocks     : Lista del numero di particelle di ogni blocco indipendente, nell'ordine di v_drift (Default: None)
 
     Ritorna:
     --------
-    vd_mean    : Valore medio del modulo della velocità di drift [m/s]
-    vd_err     : Errore associato al valore medio del modulo della velocità di drift [m/s]
-    vd_th_mean : Valore teorico medio del modulo della velocità di drift [m/s]
+    stats : Dizionario con mu, sigma, vd_err (componenti), vd_mean, vd_err_final, vd_th_mean_vec, vd_th_mean
     """
 
     mu = np.zeros(2)      # Media delle componenti della velocità di drift
     sigma = np.zeros(2)   # Deviazione standard delle componenti della velocità di drift
     
     # Fit gaussiano delle componenti della velocità di drift
-    components = ['x', 'y']
-    for i, comp in enumerate(components):
-        mu[i], sigma[i] = norm.fit(v_drift[:,i]) 
+    # Le stime di massima verosimiglianza sono media e deviazione standard, identiche a scipy.stats.norm.fit()
+    for i in range(2):
+        mu[i], sigma[i] = np.mean(v_drift[:,i]), np.std(v_drift[:,i])
 
     # Calcolo della velocità di drift media e errore tramite propagazione
     vd_mean = np.linalg.norm(mu, axis=0) 
-    vd_err = sigma / np.sqrt(len(v_drift))
+    if blocks is not None and len(blocks) > 1:
+        vd_err = block_err(v_drift[:, :2], blocks)
+    else:
+        vd_err = sigma / np.sqrt(len(v_drift))
     vd_err_final = np.sqrt((mu[0] / vd_mean * vd_err[0] )**2 + (mu[1] / vd_mean * vd_err[1])**2)
     
     # Calcolo della velocità di drift teorica media
     vd_th_mean_vec = np.mean(v_drift_th, axis=0)
     vd_th_mean = np.linalg.norm(vd_th_mean_vec)
 
+    stats = {
+        'mu'             : mu,
+        'sigma'          : sigma,
+        'vd_err'         : vd_err,
+        'vd_mean'        : vd_mean,
+        'vd_err_final'   : vd_err_final,
+        'vd_th_mean_vec' : vd_th_mean_vec,
+        'vd_th_mean'     : vd_th_mean,
+    }
+
+    return stats
+
+
+def block_err(values, blocks):
+
+    """
+    Funzione che stima l'errore della media di valori raggruppati in blocchi indipendenti
+    La media totale è la media delle medie dei blocchi pesate con il numero di particelle,
+    la sua varianza è stimata dalla dispersione delle medie dei blocchi attorno alla media totale
+
+    Parametri:
+    ----------
+    values : Array dei valori, forma (N, ...) 
+    blocks : Lista del numero di valori di ogni blocco, con somma N
+
+    Ritorna:
+    --------
+    err : Errore della media, forma (...)
+    """
+
+    n_b = np.asarray(blocks)
+    start = np.concatenate([[0], np.cumsum(n_b)[:-1]])
+    means = np.add.reduceat(values, start, axis=0) / n_b.reshape((-1,) + (1,) * (values.ndim - 1))
+    mean = np.mean(values, axis=0)
+
+    w = (n_b / n_b.sum()).reshape((-1,) + (1,) * (values.ndim - 1))
+    err = np.sqrt(len(n_b) / (len(n_b) - 1) * np.sum(w**2 * (means - mean)**2, axis=0))
+
+    return err
+
+
+def vd_fit(v_drift, v_drift_th, plot=True, blocks=None):
+    
+    """
+    Funzione che calcola e stampa la velocità di drift media e la deviazione standard
+    Vengono calcolate le componenti medie e la deviazione standard delle velocità di drift
+    Si ricava dunque il modulo della velocità di drift media e il suo errore da confrontare con la teoria
+    
+    Parametri:
+    ----------
+    v_drift    : Array delle velocità di drift ricavate per ogni particella [m/s]
+    v_drift_th : Array delle velocità di drift teoriche per ogni particella [m/s]
+    plot       : Se False non genera il grafico delle distribuzioni (Default: True)
+    blocks     : Numero di particelle dei blocchi indipendenti per l'errore, come in vd_stats() (Default: None)
+
+    Ritorna:
+    --------
+    vd_mean    : Valore medio del modulo della velocità di drift [m/s]
+    vd_err     : Errore associato al valore medio del modulo della velocità di drift [m/s]
+    vd_th_mean : Valore teorico medio del modulo della velocità di drift [m/s]
+    """
+
+    # Calcolo delle medie, delle deviazioni standard e degli errori
+    with pf.stage('vd_fit'):
+        stats = vd_stats(v_drift, v_drift_th, blocks)
+    mu, sigma, vd_err = stats['mu'], stats['sigma'], stats['vd_err']
+    vd_mean, vd_err_final = stats['vd_mean'], stats['vd_err_final']
+    vd_th_mean_vec, vd_th_mean = stats['vd_th_mean_vec'], stats['vd_th_mean']
+    components = ['x', 'y']
+
     # Calcolo dell'errore relativo tra simulazione e teoria
     rel_err = np.abs((vd_mean - vd_th_mean) / vd_th_mean) * 100
 
     # Genera il grafico delle distribuzioni delle componenti della velocità di drift
-    pt.plots_vd_dist(v_drift, vd_th_mean_vec, mu, sigma)
+    if plot:
+        with pf.stage('plots'):
+            import plots as pt
+            pt.plots_vd_dist(v_drift, vd_th_mean_vec, mu, sigma)
     
     # Stampa dei risultati  
     print(f"\n-------------------------------------------------------------")
@@ -68,6 +145,7 @@ def linear_fit(fields_value, v_drift_mean, v_drift_err):
     """
     Funzione che calcola e stampa il fit lineare delle velocità medie con la previsione teorica
     Il fit è ricavato attraverso diverse configurazioni di campo dove è ricavato il modulo della componente perpendicolare al campo B
+    Il modello v = m x ha un solo parametro, quindi il fit pesato ai minimi quadrati ha soluzione in forma chiusa (fit_from_sums())
    
     Parametri:
     ----------  
@@ -81,13 +159,68 @@ def linear_fit(fields_value, v_drift_mean, v_drift_err):
     m_err : Errore associato al coefficiente angolare
     """
 
-    popt, pcov = curve_fit(linear_func, fields_value, v_drift_mean, sigma=v_drift_err, absolute_sigma=True)
-    m_fit = popt[0]
-    m_err = np.sqrt(pcov[0,0])
+    with pf.stage('linear_fit'):
+        m_fit, m_err, _ = fit_from_sums(fit_sums(fields_value, v_drift_mean, v_drift_err))
 
     return m_fit, m_err
 
 
+def fit_sums(x, y, y_err):
+
+    """
+    Funzione che calcola le statistiche sufficienti del fit pesato v = m x, con pesi w = 1 / y_err²
+
+    Parametri:
+    ----------
+    x     : Array dei moduli dei campi
+    y     : Array delle velocità di drift medie
+    y_err : Array degli errori delle velocità
+
+    Ritorna:
+    --------
+    sums : Dizionario con n (numero di punti), Swxx, Swxy e Swyy, come le colonne della tabella fit_stats del database
+    """
+
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    w = 1.0 / np.asarray(y_err, dtype=float)**2
+
+    sums = {
+        'n'    : len(x),
+        'Swxx' : float(np.sum(w * x * x)),
+        'Swxy' : float(np.sum(w * x * y)),
+        'Swyy' : float(np.sum(w * y * y)),
+    }
+
+    return sums
+
+
+def fit_from_sums(sums):
+
+    """
+    Funzione che ricava il fit pesato v = m x dalle sole statistiche sufficienti, senza i singoli punti
+    m = Σwxy / Σwxx, con errore 1 / sqrt(Σwxx) (stesso risultato di curve_fit con absolute_sigma=True),
+    e chi quadro Σw(y - m x)² = Σwyy - (Σwxy)² / Σwxx
+
+    Parametri:
+    ----------
+    sums : Dizionario con Swxx, Swxy e Swyy, restituito da fit_sums() o da results_store.fit_stats()
+
+    Ritorna:
+    --------
+    m_fit : Coefficiente angolare del fit lineare
+    m_err : Errore associato al coefficiente angolare
+    chi2  : Chi quadro del fit, con n - 1 gradi di libertà
+    """
+
+    m_fit = sums['Swxy'] / sums['Swxx']
+    m_err = 1.0 / np.sqrt(sums['Swxx'])
+
+    # La differenza può risultare appena negativa per arrotondamento quando il fit è quasi perfetto
+    chi2 = max(sums['Swyy'] - sums['Swxy']**2 / sums['Swxx'], 0.0)
+
+    return m_fit, m_err, chi2
+
+
 def linear_func(x, m):
 
     """
@@ -0,0 +1,376 @@
+import sys, os
+import io
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import contextlib
+import tempfile
+import numpy as np
+
+# Backend senza finestre: il benchmark non apre grafici e non chiede input
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import drift_motions as dm
+import analysis as an
+import ensemble as en
+import kernels as kn
+
+# Costanti della particella, come in main.py
+q = 1.6e-19
+m = 1.67e-27
+qm = q / m
+dt = 1e-6
+
+# Comandi di main.py di cui misurare il tempo di avvio, eseguiti in una cartella temporanea
+STARTUP_CMDS = {
+    'import'    : None,
+    'help'      : ['--help'],
+    'clean'     : ['--clean'],
+    'scansione' : ['--drE', '--grid', 'Ex=10', '--grid', 'Ey=10', '-N', '200', '--seed', '0'],
+}
+
+# Configurazioni di campo consigliate nel README per i due drift
+CASES = {
+    'ExB'   : {'Bz': 8e-4, 'E': np.array([10.0, 10.0, 10.0]), 'B_grad': np.zeros(3)},
+    'gradB' : {'Bz': 8e-4, 'E': np.zeros(3), 'B_grad': np.array([5e-7, 6e-7, 0.0])},
+}
+
+
+def parser_arguments():
+
+    """
+    Funzione che definisce gli argomenti da passare quando si esegue il benchmark
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark delle funzioni di simulazione e analisi', usage='python3 benchmark.py --option')
+
+    parser.add_argument('-N', '--step', type=int, nargs='+', default=[1000, 3000], help='Numeri di passi da provare (Default: 1000 3000)')
+    parser.add_argument('-p', '--particles', type=int, nargs='+', default=[10, 50], help='Numeri di particelle da provare (Default: 10 50)')
+    parser.add_argument('-r', '--repeat', type=int, default=2, help='Ripetizioni di ogni misura, si tiene il tempo minore (Default: 2)')
+    parser.add_argument('-o', '--out', type=str, default=None, help='File .json in cui salvare i risultati')
+    parser.add_argument('--startup', action='store_true', help='Misura solo il tempo di avvio di main.py con alcuni comandi')
+    parser.add_argument('--main', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), help='File main.py di cui misurare l\'avvio, ad esempio di un\'altra versione (Default: quello accanto a benchmark.py)')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('A', 'B'), help='Confronta due file .json di risultati, B rispetto ad A')
+
+    return parser.parse_args()
+
+
+def measure(func, repeat):
+
+    """
+    Funzione che misura il tempo di esecuzione e il picco di memoria di una funzione senza argomenti
+    Il tempo è il minimo su repeat esecuzioni, la memoria viene misurata con tracemalloc in un'esecuzione separata
+    Le stampe della funzione vengono soppresse e i grafici eventualmente creati vengono chiusi
+
+    Parametri:
+    ----------
+    func   : Funzione da misurare
+    repeat : Numero di ripetizioni della misura del tempo
+
+    Ritorna:
+    --------
+    t_min   : Tempo di esecuzione minimo [s]
+    peak_MB : Picco di memoria allocata [MB]
+    """
+
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+        plt.close('all')
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    plt.close('all')
+
+    return min(times), peak / 1e6
+
+
+def record(name, case, N, N_par, t, peak_MB):
+
+    """
+    Funzione che crea la voce dei risultati di una misura con passi e particelle al secondo
+
+    Parametri:
+    ----------
+    name    : Nome della funzione misurata
+    case    : Configurazione o variante misurata
+    N       : Numero di passi
+    N_par   : Numero di particelle
+    t       : Tempo di esecuzione [s]
+    peak_MB : Picco di memoria [MB]
+
+    Ritorna:
+    --------
+    rec : Dizionario della misura
+    """
+
+    rec = {
+        'name'            : name,
+        'case'            : case,
+        'N'               : N,
+        'N_par'           : N_par,
+        'time_s'          : t,
+        'steps_per_s'     : N * N_par / t if N else None,
+        'particles_per_s' : N_par / t if N_par else None,
+        'peak_mem_MB'     : peak_MB,
+    }
+
+    return rec
+
+
+def initial_conditions(N_par):
+
+    """
+    Funzione che genera condizioni iniziali fisse, uguali in ogni esecuzione del benchmark
+
+    Parametri:
+    ----------
+    N_par : Numero di particelle
+
+    Ritorna:
+    --------
+    qm_tra : Array dei rapporti carica massa con segno [C/Kg]
+    v0     : Array delle velocità iniziali [m/s]
+    """
+
+    return en.initial_conditions(np.random.default_rng(0), N_par, qm)
+
+
+def orbit_params(N, Bz=8e-4):
+
+    """
+    Funzione che calcola passi per orbita, periodo e numero di orbite come in main.py
+
+    Parametri:
+    ----------
+    N  : Numero di passi
+    Bz : Componente z del campo magnetico [T] (Default: 8e-4)
+
+    Ritorna:
+    --------
+    steps_orb, T_orb, n_orb : Passi per orbita, periodo di un'orbita [s] e numero di orbite
+    """
+
+    steps_orb = int(2 * np.pi / (qm * Bz) / dt)
+
+    return steps_orb, steps_orb * dt, N // steps_orb
+
+
+def run_suite(N_list, N_par_list, repeat):
+
+    """
+    Funzione che esegue tutte le misure sulla griglia di passi e particelle
+
+    Parametri:
+    ----------
+    N_list     : Lista dei numeri di passi
+    N_par_list : Lista dei numeri di particelle
+    repeat     : Ripetizioni di ogni misura
+
+    Ritorna:
+    --------
+    results : Lista dei dizionari delle misure
+    """
+
+    results = []
+
+    def add(name, case, N, N_par, func, warmup=False):
+        # Chiamata di riscaldamento non misurata, così anche con una sola ripetizione il tempo non include la compilazione
+        if warmup:
+            func()
+        t, peak = measure(func, repeat)
+        results.append(record(name, case, N, N_par, t, peak))
+        print(f"{name:<16} {case:<22} N={N:<8} N_par={N_par:<6} {t:10.4f} s  {peak:9.2f} MB")
+
+    for N in N_list:
+        for N_par in N_par_list:
+
+            qm_tra, v0 = initial_conditions(N_par)
+            steps_orb, T_orb, n_orb = orbit_params(N)
+            B_hat = np.array([0.0, 0.0, 1.0])
+
+            #--------------------------------------------------------------
+            # Integrazione: drift() per particella e motore di ensemble
+            # I casi con Numba vengono eseguiti una volta prima della misura, per escludere la compilazione dei kernel
+            for case, conf in CASES.items():
+                B = np.array([0.0, 0.0, conf['Bz']])
+                for n_t in [0.0, 0.01]:
+
+                    label = f"{case} n_t={n_t}"
+                    np.random.seed(0)
+                    add('drift', label, N, N_par, lambda: [dm.drift(N, dt, B, conf['E'], conf['B_grad'], qm_tra[p], v0[p], n_t) for p in range(N_par)])
+                    add('drift_ensemble', label, N, N_par,
+                        lambda: dm.drift_ensemble(N, dt, B, conf['E'], conf['B_grad'], qm_tra, v0, n_t, rng=np.random.default_rng(0),
+                                                  steps_orb=steps_orb, n_orb=n_orb, keep_traj=False, analytic=False))
+                    if kn.NUMBA_AVAILABLE:
+                        add('drift_ensemble', label + ' numba', N, N_par,
+                            lambda: dm.drift_ensemble(N, dt, B, conf['E'], conf['B_grad'], qm_tra, v0, n_t, backend='numba', rng=np.random.default_rng(0),
+                                                      steps_orb=steps_orb, n_orb=n_orb, keep_traj=False, analytic=False), warmup=True)
+
+                    # Campi uniformi senza turbolenza: soluzione in forma chiusa
+                    if n_t == 0.0 and not conf['B_grad'].any():
+                        add('drift_ensemble', label + ' analytic', N, N_par,
+                            lambda: dm.drift_ensemble(N, dt, B, conf['E'], conf['B_grad'], qm_tra, v0, n_t, rng=np.random.default_rng(0),
+                                                      steps_orb=steps_orb, n_orb=n_orb, keep_traj=False))
+            #--------------------------------------------------------------
+
+            #--------------------------------------------------------------
+            # Centri di guida e velocità di drift
+            B = np.array([0.0, 0.0, 8e-4])
+            position, _ = dm.drift_ensemble(N, dt, B, CASES['ExB']['E'], np.zeros(3), qm_tra, v0, 0.0, rng=np.random.default_rng(0))
+            add('guide_center', 'per particella', N, N_par, lambda: [dm.guide_center(r, n_orb, steps_orb) for r in position])
+            add('guide_center', 'ensemble', N, N_par, lambda: dm.guide_center_ensemble(position, n_orb, steps_orb))
+
+            r_gc = dm.guide_center_ensemble(position, n_orb, steps_orb)
+            add('v_drift', 'per particella', N, N_par, lambda: [dm.v_drift(g, n_orb, T_orb, B_hat) for g in r_gc])
+            add('v_drift', 'ensemble', N, N_par, lambda: dm.v_drift_ensemble(r_gc, n_orb, T_orb, B_hat))
+            add('v_drift', 'lsq', N, N_par, lambda: dm.v_drift_fit(r_gc, T_orb, B_hat))
+            #--------------------------------------------------------------
+
+    #--------------------------------------------------------------
+    # Analisi: dipendono solo dal numero di particelle e di punti
+    for N_par in N_par_list:
+
+        rng = np.random.default_rng(0)
+        v_drift = rng.normal(1e4, 50.0, (N_par, 3))
+        v_drift_th = np.full((N_par, 3), 1e4)
+        add('vd_fit', 'senza grafico', 0, N_par, lambda: an.vd_fit(v_drift, v_drift_th, plot=False))
+
+        x = np.linspace(1.0, 10.0, N_par)
+        y = 3.0 * x + rng.normal(0.0, 0.1, N_par)
+        add('linear_fit', 'forma chiusa', 0, N_par, lambda: an.linear_fit(x, y, np.full(N_par, 0.1)))
+    #--------------------------------------------------------------
+
+    return results
+
+
+def run_startup(main_file, repeat):
+
+    """
+    Funzione che misura il tempo di avvio di main.py, eseguito come nuovo processo per ogni comando in STARTUP_CMDS
+    Il caso 'import' misura il solo import del modulo, gli altri l'esecuzione completa del comando
+    I comandi vengono eseguiti in una cartella temporanea, quindi il database dei dati non viene toccato
+
+    Parametri:
+    ----------
+    main_file : Percorso del file main.py
+    repeat    : Ripetizioni di ogni misura
+
+    Ritorna:
+    --------
+    results : Lista dei dizionari delle misure
+    """
+
+    main_file = os.path.abspath(main_file)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for case, argv in STARTUP_CMDS.items():
+
+            if argv is None:
+                cmd = [sys.executable, '-c', f"import sys; sys.path.insert(0, {os.path.dirname(main_file)!r}); import main"]
+            else:
+                cmd = [sys.executable, main_file] + argv
+
+            times = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                subprocess.run(cmd, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=dict(os.environ, MPLBACKEND='Agg'))
+                times.append(time.perf_counter() - t0)
+
+            results.append(record('startup', case, 0, 0, min(times), None))
+            print(f"{'startup':<16} {case:<22} {min(times):10.4f} s")
+
+    return results
+
+
+def environment():
+
+    """
+    Funzione che raccoglie le informazioni sull'ambiente di esecuzione, utili per confrontare due misure
+
+    Ritorna:
+    --------
+    env : Dizionario con versioni, piattaforma, commit e data
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    env = {
+        'python'   : platform.python_version(),
+        'numpy'    : np.__version__,
+        'platform' : platform.platform(),
+        'commit'   : commit or None,
+        'date'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    return env
+
+
+def compare(file_a, file_b):
+
+    """
+    Funzione che confronta due file di risultati e stampa il rapporto dei tempi B/A per le misure comuni
+
+    Parametri:
+    ----------
+    file_a : File .json di riferimento
+    file_b : File .json da confrontare
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    with open(file_a) as f:
+        a = json.load(f)
+    with open(file_b) as f:
+        b = json.load(f)
+
+    key = lambda r: (r['name'], r['case'], r['N'], r['N_par'])
+    ref = {key(r): r for r in a['results']}
+
+    print(f"\nConfronto di {file_b} ({b['env']['commit']}) rispetto a {file_a} ({a['env']['commit']})\n")
+    print(f"{'funzione':<16} {'variante':<22} {'N':>8} {'N_par':>6} {'A [s]':>10} {'B [s]':>10} {'B/A':>7} {'mem B/A':>8}")
+
+    for r in b['results']:
+        if key(r) in ref:
+            ra = ref[key(r)]
+            mem = r['peak_mem_MB'] / ra['peak_mem_MB'] if ra['peak_mem_MB'] and r['peak_mem_MB'] is not None else float('nan')
+            print(f"{r['name']:<16} {r['case']:<22} {r['N']:>8} {r['N_par']:>6} {ra['time_s']:10.4f} {r['time_s']:10.4f} {r['time_s'] / ra['time_s']:7.2f} {mem:8.2f}")
+
+    return
+
+
+if __name__ == "__main__":
+
+    args = parser_arguments()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    if args.startup:
+        results = run_startup(args.main, args.repeat)
+    else:
+        results = run_suite(args.step, args.particles, args.repeat)
+    report = {'env': environment(), 'results': results}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nRisultati salvati nel file: {args.out}\n")
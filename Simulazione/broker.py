@@ -0,0 +1,319 @@
+import os
+import time
+import socket
+import threading
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import ensemble as en
+import sweep as sw
+
+# Risultati di un blocco inviati al coordinatore, i soli usati da sweep.sweep_row()
+RESULT_KEYS = ['v_drift', 'v_drift_th']
+
+# Attesa suggerita ai worker quando tutti i blocchi rimasti sono già assegnati [s]
+WAIT = 1.0
+
+
+def parse_address(text):
+
+    """
+    Funzione che converte un indirizzo nella forma HOST:PORTA nella tupla usata da multiprocessing.connection
+
+    Parametri:
+    ----------
+    text : Stringa dell'indirizzo, se HOST manca si usa localhost
+
+    Ritorna:
+    --------
+    address : Tupla (host, porta)
+
+    Solleva ValueError se la porta non è un intero
+    """
+
+    host, _, port = text.rpartition(':')
+
+    return (host or 'localhost', int(port))
+
+
+def serve_sweep(jobs, N_par, address, authkey, lease=600.0, retries=3, progress=False):
+
+    """
+    Funzione che distribuisce ai worker i blocchi di particelle di tutte le configurazioni di una scansione
+    Il coordinatore ascolta su address e assegna un blocco alla volta ad ogni worker che lo richiede; un blocco torna in coda
+    se la connessione del suo worker si interrompe, se il worker segnala un errore o se non viene completato entro lease secondi.
+    I blocchi hanno il proprio SeedSequence e vengono uniti nell'ordine di sweep.sweep_jobs(), quindi le righe sono identiche
+    a quelle di sweep.run_sweep() con lo stesso seme, qualunque worker abbia eseguito i blocchi e quante volte.
+    I messaggi sono oggetti Python serializzati con pickle, la chiave authkey autentica i worker: usare solo su reti fidate
+
+    Parametri:
+    ----------
+    jobs     : Lista di tuple (params, seeds, sizes) restituita da sweep.sweep_jobs()
+    N_par    : Numero di particelle per configurazione
+    address  : Tupla (host, porta) su cui ascoltare
+    authkey  : Chiave condivisa con i worker, bytes
+    lease    : Tempo massimo per completare un blocco prima di riassegnarlo [s] (Default: 600.0)
+    retries  : Numero massimo di nuove assegnazioni di uno stesso blocco (Default: 3)
+    progress : Se True mostra la barra di avanzamento sui blocchi (Default: False)
+
+    Ritorna:
+    --------
+    rows : Lista dei dizionari con i risultati di ogni configurazione, come in sweep.run_sweep()
+
+    Solleva RuntimeError se un blocco non viene completato dopo retries nuove assegnazioni
+    """
+
+    # Blocchi di tutte le configurazioni non presenti nella cache, identificati dalla posizione nella lista
+    keys, hits = sw.sweep_cache(jobs, N_par)
+    tasks = [(params, seed, size) for (params, seeds, sizes), hit in zip(jobs, hits) if hit is None for seed, size in zip(seeds, sizes)]
+
+    pending = deque(range(len(tasks)))   # Blocchi da assegnare
+    running = {}                         # Blocco -> (scadenza, worker, connessione)
+    attempts = [0] * len(tasks)          # Nuove assegnazioni di ogni blocco
+    results = {}                         # Blocco -> risultati
+    failed = []                          # Motivo dell'interruzione della scansione
+    active = [0]                         # Connessioni aperte
+    cond = threading.Condition()
+
+    def finished():
+        return len(results) == len(tasks) or bool(failed)
+
+    def requeue(tid, reason):
+
+        # Da chiamare con cond acquisito, un blocco già completato da un altro worker non viene ripetuto
+        running.pop(tid, None)
+        if tid in results or failed:
+            return
+
+        attempts[tid] += 1
+        if attempts[tid] > retries:
+            failed.append(f"blocco {tid} non completato dopo {retries} nuove assegnazioni, ultimo errore: {reason}")
+        else:
+            print(f"\nAttenzione: blocco {tid} riassegnato ({reason})")
+            pending.appendleft(tid)
+        cond.notify_all()
+
+    def handle(conn):
+
+        # Dialogo con un worker: richiesta di un blocco, invio del risultato o dell'errore, fino alla fine della scansione
+        # Un blocco scaduto e riassegnato appartiene al nuovo worker, quello precedente non può più rimetterlo in coda
+        owner = object()
+        current = None
+        name = 'sconosciuto'
+        try:
+            while True:
+                msg = conn.recv()
+
+                with cond:
+                    if msg[0] == 'get':
+                        name = msg[1]
+                        if finished():
+                            reply = ('done',)
+                        elif pending:
+                            current = pending.popleft()
+                            running[current] = (time.monotonic() + lease, name, owner)
+                            reply = ('task', current) + tasks[current]
+                        else:
+                            reply = ('wait', WAIT)
+
+                    elif msg[0] == 'result':
+                        tid = msg[1]
+                        if tid not in results:
+                            results[tid] = msg[2]
+                        running.pop(tid, None)
+                        current = None
+                        cond.notify_all()
+                        reply = ('ok',)
+
+                    else:
+                        if running.get(msg[1], (None, None, None))[2] is owner:
+                            requeue(msg[1], f"errore nel worker {name}: {msg[2]}")
+                        current = None
+                        reply = ('ok',)
+
+                conn.send(reply)
+                if reply[0] == 'done':
+                    return
+
+        except (EOFError, OSError):
+            with cond:
+                if current is not None and running.get(current, (None, None, None))[2] is owner:
+                    requeue(current, f"connessione con il worker {name} interrotta")
+
+        finally:
+            conn.close()
+            with cond:
+                active[0] -= 1
+                cond.notify_all()
+
+    def accept(listener):
+
+        # Accetta i worker finché il coordinatore non chiude il socket, le connessioni con chiave errata vengono scartate
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            except Exception as err:
+                print(f"\nAttenzione: connessione rifiutata ({err})")
+                continue
+            with cond:
+                active[0] += 1
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    listener = Listener(address, authkey=authkey)
+    print(f"Coordinatore in ascolto su {address[0]}:{address[1]}, {len(tasks)} blocchi da eseguire")
+    threading.Thread(target=accept, args=(listener,), daemon=True).start()
+
+    if progress:
+        from tqdm import tqdm
+        bar = tqdm(total=len(tasks))
+
+    try:
+        #--------------------------------------------------------------
+        # Attesa dei risultati, i blocchi scaduti vengono riassegnati
+        with cond:
+            while not finished():
+                cond.wait(timeout=1.0)
+                now = time.monotonic()
+                for tid, (deadline, name, _) in list(running.items()):
+                    if now > deadline:
+                        requeue(tid, f"tempo scaduto per il worker {name}")
+                if progress:
+                    bar.update(len(results) - bar.n)
+
+            # I worker ancora connessi ricevono la fine della scansione alla prossima richiesta
+            end = time.monotonic() + 2 * WAIT
+            while active[0] > 0 and time.monotonic() < end:
+                cond.wait(timeout=end - time.monotonic())
+        #--------------------------------------------------------------
+
+    finally:
+        listener.close()
+        if progress:
+            bar.close()
+
+    if failed:
+        raise RuntimeError(failed[0])
+
+    # Unione dei blocchi nell'ordine delle configurazioni
+    rows = []
+    tid = 0
+    for (params, seeds, sizes), key, hit in zip(jobs, keys, hits):
+        if hit is not None:
+            rows.append(sw.sweep_row(params, [hit[0]], N_par))
+            continue
+        rows.append(sw.sweep_row(params, [results[tid + k] for k in range(len(sizes))], N_par, key))
+        tid += len(sizes)
+
+    return rows
+
+
+def connect(address, authkey, timeout=60.0):
+
+    """
+    Funzione che si connette al coordinatore, riprovando ogni secondo finché non è raggiungibile
+
+    Parametri:
+    ----------
+    address : Tupla (host, porta) del coordinatore
+    authkey : Chiave condivisa con il coordinatore, bytes
+    timeout : Tempo massimo di attesa del coordinatore [s] (Default: 60.0)
+
+    Ritorna:
+    --------
+    conn : Connessione al coordinatore
+
+    Solleva ConnectionError se il coordinatore non è raggiungibile entro timeout o se la chiave è errata
+    """
+
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except AuthenticationError:
+            raise ConnectionError(f"chiave rifiutata dal coordinatore {address[0]}:{address[1]}")
+        except ConnectionRefusedError:
+            if time.monotonic() > end:
+                raise ConnectionError(f"coordinatore {address[0]}:{address[1]} non raggiungibile")
+            time.sleep(1.0)
+
+
+def run_worker(address, authkey, timeout=60.0):
+
+    """
+    Funzione che esegue i blocchi assegnati dal coordinatore finché la scansione non è completata
+    Al coordinatore vengono restituiti solo gli array di RESULT_KEYS; se il coordinatore termina la connessione
+    il worker si chiude senza errori
+
+    Parametri:
+    ----------
+    address : Tupla (host, porta) del coordinatore
+    authkey : Chiave condivisa con il coordinatore, bytes
+    timeout : Tempo massimo di attesa del coordinatore all'avvio [s] (Default: 60.0)
+
+    Ritorna:
+    --------
+    n_done : Numero di blocchi eseguiti
+    """
+
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(address, authkey, timeout)
+    n_done = 0
+
+    try:
+        while True:
+            conn.send(('get', name))
+            msg = conn.recv()
+
+            if msg[0] == 'done':
+                break
+
+            if msg[0] == 'wait':
+                time.sleep(msg[1])
+                continue
+
+            _, tid, params, seed, size = msg
+            try:
+                res = en.run_chunk(params, seed, size)
+                conn.send(('result', tid, {key: res[key] for key in RESULT_KEYS}))
+                n_done += 1
+            except Exception as err:
+                conn.send(('error', tid, repr(err)))
+            conn.recv()
+
+    except (EOFError, OSError):
+        pass
+
+    finally:
+        conn.close()
+
+    return n_done
+
+
+def run_workers(address, authkey, workers=1, timeout=60.0):
+
+    """
+    Funzione che avvia più worker sulla stessa macchina, uno per processo
+
+    Parametri:
+    ----------
+    address : Tupla (host, porta) del coordinatore
+    authkey : Chiave condivisa con il coordinatore, bytes
+    workers : Numero di processi (Default: 1)
+    timeout : Tempo massimo di attesa del coordinatore all'avvio [s] (Default: 60.0)
+
+    Ritorna:
+    --------
+    n_done : Numero di blocchi eseguiti da tutti i processi
+    """
+
+    if workers <= 1:
+        return run_worker(address, authkey, timeout)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        n_done = sum(pool.map(run_worker, [address] * workers, [authkey] * workers, [timeout] * workers))
+
+    return n_done
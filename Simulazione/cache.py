@@ -0,0 +1,232 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+# Versione dei risultati degli integratori, da aumentare ad ogni modifica che cambia i valori numerici delle simulazioni
+# così i risultati calcolati con le versioni precedenti non vengono più riutilizzati
+VERSION = 4
+
+# Cartella della cache, se None la cache è disattivata
+CACHE_DIR = None
+
+# Dimensione massima della cache [byte]
+MAX_BYTES = 1024 * 2**20
+
+# Parametri che non cambiano i risultati: il backend numba è identico bit per bit a numpy in doppia precisione,
+# la precisione effettivamente usata entra nella chiave al posto di quella richiesta (effective_precision())
+IGNORED_KEYS = ['backend', 'profile']
+
+# Array per particella salvati nella cache, quando presenti nei risultati
+ARRAY_KEYS = ['qm', 'v0', 'v_drift', 'v_drift_err', 'v_drift_th']
+
+# Statistiche riassuntive di analysis.vd_stats() salvate insieme agli array
+STATS_KEYS = ['vd_mean', 'vd_err_final', 'vd_th_mean']
+
+
+def set_cache(cache_dir=None, max_mb=None):
+
+    """
+    Funzione che attiva la cache dei risultati nella cartella indicata, o la disattiva
+
+    Parametri:
+    ----------
+    cache_dir : Cartella della cache, creata se non esiste, se None la cache viene disattivata (Default: None)
+    max_mb    : Dimensione massima della cache [MB], se None resta quella attuale (Default: None)
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    global CACHE_DIR, MAX_BYTES
+
+    CACHE_DIR = cache_dir
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    if max_mb is not None:
+        MAX_BYTES = int(max_mb * 2**20)
+
+    return
+
+
+def file_hash(file_name):
+
+    """
+    Funzione che calcola l'impronta SHA-256 del contenuto di un file, letto a blocchi
+
+    Parametri:
+    ----------
+    file_name : Percorso del file
+
+    Ritorna:
+    --------
+    digest : Impronta esadecimale del file
+    """
+
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def effective_precision(params):
+
+    """
+    Funzione che ricava la precisione con cui la simulazione viene effettivamente integrata
+    I kernel di numba lavorano sempre in doppia precisione, tranne con la mappa di campo dove si usa comunque il ciclo NumPy
+
+    Parametri:
+    ----------
+    params : Dizionario con i parametri della simulazione
+
+    Ritorna:
+    --------
+    precision : 'double' o 'single'
+    """
+
+    if params.get('backend') == 'numba' and not params.get('field_map'):
+        return 'double'
+
+    return params.get('precision', 'double')
+
+
+def result_key(params, N_par, seeds):
+
+    """
+    Funzione che calcola la chiave dei risultati di una simulazione, l'impronta SHA-256 di tutto ciò che li determina:
+    parametri (campi, N, n_t, dt, q/m, integratore, stimatore, campionamento, ...), numero di particelle, semi dei blocchi
+    e VERSION. La mappa di campo entra con l'impronta del contenuto del file, non con il solo percorso, e la precisione
+    con quella effettivamente usata dal backend
+
+    Parametri:
+    ----------
+    params : Dizionario con i parametri della simulazione
+    N_par  : Numero di particelle
+    seeds  : Lista dei SeedSequence dei blocchi, come in ensemble.split_chunks()
+
+    Ritorna:
+    --------
+    key : Chiave esadecimale, None se la cache è disattivata
+    """
+
+    if CACHE_DIR is None:
+        return None
+
+    desc = {key: val for key, val in params.items() if key not in IGNORED_KEYS}
+    desc['precision'] = effective_precision(params)
+    if desc.get('field_map'):
+        desc['field_map'] = file_hash(desc['field_map'])
+
+    desc.update({
+        'version' : VERSION,
+        'N_par'   : N_par,
+        'seeds'   : [[str(s.entropy), list(s.spawn_key)] for s in seeds],
+    })
+
+    # Testo canonico: chiavi ordinate, array come liste e numeri con tutte le cifre
+    text = json.dumps(desc, sort_keys=True, default=lambda x: np.asarray(x).tolist())
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def load(key):
+
+    """
+    Funzione che legge i risultati associati a una chiave e li segna come usati di recente
+
+    Parametri:
+    ----------
+    key : Chiave restituita da result_key(), se None la funzione non fa nulla
+
+    Ritorna:
+    --------
+    hit : Tupla (res, stats) con il dizionario degli array di ARRAY_KEYS salvati e quello delle statistiche di STATS_KEYS,
+          None se la chiave non è nella cache
+    """
+
+    if key is None:
+        return None
+
+    file_res = os.path.join(CACHE_DIR, f'{key}.npz')
+    try:
+        with np.load(file_res) as data:
+            res = {k: data[k] for k in data.files if k not in STATS_KEYS}
+            stats = {k: float(data[k]) for k in STATS_KEYS}
+        os.utime(file_res)
+
+    except (OSError, KeyError, ValueError):
+        return None
+
+    return res, stats
+
+
+def store(key, res, stats):
+
+    """
+    Funzione che salva nella cache gli array per particella e le statistiche di una simulazione
+    Il file viene scritto con un nome temporaneo e poi rinominato, quindi processi diversi possono salvare insieme;
+    se la cache supera MAX_BYTES vengono eliminati i risultati usati meno di recente
+
+    Parametri:
+    ----------
+    key   : Chiave restituita da result_key(), se None la funzione non fa nulla
+    res   : Dizionario con gli array di tutte le particelle
+    stats : Dizionario restituito da analysis.vd_stats()
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    if key is None:
+        return
+
+    arrays = {k: res[k] for k in ARRAY_KEYS if k in res}
+    arrays.update({k: stats[k] for k in STATS_KEYS})
+
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, os.path.join(CACHE_DIR, f'{key}.npz'))
+
+    evict()
+
+    return
+
+
+def evict():
+
+    """
+    Funzione che elimina i risultati usati meno di recente finché la cache non rientra in MAX_BYTES
+    L'ordine è quello della data di modifica dei file, aggiornata da load() ad ogni lettura
+
+    Ritorna:
+    --------
+    n_removed : Numero di risultati eliminati
+    """
+
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npz'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+
+    n_removed = 0
+    for _, size, path in entries:
+        if total <= MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        n_removed += 1
+
+    return n_removed
@@ -0,0 +1,215 @@
+import os
+import json
+import numpy as np
+import trajectories as tj
+
+# Versione del formato della cartella dei checkpoint
+CHECKPOINT_FORMAT = 1
+
+
+def create_checkpoint(path, params, N_par, seed, traj_out=None):
+
+    """
+    Funzione che crea la cartella dei checkpoint di una simulazione con il file meta.json
+    I metadati contengono tutto ciò che serve per ripartire: parametri, numero di particelle e seme
+
+    Parametri:
+    ----------
+    path     : Percorso della cartella dei checkpoint
+    params   : Dizionario con i parametri della simulazione
+    N_par    : Numero di particelle
+    seed     : Entropia del seme della simulazione
+    traj_out : Cartella delle traiettorie della simulazione, se usata (Default: None)
+
+    Ritorna:
+    --------
+    Nessuno
+
+    Solleva FileExistsError se la cartella contiene già un checkpoint, che va ripreso con --resume
+    """
+
+    file_meta = os.path.join(path, 'meta.json')
+    if os.path.exists(file_meta):
+        raise FileExistsError(f"la cartella '{path}' contiene già un checkpoint")
+
+    os.makedirs(path, exist_ok=True)
+
+    meta = {
+        'format'   : CHECKPOINT_FORMAT,
+        'N_par'    : N_par,
+        'seed'     : str(seed),
+        'traj_out' : traj_out,
+        'params'   : {key: (np.asarray(val).tolist() if key in tj.ARRAY_KEYS else val) for key, val in params.items()},
+    }
+
+    with open(file_meta, 'w') as f:
+        json.dump(meta, f, indent=2, default=float)
+
+    return
+
+
+def open_checkpoint(path):
+
+    """
+    Funzione che legge i metadati della cartella dei checkpoint
+
+    Parametri:
+    ----------
+    path : Percorso della cartella dei checkpoint
+
+    Ritorna:
+    --------
+    meta : Dizionario dei metadati, con i parametri della simulazione in 'params'
+    """
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    if meta['format'] != CHECKPOINT_FORMAT:
+        raise ValueError(f"formato {meta['format']} della cartella '{path}' non supportato")
+
+    for key in tj.ARRAY_KEYS:
+        meta['params'][key] = np.array(meta['params'][key])
+
+    return meta
+
+
+def save_npz(file_npz, arrays):
+
+    """
+    Funzione che salva un dizionario di array in un file .npz in modo atomico
+    Il file viene scritto con un nome temporaneo e poi rinominato, quindi un'interruzione durante il salvataggio
+    lascia sempre intatto il checkpoint precedente
+
+    Parametri:
+    ----------
+    file_npz : Percorso del file
+    arrays   : Dizionario degli array, le voci None non vengono salvate
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    tmp = file_npz + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **{key: val for key, val in arrays.items() if val is not None})
+    os.replace(tmp, file_npz)
+
+    return
+
+
+def load_npz(file_npz):
+
+    """
+    Funzione che legge un file .npz salvato con save_npz()
+
+    Parametri:
+    ----------
+    file_npz : Percorso del file
+
+    Ritorna:
+    --------
+    arrays : Dizionario degli array, None se il file non esiste
+    """
+
+    if not os.path.exists(file_npz):
+        return None
+
+    with np.load(file_npz) as data:
+        arrays = {key: data[key] for key in data.files}
+
+    return arrays
+
+
+def save_chunk(path, index, res):
+
+    """
+    Funzione che salva i risultati di un blocco completato ed elimina il suo stato parziale
+
+    Parametri:
+    ----------
+    path  : Percorso della cartella dei checkpoint
+    index : Indice del blocco
+    res   : Dizionario restituito da ensemble.run_chunk(), i tempi delle fasi non vengono salvati
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    save_npz(os.path.join(path, f'chunk_{index:05d}.npz'), {key: val for key, val in res.items() if key != 'timing'})
+
+    file_state = os.path.join(path, f'state_{index:05d}.npz')
+    if os.path.exists(file_state):
+        os.remove(file_state)
+
+    return
+
+
+def load_chunk(path, index):
+
+    """
+    Funzione che legge i risultati di un blocco completato
+
+    Parametri:
+    ----------
+    path  : Percorso della cartella dei checkpoint
+    index : Indice del blocco
+
+    Ritorna:
+    --------
+    res : Dizionario dei risultati del blocco, None se il blocco non è stato completato
+    """
+
+    return load_npz(os.path.join(path, f'chunk_{index:05d}.npz'))
+
+
+def save_state(path, index, state):
+
+    """
+    Funzione che salva lo stato parziale dell'integrazione di un blocco
+    Lo stato del generatore casuale, un dizionario di interi, viene salvato come testo JSON
+
+    Parametri:
+    ----------
+    path  : Percorso della cartella dei checkpoint
+    index : Indice del blocco
+    state : Dizionario con n, r_n, v, gc_sum, r_gc e rng, come in drift_motions.drift_ensemble()
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    arrays = dict(state)
+    arrays['rng'] = np.array(json.dumps(state['rng']))
+    save_npz(os.path.join(path, f'state_{index:05d}.npz'), arrays)
+
+    return
+
+
+def load_state(path, index):
+
+    """
+    Funzione che legge lo stato parziale dell'integrazione di un blocco
+
+    Parametri:
+    ----------
+    path  : Percorso della cartella dei checkpoint
+    index : Indice del blocco
+
+    Ritorna:
+    --------
+    state : Dizionario dello stato come in save_state(), None se non è stato salvato
+    """
+
+    state = load_npz(os.path.join(path, f'state_{index:05d}.npz'))
+    if state is None:
+        return None
+
+    state['n'] = int(state['n'])
+    state['rng'] = json.loads(str(state['rng']))
+    state.setdefault('r_gc', None)
+
+    return state
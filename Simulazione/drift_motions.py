@@ -1,7 +1,15 @@
+import time
 import numpy as np
+import fields as fl
 
+# tqdm e i kernel di Numba vengono importati solo se usati, per avviare velocemente il programma
 
-def drift(N, dt, B, E, B_grad, qm, v0, n_t):
+# Passi di ogni finestra di eventi di scattering: gli eventi vengono generati una finestra alla volta,
+# quindi la memoria non cresce con il numero di passi, e lo stato parziale viene salvato solo all'inizio di una finestra
+EV_WINDOW = 4096
+
+
+def drift(N, dt, B, E, B_grad, qm, v0, n_t, field_map=None):
    
     """
     Funzione che calola la traiettoria e la velocità di una particella con il drift scelto
@@ -18,6 +26,8 @@ def drift(N, dt, B, E, B_grad, qm, v0, n_t):
     qm  : Rapporto carica massa [C/Kg]
     v0  : Velocità iniziale della particella [m/s]
     n_t : Coefficiente di scattering
+    field_map : Mappa di campo di fields.py, se data E e B sono interpolati nella posizione della particella
+                e B, E e B_grad vengono ignorati (Default: None)
 
     Ritorna:
     --------
@@ -29,19 +39,23 @@ def drift(N, dt, B, E, B_grad, qm, v0, n_t):
     v = np.zeros((N, 3))
     v[0, :] = v0
 
+    # Passi in cui la particella viene scatterata e nuove direzioni, generati prima del moto
+    ev_step, _, ev_dir = turbulence_schedule(N, 1, n_t)
+    k = 0
+
     #------------------------------------------------------------
     # Moto della particella
 
     for n in range(N-1):
 
-        # Randomizzazione direzione particella
-        scatter = np.random.uniform(0.001,1.000)
-
         # Calcolo del campo magnetico locale
-        B_loc = np.array([0.0, 0.0, B[2] + B_grad[0] * r[n,0] + B_grad[1] * r[n,1]])
+        if field_map is not None:
+            E, B_loc = (val[0] for val in fl.interpolate(field_map, r[n:n+1]))
+        else:
+            B_loc = np.array([0.0, 0.0, B[2] + B_grad[0] * r[n,0] + B_grad[1] * r[n,1]])
 
         # Creazione dei vettori di rotazione s e t
-        t = np.array([0.0, 0.0, qm * B_loc[2] * dt / 2.0]) 
+        t = qm * B_loc * dt / 2.0
         t2 = np.dot(t, t)
         s = 2 * t / (1 + t2)
 
@@ -58,9 +72,10 @@ def drift(N, dt, B, E, B_grad, qm, v0, n_t):
         v_new = v_plus + qm * E * dt / 2
 
         # Turbolenza
-        if scatter < n_t:
+        if k < len(ev_step) and ev_step[k] == n:
             v_mod = np.linalg.norm(v_new)
-            v[n+1] = v_mod * turbulence_effects()
+            v[n+1] = v_mod * ev_dir[k]
+            k += 1
         else:
             v[n+1] = v_new 
 
@@ -71,6 +86,493 @@ def drift(N, dt, B, E, B_grad, qm, v0, n_t):
     return r
 
 
+def drift_ensemble(N, dt, B, E, B_grad, qm, v0, n_t, progress=False, backend='numpy', integrator='boris', rng=None,
+                   steps_orb=None, n_orb=None, keep_traj=True, out=None, state=None, checkpoint=None, every=60.0, field_map=None,
+                   analytic=True, precision='double', gc_stride=1):
+
+    """
+    Funzione che calcola le traiettorie di tutte le particelle dell'ensemble contemporaneamente
+    Implementa lo stesso metodo di Boris di drift() ma opera su array di forma (N_par, 3)
+    Ogni particella ha il proprio rapporto carica massa, il proprio campo magnetico locale e la propria turbolenza,
+    con gli eventi di scattering generati una finestra di EV_WINDOW passi alla volta da turbulence_window()
+    Se sono dati steps_orb e n_orb accumula durante l'integrazione le somme delle posizioni su ogni orbita
+    e ricava i centri di guida senza bisogno di conservare le traiettorie complete
+
+    Parametri:
+    ----------
+    N      : Numero di passi della simulazione
+    dt     : Intervallo di tempo tra i passi [s]
+    B      : Campo magnetico di riferimento [T]
+    E      : Campo elettrico di riferimento [V/m]
+    B_grad : Gradiente del campo magnetico [T/m]
+    qm     : Array dei rapporti carica massa delle particelle [C/Kg], forma (N_par,)
+    v0     : Array delle velocità iniziali delle particelle [m/s], forma (N_par, 3)
+    n_t    : Coefficiente di scattering
+    progress   : Se True mostra la barra di avanzamento sui passi (Default: False)
+    backend    : 'numpy' per il ciclo vettorizzato, 'numba' per il kernel compilato (Default: 'numpy')
+    integrator : 'boris' per il metodo di Boris, 'exact' per la girazione esatta (Default: 'boris')
+    rng        : Generatore casuale np.random.Generator, se None ne viene creato uno nuovo (Default: None)
+    steps_orb  : Numero di passi per orbita per il calcolo dei centri di guida (Default: None)
+    n_orb      : Numero di orbite per il calcolo dei centri di guida (Default: None)
+    keep_traj  : Se False le traiettorie complete non vengono salvate (Default: True)
+    out        : Array di forma (N_par, N, 3) in cui scrivere le traiettorie, ad esempio un file mappato in memoria (Default: None)
+    state      : Stato parziale salvato da checkpoint da cui riprendere l'integrazione (Default: None)
+    checkpoint : Funzione chiamata con lo stato parziale almeno ogni every secondi, con le voci n (passo successivo), r_n, v,
+                 gc_sum, r_gc, rng (stato del generatore) e next_ev (prossimi eventi di scattering), sempre all'inizio
+                 di una finestra di EV_WINDOW passi (Default: None)
+    every      : Intervallo tra due chiamate di checkpoint [s] (Default: 60.0)
+    Lo stato parziale è usato solo dal backend numpy, con il backend numba un blocco viene sempre integrato per intero
+    field_map  : Mappa di campo di fields.py, se data E e B vengono interpolati ad ogni passo per tutte le particelle insieme
+                 e integrati con boris_step_3d(), B, E e B_grad vengono ignorati e si usa sempre il ciclo NumPy (Default: None)
+    analytic   : Se True, con campi uniformi e nessun evento di scattering, usa la soluzione in forma chiusa di
+                 analytic_ensemble() invece di integrare (Default: True)
+    precision  : 'double' o 'single', con 'single' velocità, coefficienti di rotazione e direzioni di scattering sono in float32,
+                 mentre posizioni e somme dei centri di guida restano in float64. Usata solo dal ciclo NumPy (Default: 'double')
+    gc_stride  : Orbite tra due centri di guida conservati, come in gc_orbits_kept(); ogni centro resta la media su
+                 una sola orbita (Default: 1)
+
+    Ritorna:
+    --------
+    r    : Array delle posizioni delle particelle ad ogni passo [m], forma (N_par, N, 3), None se keep_traj è False
+           Se out è dato r è out stesso
+    r_gc : Array delle posizioni dei centri di guida delle orbite di gc_orbits_kept() [m], forma (N_par, n_gc, 3),
+           None se steps_orb non è dato
+    """
+
+    qm = np.asarray(qm, dtype=float)
+    v0 = np.asarray(v0, dtype=float)
+    N_par = len(v0)
+
+    # Tipo delle velocità e dei coefficienti, le posizioni sono sempre in float64
+    ftype = np.float32 if precision == 'single' else np.float64
+
+    # Inizializzazione array posizione, velocità e centri di guida
+    if out is not None:
+        r = np.asarray(out)
+        r[:,0] = 0.0
+        keep_traj = True
+    else:
+        r = np.zeros((N_par, N, 3)) if keep_traj else None
+    r_n = np.zeros((N_par, 3))
+    v = v0.copy()
+    rng = np.random.default_rng() if rng is None else rng
+
+    # Indice in r_gc del centro di guida di ogni orbita, -1 per le orbite non conservate
+    stream = steps_orb is not None
+    r_gc, gc_slot = None, np.zeros(0, dtype=np.int64)
+    if stream:
+        kept = gc_orbits_kept(n_orb, gc_stride)
+        gc_slot = np.full(n_orb, -1, dtype=np.int64)
+        gc_slot[kept] = np.arange(len(kept))
+        r_gc = np.zeros((N_par, len(kept), 3))
+    gc_sum = np.zeros((N_par, 3))
+
+    # Passo del primo evento di scattering di ogni particella, gli eventi successivi sono generati una finestra alla volta
+    next_ev = turbulence_start(N_par, n_t, rng)
+
+    # Campi uniformi senza scattering: traiettorie e centri di guida in forma chiusa, senza integrare
+    uniform = field_map is None and B_grad[0] == 0 and B_grad[1] == 0
+    if analytic and uniform and np.all(next_ev >= N - 1) and state is None:
+        r_an, r_gc = analytic_ensemble(N, dt, B, E, qm, v0, integrator, steps_orb, n_orb, keep_traj, out, gc_stride=gc_stride)
+        return (r_an if out is None else out), r_gc
+
+    # Kernel compilato, il ciclo sui passi di ogni finestra viene eseguito fuori dall'interprete
+    # Il kernel scorre una particella per volta, quindi gli eventi vengono raggruppati per particella
+    if backend == 'numba' and field_map is None:
+        import kernels as kn
+        kernel = kn.boris_ensemble if integrator == 'boris' else kn.exact_ensemble
+        r_out = r if keep_traj else np.zeros((N_par, 1, 3))
+        r_gc_out = r_gc if stream else np.zeros((N_par, 0, 3))
+        B_k, E_k, B_grad_k = np.asarray(B, dtype=float), np.asarray(E, dtype=float), np.asarray(B_grad, dtype=float)
+        gc_sum_k = np.zeros((N_par, 3))
+        for n0 in range(0, max(N - 1, 1), EV_WINDOW):
+            n1 = min(n0 + EV_WINDOW, N - 1)
+            ev_step, ev_par, ev_dir = turbulence_window(next_ev, n0, n1, n_t, rng)
+            order = np.lexsort((ev_step, ev_par))
+            ev_ptr = np.searchsorted(ev_par[order], np.arange(N_par + 1))
+            kernel(r_out, r_gc_out, r_n, v, gc_sum_k, n0, n1, N, dt, B_k, E_k, B_grad_k, qm, ev_ptr, ev_step[order], ev_dir[order],
+                   steps_orb if stream else 0, gc_slot, keep_traj)
+        return (r if out is None else out), r_gc
+
+    # Velocità e campi nel tipo scelto, i numeri casuali sono comunque generati in float64
+    v = v.astype(ftype, copy=False)
+    qm_f, E_f = qm.astype(ftype, copy=False), np.asarray(E, dtype=ftype)
+
+    # Con campi uniformi i coefficienti dell'integratore sono calcolati una sola volta, in float64 e poi convertiti
+    coeffs = None
+    if uniform:
+        B_loc = np.full(N_par, float(B[2]))
+        coeffs = boris_coeffs(B_loc, E, qm, dt) if integrator == 'boris' else exact_coeffs(B_loc, E, qm, dt)
+        coeffs = tuple(np.asarray(c, dtype=ftype) for c in coeffs)
+
+    # Ripresa da uno stato parziale, salvato all'inizio di una finestra di eventi con il generatore e i prossimi eventi
+    n_start = 0
+    if state is not None:
+        if 'next_ev' not in state:
+            raise ValueError("il checkpoint è stato salvato da una versione precedente, senza i prossimi eventi di scattering")
+        n_start = state['n']
+        r_n, v, gc_sum = state['r_n'].copy(), state['v'].astype(ftype), state['gc_sum'].copy()
+        next_ev = state['next_ev'].astype(np.int64)
+        rng.bit_generator.state = state['rng']
+        if stream:
+            r_gc[:] = state['r_gc']
+    t_check = time.perf_counter()
+
+    #------------------------------------------------------------
+    # Moto delle particelle
+
+    if progress:
+        from tqdm import tqdm
+    steps = tqdm(range(n_start, N-1)) if progress else range(n_start, N-1)
+    for n in steps:
+
+        # Inizio di una finestra: salvataggio periodico dello stato e generazione degli eventi dei passi [n0, n1)
+        if n % EV_WINDOW == 0 or n == n_start:
+            if checkpoint is not None and time.perf_counter() - t_check >= every:
+                checkpoint({'n': n, 'r_n': r_n, 'v': v, 'gc_sum': gc_sum, 'r_gc': r_gc, 'rng': rng.bit_generator.state, 'next_ev': next_ev})
+                t_check = time.perf_counter()
+
+            n0, n1 = n, min(n - n % EV_WINDOW + EV_WINDOW, N - 1)
+            ev_step, ev_par, ev_dir = turbulence_window(next_ev, n0, n1, n_t, rng)
+            ev_dir = ev_dir.astype(ftype, copy=False)
+
+            # Indice del primo evento di ogni passo, gli eventi del passo n sono ev_start[n-n0]:ev_start[n-n0+1]
+            ev_start = np.searchsorted(ev_step, np.arange(n0, n1 + 1))
+
+        # Somma delle posizioni sull'orbita corrente, la posizione n è l'ultima dell'orbita o
+        if stream:
+            gc_sum += r_n
+            o, i = divmod(n + 1, steps_orb)
+            if i == 0 and o <= n_orb:
+                if gc_slot[o-1] >= 0:
+                    r_gc[:,gc_slot[o-1]] = gc_sum / steps_orb
+                gc_sum[:] = 0.0
+
+        # Passo dell'integratore scelto
+        if field_map is not None:
+
+            # Campi interpolati nelle posizioni di tutte le particelle
+            E_loc, B_loc = fl.interpolate(field_map, r_n)
+            v = boris_step_3d(v, B_loc.astype(ftype, copy=False), E_loc.astype(ftype, copy=False), qm_f, dt)
+            dr = None
+
+        elif integrator == 'boris':
+
+            # Calcolo del campo magnetico locale per ogni particella
+            if coeffs is None:
+                B_loc = (B[2] + B_grad[0] * r_n[:,0] + B_grad[1] * r_n[:,1]).astype(ftype, copy=False)
+            v = boris_step(v, B_loc, E_f, qm_f, dt, coeffs)
+            dr = None
+
+        else:
+
+            # Campo magnetico locale stimato a metà passo
+            if coeffs is None:
+                r_mid = r_n + v * dt / 2
+                B_loc = (B[2] + B_grad[0] * r_mid[:,0] + B_grad[1] * r_mid[:,1]).astype(ftype, copy=False)
+            v, dr = exact_step(v, B_loc, E_f, qm_f, dt, coeffs)
+
+        # Turbolenza sulle sole particelle scatterate in questo passo
+        a, b = ev_start[n-n0], ev_start[n-n0+1]
+        if b > a:
+            hit = ev_par[a:b]
+            v_mod = np.linalg.norm(v[hit], axis=1)
+            v[hit] = v_mod[:, None] * ev_dir[a:b]
+
+        # Aggiornamento posizione, sempre accumulata in float64
+        if dr is None:
+            r_n = r_n + v * dt
+        else:
+            r_n = r_n + dr
+
+        if keep_traj:
+            r[:,n+1] = r_n
+
+    # Ultima posizione, chiude l'orbita se termina esattamente all'ultimo passo
+    if stream:
+        gc_sum += r_n
+        o, i = divmod(N, steps_orb)
+        if i == 0 and o <= n_orb and gc_slot[o-1] >= 0:
+            r_gc[:,gc_slot[o-1]] = gc_sum / steps_orb
+    #------------------------------------------------------------
+
+    return (r if out is None else out), r_gc
+
+
+def boris_coeffs(B_loc, E, qm, dt):
+
+    """
+    Funzione che calcola i coefficienti del metodo di Boris, costanti se i campi sono uniformi
+
+    Parametri:
+    ----------
+    Gli stessi di boris_step()
+
+    Ritorna:
+    --------
+    a_half : Array delle accelerazioni elettriche su mezzo passo [m/s], forma (N_par, 3)
+    t, s   : Array delle componenti z dei vettori di rotazione, forma (N_par,)
+    """
+
+    # Accelerazione elettrica su mezzo passo
+    a_half = qm[:, None] * E * dt / 2
+
+    # Vettori di rotazione t e s, diretti lungo z
+    t = qm * B_loc * dt / 2.0
+    s = 2 * t / (1 + t**2)
+
+    return a_half, t, s
+
+
+def boris_step(v, B_loc, E, qm, dt, coeffs=None):
+
+    """
+    Funzione che esegue un passo del metodo di Boris per tutte le particelle con B diretto lungo z
+
+    Parametri:
+    ----------
+    v      : Array delle velocità delle particelle [m/s], forma (N_par, 3)
+    B_loc  : Array della componente z del campo magnetico locale [T], forma (N_par,)
+    E      : Campo elettrico [V/m]
+    qm     : Array dei rapporti carica massa [C/Kg], forma (N_par,)
+    dt     : Intervallo di tempo del passo [s]
+    coeffs : Coefficienti già calcolati con boris_coeffs(), se dati B_loc, E e qm non vengono usati (Default: None)
+
+    Ritorna:
+    --------
+    v_new : Array delle velocità al passo successivo [m/s]
+    """
+
+    a_half, t, s = boris_coeffs(B_loc, E, qm, dt) if coeffs is None else coeffs
+
+    # v_minus
+    v_minus = v + a_half
+
+    # v_prime = v_minus + v_minus × t
+    v_prime_x = v_minus[:,0] + v_minus[:,1] * t
+    v_prime_y = v_minus[:,1] - v_minus[:,0] * t
+
+    # v_plus = v_minus + v_prime × s
+    v_plus = v_minus.copy()
+    v_plus[:,0] += v_prime_y * s
+    v_plus[:,1] -= v_prime_x * s
+
+    v_new = v_plus + a_half
+
+    return v_new
+
+
+def analytic_ensemble(N, dt, B, E, qm, v0, integrator='boris', steps_orb=None, n_orb=None, keep_traj=True, out=None, block=65536, gc_stride=1):
+
+    """
+    Funzione che calcola in forma chiusa le posizioni e i centri di guida di drift_ensemble() con campi uniformi e senza scattering
+    Con B lungo z ed E uniforme ogni passo dell'integratore è una mappa lineare: nel piano perpendicolare, scritto con i
+    numeri complessi x + iy, la velocità relativa a una velocità di deriva w ruota ad ogni passo del fattore rho, quindi
+
+        r_n = n dt w + K (1 - rho^n) u0,    u0 = v0 - w
+
+    mentre lungo z il moto è uniformemente accelerato. Con il metodo di Boris rho = (1 - it)² / (1 + t²), w = a (1 + rho) / (1 - rho)
+    e K = dt rho / (1 - rho), con la girazione esatta rho = exp(-i om dt), w = E×B/B² e K = (A - iC) / (1 - rho)
+    Le posizioni coincidono con quelle integrate passo per passo a meno degli errori di arrotondamento, che qui non si accumulano
+    I centri di guida sono le medie delle posizioni su ogni orbita, ricavate con le somme geometriche senza calcolare le posizioni
+
+    Parametri:
+    ----------
+    Gli stessi di drift_ensemble()
+    block : Numero di passi calcolati per volta quando si salvano le traiettorie, limita la memoria usata (Default: 65536)
+
+    Ritorna:
+    --------
+    r    : Array delle posizioni delle particelle ad ogni passo [m], forma (N_par, N, 3), None se keep_traj è False
+           Se out è dato le posizioni vengono scritte in out
+    r_gc : Array delle posizioni dei centri di guida delle orbite di gc_orbits_kept() [m], forma (N_par, n_gc, 3),
+           None se steps_orb non è dato
+    """
+
+    qm = np.asarray(qm, dtype=float)
+    v0 = np.asarray(v0, dtype=float)
+    Bz = float(B[2])
+    om = qm * Bz                        # Frequenza di ciclotrone con segno [rad/s]
+    a_z = qm * E[2] * dt**2 / 2         # Spostamento lungo z dovuto a E_z in un passo [m]
+
+    # Fattore di rotazione, velocità di deriva e coefficiente dello spostamento di ogni particella
+    if integrator == 'boris':
+        t = om * dt / 2
+        rho = (1 - 1j * t)**2 / (1 + t**2)
+        a = qm * (E[0] + 1j * E[1]) * dt / 2
+        w = a * (1 + rho) / (1 - rho)
+        K = dt * rho / (1 - rho)
+    else:
+        rho = np.exp(-1j * om * dt)
+        w = np.full(len(qm), (E[1] - 1j * E[0]) / Bz)
+        K = (np.sin(om * dt) / om - 1j * (1 - np.cos(om * dt)) / om) / (1 - rho)
+
+    phase = np.angle(rho)
+    u0 = v0[:,0] + 1j * v0[:,1] - w
+
+    # Spostamento lungo z dopo n passi: n(n+1) per Boris, che aggiorna la posizione con la velocità nuova, n² per la girazione esatta
+    def z_sum(n):
+        return n * (n + 1) if integrator == 'boris' else n**2
+
+    #------------------------------------------------------------
+    # Posizioni ad ogni passo, calcolate a blocchi di passi
+
+    r = None
+    if keep_traj or out is not None:
+        r = out if out is not None else np.zeros((len(v0), N, 3))
+        for j0 in range(0, N, block):
+            n = np.arange(j0, min(j0 + block, N))
+            xy = n * dt * w[:, None] + (K * u0)[:, None] * (1 - np.exp(1j * phase[:, None] * n))
+            r[:, j0:j0+len(n), 0] = xy.real
+            r[:, j0:j0+len(n), 1] = xy.imag
+            r[:, j0:j0+len(n), 2] = n * dt * v0[:, 2:3] + a_z[:, None] * z_sum(n)
+    #------------------------------------------------------------
+
+    #------------------------------------------------------------
+    # Centri di guida, medie dei passi j = o S, ..., o S + S - 1 delle orbite o conservate
+
+    r_gc = None
+    if steps_orb is not None:
+        S = steps_orb
+        j0 = gc_orbits_kept(n_orb, gc_stride) * S
+        j_mean = j0 + (S - 1) / 2
+        j2_mean = j0**2 + j0 * (S - 1) + (S - 1) * (2 * S - 1) / 6
+
+        # Media di rho^j sull'orbita, somma geometrica
+        G = (1 - np.exp(1j * phase * S)) / (S * (1 - np.exp(1j * phase)))
+        rho_mean = np.exp(1j * phase[:, None] * j0) * G[:, None]
+
+        xy = j_mean * dt * w[:, None] + (K * u0)[:, None] * (1 - rho_mean)
+        z_mean = j2_mean + j_mean if integrator == 'boris' else j2_mean
+
+        r_gc = np.empty((len(v0), len(j0), 3))
+        r_gc[:,:,0] = xy.real
+        r_gc[:,:,1] = xy.imag
+        r_gc[:,:,2] = j_mean * dt * v0[:, 2:3] + a_z[:, None] * z_mean
+    #------------------------------------------------------------
+
+    return r, r_gc
+
+
+def boris_step_3d(v, B_loc, E_loc, qm, dt):
+
+    """
+    Funzione che esegue un passo del metodo di Boris per tutte le particelle con campi locali di direzione qualsiasi
+
+    Parametri:
+    ----------
+    v     : Array delle velocità delle particelle [m/s], forma (N_par, 3)
+    B_loc : Array del campo magnetico locale [T], forma (N_par, 3)
+    E_loc : Array del campo elettrico locale [V/m], forma (N_par, 3)
+    qm    : Array dei rapporti carica massa [C/Kg], forma (N_par,)
+    dt    : Intervallo di tempo del passo [s]
+
+    Ritorna:
+    --------
+    v_new : Array delle velocità al passo successivo [m/s]
+    """
+
+    # Accelerazione elettrica su mezzo passo
+    a_half = qm[:, None] * E_loc * dt / 2
+
+    # Vettori di rotazione t e s
+    t = qm[:, None] * B_loc * dt / 2.0
+    s = 2 * t / (1 + np.sum(t**2, axis=1))[:, None]
+
+    # v_minus
+    v_minus = v + a_half
+    mx, my, mz = v_minus.T
+    tx, ty, tz = t.T
+    sx, sy, sz = s.T
+
+    # v_prime = v_minus + v_minus × t, prodotti vettoriali per componenti, più veloci di np.cross su array piccoli
+    px = mx + my * tz - mz * ty
+    py = my + mz * tx - mx * tz
+    pz = mz + mx * ty - my * tx
+
+    # v_plus = v_minus + v_prime × s
+    v_new = np.empty_like(v)
+    v_new[:,0] = mx + py * sz - pz * sy
+    v_new[:,1] = my + pz * sx - px * sz
+    v_new[:,2] = mz + px * sy - py * sx
+    v_new += a_half
+
+    return v_new
+
+
+def exact_coeffs(B_loc, E, qm, dt):
+
+    """
+    Funzione che calcola i coefficienti della girazione esatta, costanti se i campi sono uniformi
+
+    Parametri:
+    ----------
+    Gli stessi di exact_step()
+
+    Ritorna:
+    --------
+    c, s       : Array del coseno e del seno dell'angolo di rotazione, forma (N_par,)
+    vE_x, vE_y : Componenti della velocità E×B/B² [m/s]
+    A, C       : Array degli integrali della rotazione sul passo [s], forma (N_par,)
+    """
+
+    # Frequenza di ciclotrone con segno e angolo di rotazione
+    om = qm * B_loc
+    c = np.cos(om * dt)
+    s = np.sin(om * dt)
+
+    # Velocità di deriva E×B/B²
+    vE_x = E[1] / B_loc
+    vE_y = -E[0] / B_loc
+
+    # Integrali esatti della rotazione sul passo
+    A = s / om
+    C = (1 - c) / om
+
+    return c, s, vE_x, vE_y, A, C
+
+
+def exact_step(v, B_loc, E, qm, dt, coeffs=None):
+
+    """
+    Funzione che esegue un passo con la soluzione esatta del moto per B diretto lungo z ed E uniforme
+    Nel piano perpendicolare la velocità ruota dell'angolo qm*B_loc*dt attorno alla velocità E×B/B²,
+    lungo z il moto è uniformemente accelerato. Anche lo spostamento è l'integrale esatto della velocità
+
+    Parametri:
+    ----------
+    v      : Array delle velocità delle particelle [m/s], forma (N_par, 3)
+    B_loc  : Array della componente z del campo magnetico locale [T], forma (N_par,)
+    E      : Campo elettrico [V/m]
+    qm     : Array dei rapporti carica massa [C/Kg], forma (N_par,)
+    dt     : Intervallo di tempo del passo [s]
+    coeffs : Coefficienti già calcolati con exact_coeffs(), se dati B_loc non viene usato (Default: None)
+
+    Ritorna:
+    --------
+    v_new : Array delle velocità al passo successivo [m/s]
+    dr    : Array degli spostamenti durante il passo [m]
+    """
+
+    c, s, vE_x, vE_y, A, C = exact_coeffs(B_loc, E, qm, dt) if coeffs is None else coeffs
+
+    # Velocità relativa che ruota attorno a E×B/B²
+    u_x = v[:,0] - vE_x
+    u_y = v[:,1] - vE_y
+
+    v_new = np.empty_like(v)
+    v_new[:,0] = vE_x + u_x * c + u_y * s
+    v_new[:,1] = vE_y + u_y * c - u_x * s
+    v_new[:,2] = v[:,2] + qm * E[2] * dt
+
+    dr = np.empty_like(v)
+    dr[:,0] = vE_x * dt + u_x * A + u_y * C
+    dr[:,1] = vE_y * dt + u_y * A - u_x * C
+    dr[:,2] = v[:,2] * dt + qm * E[2] * dt**2 / 2
+
+    return v_new, dr
+
+
 def guide_center(r, n_orb, steps_orb):
 
     """
@@ -129,7 +631,123 @@ def v_drift(r_gc, n_orb, T_orb, B_hat):
     return v_d_vec
 
 
-def turbulence_effects():
+def gc_orbits_kept(n_orb, gc_stride=1):
+
+    """
+    Funzione che elenca le orbite di cui vengono conservati i centri di guida: una ogni gc_stride, più l'ultima
+    Il primo e l'ultimo centro sono sempre presenti, quindi lo stimatore endpoint è identico a quello con tutti i centri
+
+    Parametri:
+    ----------
+    n_orb     : Numero di orbite del moto
+    gc_stride : Orbite tra due centri di guida conservati (Default: 1)
+
+    Ritorna:
+    --------
+    orbits : Array crescente degli indici delle orbite conservate
+    """
+
+    orbits = np.arange(0, n_orb, gc_stride)
+    if n_orb > 0 and orbits[-1] != n_orb - 1:
+        orbits = np.append(orbits, n_orb - 1)
+
+    return orbits
+
+
+def guide_center_ensemble(position, n_orb, steps_orb):
+
+    """
+    Funzione che calcola i centri di guida di tutte le particelle con una sola operazione
+    Le posizioni vengono riorganizzate in un array (N_par, n_orb, steps_orb, 3) e mediate su ogni orbita
+
+    Parametri:
+    ----------
+    position  : Array delle posizioni delle particelle [m], forma (N_par, N, 3)
+    n_orb     : Numero di orbite del moto
+    steps_orb : Numero di passi per orbita
+
+    Ritorna:
+    --------
+    r_gc : Array con posizioni dei centri di guida [m], forma (N_par, n_orb, 3)
+    """
+
+    N_par = position.shape[0]
+    r_orb = position[:, :n_orb * steps_orb].reshape(N_par, n_orb, steps_orb, 3)
+    r_gc = r_orb.mean(axis=2)
+
+    return r_gc
+
+
+def v_drift_ensemble(r_gc, n_orb, T_orb, B_hat):
+
+    """
+    Funzione che calcola le velocità di drift di tutte le particelle con lo stesso metodo di v_drift()
+
+    Parametri:
+    ----------
+    r_gc   : Array delle posizioni dei centri di guida [m], forma (N_par, n_orb, 3)
+    n_orb  : Numero di orbite del moto
+    T_orb  : Periodo per compiere un orbita [s]
+    B_hat  : Versore campo magnetico
+
+    Ritorna:
+    --------
+    v_d_vec : Array delle velocità di drift [m/s], forma (N_par, 3)
+    """
+
+    # Calcolo della velocità dei centri di guida
+    v_gc_vec = (r_gc[:,-1] - r_gc[:,0]) / (n_orb * T_orb)
+
+    # Calcolo della velocità di drift
+    v_d_vec = v_gc_vec - (v_gc_vec @ B_hat)[:, None] * B_hat
+
+    return v_d_vec
+
+
+def v_drift_fit(r_gc, T_orb, B_hat, orbits=None):
+
+    """
+    Funzione che calcola le velocità di drift di tutte le particelle con un fit lineare ai minimi quadrati
+    La velocità del centro di guida è la pendenza della retta che interpola tutti i centri di guida,
+    non solo il primo e l'ultimo, e l'errore si ricava dai residui del fit per ogni particella
+
+    Parametri:
+    ----------
+    r_gc   : Array delle posizioni dei centri di guida [m], forma (N_par, n_orb, 3)
+    T_orb  : Periodo per compiere un orbita [s]
+    B_hat  : Versore campo magnetico
+    orbits : Indici delle orbite dei centri di guida, come in gc_orbits_kept(), se None sono consecutivi (Default: None)
+
+    Ritorna:
+    --------
+    v_d_vec : Array delle velocità di drift [m/s], forma (N_par, 3)
+    v_d_err : Array degli errori sulle componenti della velocità di drift [m/s], forma (N_par, 3)
+    """
+
+    n_orb = r_gc.shape[1]
+
+    # Tempi dei centri di guida, centrati sulla media
+    if orbits is None:
+        t = (np.arange(n_orb) - (n_orb - 1) / 2) * T_orb
+    else:
+        t = (orbits - np.mean(orbits)) * T_orb
+    S_tt = np.sum(t**2)
+
+    # Pendenza e residui del fit per ogni particella e componente
+    r_mean = r_gc.mean(axis=1)
+    v_gc_vec = np.einsum('i,pik->pk', t, r_gc) / S_tt
+    res = r_gc - r_mean[:, None] - t[None, :, None] * v_gc_vec[:, None]
+    v_gc_var = np.sum(res**2, axis=1) / max(n_orb - 2, 1) / S_tt
+
+    # Calcolo della velocità di drift e propagazione della varianza con il proiettore perpendicolare a B
+    P = np.eye(3) - np.outer(B_hat, B_hat)
+    v_d_vec = v_gc_vec @ P.T
+    v_d_err = np.sqrt(v_gc_var @ (P**2).T)
+
+    return v_d_vec, v_d_err
+
+
+def turbulence_effects(n=None, rng=None):
   
     """
     Funzione che scattera la direzione della particella in una direzione casuale 
@@ -137,22 +755,151 @@ def turbulence_effects():
     
     Parametri:
     ----------
-    Nessuno   
+    n   : Numero di direzioni da generare, se None ne genera una sola (Default: None)
+    rng : Generatore casuale np.random.Generator, se None usa lo stato globale di np.random (Default: None)
 
     Ritorna:
     --------
-    rand_dir : Array per la direzione della particella con valori casuali
+    rand_dir : Array per la direzione della particella con valori casuali, di forma (3,) o (n, 3)
     """	
 
+    rng = np.random if rng is None else rng
+
     # Definizioni dei valori che vengono generati casualmente per phi e theta
-    cos_th = np.random.uniform(-1.0, 1.0)
+    cos_th = rng.uniform(-1.0, 1.0, n)
     sin_th = np.sqrt(1-cos_th**2)
-    phi = np.random.uniform(0.0, 2.0*np.pi)
+    phi = rng.uniform(0.0, 2.0*np.pi, n)
     
     # Definizione dei versori
     dir_x = sin_th * np.cos(phi)
     dir_y = sin_th * np.sin(phi)
     dir_z = cos_th
-    rand_dir = np.array([dir_x, dir_y, dir_z])
+    rand_dir = np.stack([dir_x, dir_y, dir_z], axis=-1)
     
-    return rand_dir
\ No newline at end of file
+    return rand_dir
+
+
+def scatter_prob(n_t):
+
+    """
+    Funzione che ricava la probabilità di scattering per passo dal coefficiente di scattering
+    Ad ogni passo una particella viene scatterata se un numero uniforme in [0.001, 1] è minore di n_t,
+    cioè con probabilità p = (n_t - 0.001) / 0.999
+
+    Parametri:
+    ----------
+    n_t : Coefficiente di scattering
+
+    Ritorna:
+    --------
+    p : Probabilità di scattering per passo, compresa in [0, 1]
+    """
+
+    return min(max((n_t - 0.001) / 0.999, 0.0), 1.0)
+
+
+def turbulence_start(N_par, n_t, rng=None):
+
+    """
+    Funzione che estrae il passo del primo evento di scattering di ogni particella
+    Il numero di passi tra due eventi segue una distribuzione geometrica di parametro p = scatter_prob(n_t)
+
+    Parametri:
+    ----------
+    N_par : Numero di particelle
+    n_t   : Coefficiente di scattering
+    rng   : Generatore casuale np.random.Generator, se None usa lo stato globale di np.random (Default: None)
+
+    Ritorna:
+    --------
+    next_ev : Array del passo del prossimo evento di ogni particella, forma (N_par,), aggiornato da turbulence_window()
+              Senza scattering contiene un passo mai raggiunto
+    """
+
+    rng = np.random if rng is None else rng
+    p = scatter_prob(n_t)
+
+    if p == 0.0:
+        return np.full(N_par, np.iinfo(np.int64).max, dtype=np.int64)
+
+    return rng.geometric(p, N_par).astype(np.int64) - 1
+
+
+def turbulence_window(next_ev, n0, n1, n_t, rng=None):
+
+    """
+    Funzione che genera gli eventi di scattering dei passi [n0, n1) a partire dal prossimo evento di ogni particella
+    L'intervallo geometrico successivo viene estratto solo quando l'evento di una particella cade nella finestra,
+    quindi la memoria dipende dalla lunghezza della finestra e non da quella della simulazione
+    Le direzioni dopo lo scattering vengono generate tutte insieme con turbulence_effects()
+
+    Parametri:
+    ----------
+    next_ev : Array del passo del prossimo evento di ogni particella restituito da turbulence_start(), aggiornato sul posto
+    n0, n1  : Primo passo della finestra e primo passo successivo
+    n_t     : Coefficiente di scattering
+    rng     : Generatore casuale np.random.Generator, se None usa lo stato globale di np.random (Default: None)
+
+    Ritorna:
+    --------
+    ev_step : Array dei passi in cui avvengono gli eventi, ordinato, forma (M,)
+    ev_par  : Array delle particelle scatterate in ogni evento, forma (M,)
+    ev_dir  : Array delle nuove direzioni delle particelle, forma (M, 3)
+    """
+
+    rng = np.random if rng is None else rng
+    p = scatter_prob(n_t)
+
+    # Intervalli estratti a blocchi di K per le particelle con eventi nella finestra, in numero sufficiente
+    # per coprirla salvo rari casi che vengono completati al giro successivo
+    K = int((n1 - n0) * p + 5 * np.sqrt((n1 - n0) * p * (1 - p))) + 8
+    steps, pars = [], []
+    hit = np.nonzero(next_ev < n1)[0]
+    while len(hit):
+        gaps = rng.geometric(p, (len(hit), K))
+        ev = next_ev[hit, None] + np.concatenate([np.zeros((len(hit), 1), dtype=np.int64), np.cumsum(gaps[:, :-1], axis=1)], axis=1)
+
+        # Gli eventi sono crescenti, quelli nella finestra sono i primi n_in di ogni particella
+        n_in = np.sum(ev < n1, axis=1)
+        par, col = np.nonzero(ev < n1)
+        steps.append(ev[par, col])
+        pars.append(hit[par])
+
+        # Prossimo evento: il primo oltre la finestra, o quello dopo l'ultimo estratto
+        next_ev[hit] = np.where(n_in < K, ev[np.arange(len(hit)), np.minimum(n_in, K - 1)], ev[:, -1] + gaps[:, -1])
+        hit = hit[next_ev[hit] < n1]
+
+    if not steps:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+
+    # Eventi ordinati per passo, una particella ha al più un evento per passo
+    ev_step, ev_par = np.concatenate(steps), np.concatenate(pars)
+    order = np.argsort(ev_step, kind='stable')
+    ev_step, ev_par = ev_step[order], ev_par[order]
+
+    ev_dir = turbulence_effects(len(ev_step), rng)
+
+    return ev_step, ev_par, ev_dir
+
+
+def turbulence_schedule(N, N_par, n_t, rng=None):
+
+    """
+    Funzione che genera in anticipo tutti gli eventi di scattering delle particelle, come un'unica finestra di turbulence_window()
+    Usata per la singola particella di drift(), che conserva comunque l'intera traiettoria
+
+    Parametri:
+    ----------
+    N     : Numero di passi della simulazione
+    N_par : Numero di particelle
+    n_t   : Coefficiente di scattering
+    rng   : Generatore casuale np.random.Generator, se None usa lo stato globale di np.random (Default: None)
+
+    Ritorna:
+    --------
+    ev_step, ev_par, ev_dir : Eventi di tutti i passi della simulazione, come in turbulence_window()
+    """
+
+    next_ev = turbulence_start(N_par, n_t, rng)
+
+    return turbulence_window(next_ev, 0, max(N - 1, 0), n_t, rng)
@@ -0,0 +1,701 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import drift_motions as dm
+import trajectories as tj
+import analysis as an
+import profiling as pf
+import checkpoint as ck
+import fields as fl
+
+# Numero di particelle per blocco, ogni blocco ha il proprio generatore casuale
+# La suddivisione non dipende dal numero di processi, quindi i risultati sono riproducibili
+CHUNK_SIZE = 128
+
+# Numero minimo di blocchi indipendenti con i campionamenti a varianza ridotta: l'errore della velocità di drift media
+# è ricavato dalla dispersione delle medie dei blocchi, quindi con poche particelle i blocchi sono più piccoli di CHUNK_SIZE
+MIN_BLOCKS = 4
+
+# Deviazioni standard delle componenti della velocità iniziale [m/s]
+V_SIGMA = np.array([4e5, 4e5, 5e4])
+
+# Metodi di campionamento delle condizioni iniziali
+SAMPLING = ['mc', 'antithetic', 'lhs', 'sobol']
+
+# Passi per orbita minimi perché i centri di guida, medie su un'orbita, siano affidabili
+MIN_STEPS_ORB = 16
+
+# Configurazioni di riferimento per il controllo della singola precisione, entrambe con turbolenza e quindi integrate
+# passo per passo: E×B ha una velocità media ben misurata, ∇B usa anche il campo magnetico locale in float32
+PRECISION_REFS = [
+    {'flag': 'ExB',   'Bz': 8e-4, 'E': [10.0, 10.0, 0.0], 'B_grad': [0.0, 0.0, 0.0],   'N': 3000, 'dt': 1e-6, 'n_t': 0.01},
+    {'flag': 'gradB', 'Bz': 8e-4, 'E': [0.0, 0.0, 0.0],   'B_grad': [5e-7, 6e-7, 0.0], 'N': 3000, 'dt': 1e-6, 'n_t': 0.01},
+]
+
+# Differenza massima tra le velocità di drift della stessa particella in singola e doppia precisione, relativa alla
+# velocità di drift teorica media: con le cariche casuali la media di ∇B è quasi nulla e dominata dal rumore,
+# quindi il confronto è particella per particella (gli arrotondamenti danno circa 1e-4 con l'integratore exact)
+PRECISION_RTOL = 1e-3
+
+
+def max_field(Bz, B_grad, t_tot, qm):
+
+    """
+    Funzione che stima il massimo modulo del campo magnetico incontrato dalle particelle
+    Il dominio è un cerchio di raggio pari a due raggi di Larmor più lo spostamento per deriva ∇B
+    nella durata della simulazione, calcolati per una velocità di 5 deviazioni standard
+
+    Parametri:
+    ----------
+    Bz     : Componente z del campo magnetico [T]
+    B_grad : Gradiente del campo magnetico [T/m]
+    t_tot  : Durata della simulazione [s]
+    qm     : Rapporto carica massa per particella positiva [C/Kg]
+
+    Ritorna:
+    --------
+    B_max : Massimo modulo del campo magnetico nel dominio [T]
+    """
+
+    B_mod = abs(Bz)
+    G = np.linalg.norm(np.asarray(B_grad, dtype=float)[:2])
+
+    v_max = 5 * np.linalg.norm(V_SIGMA)                 # Velocità massima delle particelle [m/s]
+    r_L   = v_max / (qm * B_mod)                        # Raggio di Larmor massimo [m]
+    v_d   = v_max**2 * G / (2 * qm * B_mod**2)          # Velocità di deriva ∇B massima [m/s]
+
+    B_max = B_mod + G * (2 * r_L + v_d * t_tot)
+
+    return B_max
+
+
+def auto_dt(Bz, B_grad, N, qm, steps_orb):
+
+    """
+    Funzione che sceglie l'intervallo di tempo tra i passi in modo da avere steps_orb passi per orbita
+    nel punto in cui il campo è più intenso, dove il periodo di ciclotrone è più breve
+    La durata usata per stimare il dominio è calcolata con il periodo di ciclotrone di Bz, che è il più lungo,
+    quindi il campo massimo è stimato per eccesso e i passi per orbita effettivi non sono mai meno di steps_orb
+
+    Parametri:
+    ----------
+    Bz        : Componente z del campo magnetico [T]
+    B_grad    : Gradiente del campo magnetico [T/m]
+    N         : Numero di passi della simulazione
+    qm        : Rapporto carica massa per particella positiva [C/Kg]
+    steps_orb : Passi per orbita desiderati
+
+    Ritorna:
+    --------
+    dt : Intervallo di tempo tra i passi [s]
+
+    Solleva ValueError se steps_orb è minore di MIN_STEPS_ORB
+    """
+
+    if steps_orb < MIN_STEPS_ORB:
+        raise ValueError(f"i passi per orbita devono essere almeno {MIN_STEPS_ORB}")
+
+    t_tot = N / steps_orb * 2 * np.pi / (qm * abs(Bz))
+    dt = 2 * np.pi / (qm * max_field(Bz, B_grad, t_tot, qm)) / steps_orb
+
+    return dt
+
+
+def build_params(flag, Bz, E, B_grad, N, dt, n_t, qm, backend='numpy', integrator='boris', estimator='endpoint', steps_orb=None,
+                 sampling='mc', balance=False, field_map=None, analytic=True, precision='double', gc_stride=1):
+
+    """
+    Funzione che crea il dizionario dei parametri di una configurazione di campo
+    Calcola il periodo di ciclotrone, i passi per orbita e il numero di orbite usati per i centri di guida
+    Se steps_orb è dato, dt viene ignorato e ricavato con auto_dt()
+
+    Parametri:
+    ----------
+    flag   : Tipo di drift, 'ExB' o 'gradB'
+    Bz     : Componente z del campo magnetico [T]
+    E      : Campo elettrico [V/m]
+    B_grad : Gradiente del campo magnetico [T/m]
+    N      : Numero di passi della simulazione
+    dt     : Intervallo di tempo tra i passi [s]
+    n_t    : Coefficiente di scattering
+    qm     : Rapporto carica massa per particella positiva [C/Kg]
+    backend, integrator, estimator : Scelte di calcolo, come in drift_ensemble() e run_chunk()
+    steps_orb : Passi per orbita desiderati nel punto di campo più intenso (Default: None)
+    sampling, balance : Campionamento delle condizioni iniziali, come in initial_conditions()
+    field_map : File .npz della mappa di campo di fields.py, se dato Bz, E e B_grad sono i campi di riferimento
+                usati per orbite e teoria, mentre le particelle si muovono nei campi interpolati (Default: None)
+    analytic  : Se True usa la soluzione in forma chiusa con campi uniformi e senza scattering, come in drift_ensemble() (Default: True)
+    precision : Precisione di velocità e coefficienti dell'integratore, 'double' o 'single', come in drift_ensemble() (Default: 'double')
+    gc_stride : Orbite tra due centri di guida conservati, più di una per le specie veloci di species.py, così il numero
+                di centri di guida non cresce con la frequenza di ciclotrone; ogni centro resta la media su una sola orbita,
+                come in drift_motions.gc_orbits_kept() (Default: 1)
+
+    Ritorna:
+    --------
+    params : Dizionario con i parametri della simulazione
+             La voce 'profile' riporta se la misura dei tempi di profiling.py è attiva, così anche i processi di calcolo misurano le fasi
+
+    Solleva ZeroDivisionError se il campo magnetico è nullo o i passi non bastano per un'orbita
+    e ValueError se steps_orb è minore di MIN_STEPS_ORB o se la mappa di campo è usata con l'integratore exact
+    """
+
+    if Bz == 0:
+        raise ZeroDivisionError("Il campo magnetico deve essere non nullo")
+
+    if field_map is not None and integrator == 'exact':
+        raise ValueError("l'integratore exact richiede E uniforme e B lungo z, con una mappa di campo usare boris")
+
+    if steps_orb is not None:
+        dt = auto_dt(Bz, B_grad, N, qm, steps_orb)
+
+    B = np.array([0.0, 0.0, Bz])
+    E = np.asarray(E, dtype=float)
+    B_grad = np.asarray(B_grad, dtype=float)
+
+    # Calcolo del periodo di ciclotrone
+    B_mod = np.linalg.norm(B)       # Modulo del campo magnetico [T]
+    B_hat = B / B_mod               # Versore del campo magnetico 
+    om_c  = qm * B_mod              # Frequenza di ciclotrone [rad/s]
+    T_c   = 2 * np.pi / om_c        # Periodo di ciclotrone [s]
+
+    # Calcolo del numero di orbite, la tolleranza evita che con dt automatico 82 passi diventino 81.999... -> 81
+    steps_orb = int(T_c / dt + 1e-9)  # Passi per completare un orbita
+    T_orb = steps_orb * dt          # Periodo per completare un orbita [s]
+    n_orb = int(N / steps_orb)      # Numero di orbite completate
+
+    # Passi per orbita nel punto di campo più intenso, i meno risolti
+    steps_orb_min = int(2 * np.pi / (qm * max_field(Bz, B_grad, N * dt, qm)) / dt + 1e-9)
+
+    # Valore caratteristico del campo per il fit lineare
+    fields_val = np.linalg.norm(E[:2]) if flag == 'ExB' else np.linalg.norm(B_grad[:2])
+
+    params = {
+        'flag'          : flag,
+        'N'             : N,
+        'dt'            : dt,
+        'B'             : B,
+        'E'             : E,
+        'B_grad'        : B_grad,
+        'qm'            : qm,
+        'n_t'           : n_t,
+        'n_orb'         : n_orb,
+        'steps_orb'     : steps_orb,
+        'steps_orb_min' : steps_orb_min,
+        'T_orb'         : T_orb,
+        'B_hat'         : B_hat,
+        'fields_val'    : fields_val,
+        'backend'       : backend,
+        'integrator'    : integrator,
+        'estimator'     : estimator,
+        'sampling'      : sampling,
+        'balance'       : balance,
+        'profile'       : pf.ENABLED,
+        'field_map'     : field_map,
+        'analytic'      : analytic,
+        'precision'     : precision,
+        'gc_stride'     : gc_stride,
+    }
+
+    return params
+
+
+def initial_conditions(rng, N_par, qm, sampling='mc', balance=False, charge=None, v_sigma=None):
+
+    """
+    Funzione che genera le condizioni iniziali casuali delle particelle
+    La carica ha segno casuale e le componenti della velocità seguono distribuzioni gaussiane
+    Oltre al Monte Carlo semplice sono disponibili campionamenti a varianza ridotta:
+    'antithetic' aggiunge ad ogni particella la gemella con carica opposta e stessa velocità,
+    'lhs' e 'sobol' campionano carica e velocità con ipercubo latino o sequenza di Sobol randomizzata
+    Con 512 particelle e 16 semi la dispersione della velocità di drift media rispetto a 'mc' scende con 'antithetic'
+    da 1.7 a 0.3 m/s per ExB e da 58 a 1.1 m/s per gradB, con 'sobol' a 0.16 m/s per ExB e 13 m/s per gradB,
+    mentre 'lhs' non la riduce: il guadagno dipende dalla configurazione e va verificato con più semi
+
+    Parametri:
+    ----------
+    rng      : Generatore casuale np.random.Generator
+    N_par    : Numero di particelle
+    qm       : Rapporto carica massa per particella positiva [C/Kg]
+    sampling : Metodo di campionamento, uno tra SAMPLING (Default: 'mc')
+    balance  : Se True metà delle particelle ha carica positiva e metà negativa (Default: False)
+               Con 'mc' l'ordine è casuale, con 'lhs' e 'sobol' è negativa la metà con la coordinata della carica minore,
+               così il segno resta stratificato; con 'antithetic' le cariche sono già bilanciate coppia per coppia
+    charge   : Segno della carica di tutte le particelle, +1 o -1, se None il segno è casuale come sopra (Default: None)
+               I numeri casuali vengono generati comunque, quindi le velocità non dipendono dalla scelta
+    v_sigma  : Deviazioni standard delle componenti della velocità [m/s], se None si usa V_SIGMA (Default: None)
+
+    Ritorna:
+    --------
+    qm_tra : Array dei rapporti carica massa con segno delle particelle [C/Kg]
+    v0     : Array delle velocità iniziali delle particelle [m/s], forma (N_par, 3)
+    """
+
+    v_sigma = V_SIGMA if v_sigma is None else np.asarray(v_sigma, dtype=float)
+
+    if sampling == 'mc':
+
+        # Inizializzazione della carica per ogni particella
+        sign = np.sign(rng.uniform(-1.0, 1.0, N_par))
+
+        # Creazione array per le velocità iniziali casuali delle particelle
+        v0 = np.zeros((N_par, 3))
+        v0[:,0] = rng.normal(0.0, v_sigma[0], N_par)
+        v0[:,1] = rng.normal(0.0, v_sigma[1], N_par)
+        v0[:,2] = rng.normal(0.0, v_sigma[2], N_par)
+
+    elif sampling == 'antithetic':
+
+        # Prima metà campionata normalmente, la seconda sono le gemelle con carica opposta e stessa velocità
+        # Invertire anche la velocità perpendicolare rende le gemelle correlate positivamente per ExB, che non dipende dalla carica
+        n_pair = N_par // 2
+        qm_tra, v0 = initial_conditions(rng, N_par - n_pair, qm, v_sigma=v_sigma)
+        sign = np.concatenate([qm_tra / qm, -qm_tra[:n_pair] / qm])
+        v0 = np.concatenate([v0, v0[:n_pair]])
+        balance = False
+
+    elif sampling in ('lhs', 'sobol'):
+
+        # Punti in [0,1)^4: le prime tre coordinate danno la velocità tramite la gaussiana inversa, la quarta il segno della carica
+        from scipy.stats import norm, qmc
+
+        if sampling == 'lhs':
+            u = qmc.LatinHypercube(d=4, seed=rng).random(N_par)
+        else:
+            u = qmc.Sobol(d=4, scramble=True, seed=rng).random_base2(int(np.ceil(np.log2(max(N_par, 1)))))[:N_par]
+
+        v0 = norm.ppf(u[:, :3]) * v_sigma
+        sign = np.where(u[:, 3] < 0.5, -1.0, 1.0)
+
+        # Con balance la soglia diventa la mediana della quarta coordinata: metà esatta delle cariche, ancora stratificate
+        if balance:
+            sign = np.ones(N_par)
+            sign[np.argsort(u[:, 3])[:N_par // 2]] = -1.0
+            balance = False
+
+    else:
+        raise ValueError(f"campionamento '{sampling}' non valido, scegliere tra {', '.join(SAMPLING)}")
+
+    if balance:
+        sign = rng.permutation(np.resize([1.0, -1.0], N_par))
+
+    if charge is not None:
+        sign = np.full(N_par, np.sign(charge))
+
+    qm_tra = sign * qm
+
+    return qm_tra, v0
+
+
+def drift_theory(params, qm_tra, v0):
+
+    """
+    Funzione che calcola la velocità di drift teorica per ogni particella
+
+    Parametri:
+    ----------
+    params : Dizionario con i parametri della simulazione
+    qm_tra : Array dei rapporti carica massa con segno delle particelle [C/Kg]
+    v0     : Array delle velocità iniziali delle particelle [m/s]
+
+    Ritorna:
+    --------
+    v_drift_th : Array delle velocità di drift teoriche [m/s], forma (N_par, 3)
+    """
+
+    B, E, B_grad = params['B'], params['E'], params['B_grad']
+    B_mod = np.linalg.norm(B)
+    v_drift_th = np.zeros((len(v0), 3))
+
+    # Velocità di drift teorica per ExB
+    if params['flag'] == 'ExB':
+
+        v_drift_th[:] = np.cross(E, B) / B_mod**2
+
+    # Velocità di drift teorica per gradB
+    if params['flag'] == 'gradB':
+
+        v_perp = np.linalg.norm(v0[:,:2], axis=1)
+        v_drift_th[:] = ( v_perp**2 / (2 * qm_tra * B_mod**3))[:, None] * np.cross(B, B_grad)
+
+    return v_drift_th
+
+
+def run_chunk(params, seed_seq, N_par, keep_traj=False, traj_file=None, start=0, checkpoint=None, index=0, every=60.0):
+
+    """
+    Funzione che simula un blocco di particelle con il proprio generatore casuale
+    Genera le condizioni iniziali, integra le traiettorie e ricava centri di guida e velocità di drift
+
+    Parametri:
+    ----------
+    params    : Dizionario con i parametri della simulazione
+    seed_seq  : np.random.SeedSequence del blocco
+    N_par     : Numero di particelle del blocco
+    keep_traj : Se True restituisce anche le traiettorie complete (Default: False)
+    traj_file : Cartella delle traiettorie in cui scrivere le posizioni del blocco durante l'integrazione (Default: None)
+    start     : Indice della prima particella del blocco nella cartella delle traiettorie (Default: 0)
+    checkpoint : Cartella dei checkpoint, se data il blocco salva periodicamente il suo stato e, una volta completato,
+                 i suoi risultati, e riparte da essi se già presenti (Default: None)
+    index      : Indice del blocco nella cartella dei checkpoint (Default: 0)
+    every      : Intervallo tra due salvataggi dello stato del blocco [s] (Default: 60.0)
+
+    Ritorna:
+    --------
+    res : Dizionario con qm, v0, v_drift, v_drift_err, v_drift_th, guide_cn ed eventualmente position
+          Con la misura dei tempi attiva contiene anche timing, i tempi delle fasi del blocco
+    """
+
+    # Blocco già completato prima dell'interruzione
+    state = None
+    if checkpoint is not None:
+        res = ck.load_chunk(checkpoint, index)
+        if res is not None:
+            return res
+        state = ck.load_state(checkpoint, index)
+
+    # Tempi delle fasi misurati nel processo che esegue il blocco, restituiti con i risultati
+    times = {} if params.get('profile') else None
+
+    with pf.stage('initial_conditions', times):
+        rng = np.random.default_rng(seed_seq)
+        qm_tra, v0 = initial_conditions(rng, N_par, params['qm'], params['sampling'], params['balance'], params.get('charge'), params.get('v_sigma'))
+
+    # Calcolo dei centri di guida di tutte le particelle del blocco durante l'integrazione
+    # Le traiettorie complete vengono conservate solo se richiesto, in memoria o direttamente su file
+    n_orb, steps_orb = params['n_orb'], params['steps_orb']
+    out = tj.block_view(traj_file, start, N_par) if traj_file else None
+
+    # Le posizioni già scritte sul file delle traiettorie vengono salvate su disco prima dello stato
+    if checkpoint is not None:
+        def on_checkpoint(st):
+            if out is not None:
+                out.flush()
+            ck.save_state(checkpoint, index, st)
+    else:
+        on_checkpoint = None
+
+    with pf.stage('drift', times):
+        position, guide_cn = dm.drift_ensemble(params['N'], params['dt'], params['B'], params['E'], params['B_grad'], qm_tra, v0, params['n_t'],
+                                               backend=params['backend'], integrator=params['integrator'], rng=rng,
+                                               steps_orb=steps_orb, n_orb=n_orb, keep_traj=keep_traj, out=out,
+                                               state=state, checkpoint=on_checkpoint, every=every, analytic=params.get('analytic', True),
+                                               precision=params.get('precision', 'double'), gc_stride=params.get('gc_stride', 1),
+                                               field_map=fl.load_field_map(params['field_map']) if params.get('field_map') else None)
+        if out is not None:
+            out.flush()
+
+    # Calcolo delle velocità di drift con lo stimatore scelto
+    with pf.stage('v_drift', times):
+        if params['estimator'] == 'lsq':
+            v_drift, v_drift_err = dm.v_drift_fit(guide_cn, params['T_orb'], params['B_hat'], dm.gc_orbits_kept(n_orb, params.get('gc_stride', 1)))
+        else:
+            v_drift = dm.v_drift_ensemble(guide_cn, n_orb, params['T_orb'], params['B_hat'])
+            v_drift_err = np.full((N_par, 3), np.nan)
+        v_drift_th = drift_theory(params, qm_tra, v0)
+
+    res = {
+        'qm'          : qm_tra,
+        'v0'          : v0,
+        'v_drift'     : v_drift,
+        'v_drift_err' : v_drift_err,
+        'v_drift_th'  : v_drift_th,
+        'guide_cn'    : guide_cn,
+    }
+
+    if keep_traj:
+        res['position'] = position
+
+    if checkpoint is not None:
+        ck.save_chunk(checkpoint, index, res)
+
+    if times is not None:
+        res['timing'] = times
+
+    return res
+
+
+def chunk_sizes(N_par, n_min=1):
+
+    """
+    Funzione che suddivide un numero di particelle in blocchi di CHUNK_SIZE, l'ultimo eventualmente più piccolo
+    Se così i blocchi sarebbero meno di n_min, le particelle vengono divise in n_min blocchi di dimensioni quasi uguali,
+    con almeno due particelle per blocco
+
+    Parametri:
+    ----------
+    N_par : Numero di particelle
+    n_min : Numero minimo di blocchi, come in min_blocks() (Default: 1)
+
+    Ritorna:
+    --------
+    sizes : Lista del numero di particelle di ogni blocco
+    """
+
+    n_blocks = min(n_min, N_par // 2)
+    if -(-N_par // CHUNK_SIZE) < n_blocks:
+        return [N_par // n_blocks + (i < N_par % n_blocks) for i in range(n_blocks)]
+
+    sizes = [CHUNK_SIZE] * (N_par // CHUNK_SIZE)
+    if N_par % CHUNK_SIZE:
+        sizes.append(N_par % CHUNK_SIZE)
+
+    return sizes
+
+
+def min_blocks(params):
+
+    """
+    Funzione che restituisce il numero minimo di blocchi indipendenti in cui suddividere l'ensemble
+    Con i campionamenti a varianza ridotta le particelle non sono indipendenti e l'errore richiede più blocchi
+
+    Parametri:
+    ----------
+    params : Dizionario con i parametri della simulazione
+
+    Ritorna:
+    --------
+    n_min : MIN_BLOCKS con i campionamenti a varianza ridotta o con le cariche bilanciate, 1 con il Monte Carlo semplice
+    """
+
+    if params['sampling'] == 'mc' and not params['balance']:
+        return 1
+
+    return MIN_BLOCKS
+
+
+def error_blocks(params, N_par):
+
+    """
+    Funzione che restituisce i blocchi indipendenti da usare per l'errore della velocità di drift media
+    Con il Monte Carlo semplice le particelle sono indipendenti e non servono blocchi, con i campionamenti a varianza
+    ridotta i blocchi sono quelli di chunk_sizes(), almeno MIN_BLOCKS, campionati ognuno con il proprio generatore
+
+    Parametri:
+    ----------
+    params : Dizionario con i parametri della simulazione
+    N_par  : Numero di particelle
+
+    Ritorna:
+    --------
+    blocks : Lista del numero di particelle dei blocchi, None con il Monte Carlo semplice
+    """
+
+    if min_blocks(params) == 1:
+        return None
+
+    return chunk_sizes(N_par, min_blocks(params))
+
+
+def split_chunks(N_par, seed=None, n_min=1):
+
+    """
+    Funzione che suddivide le particelle in blocchi di CHUNK_SIZE e assegna a ognuno un SeedSequence indipendente
+
+    Parametri:
+    ----------
+    N_par : Numero di particelle
+    seed  : Seme della simulazione, intero o np.random.SeedSequence, se None viene generato casualmente (Default: None)
+    n_min : Numero minimo di blocchi, come in chunk_sizes() (Default: 1)
+
+    Ritorna:
+    --------
+    sizes : Lista del numero di particelle di ogni blocco
+    seeds : Lista dei SeedSequence dei blocchi
+    ss    : SeedSequence della simulazione
+    """
+
+    ss = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    sizes = chunk_sizes(N_par, n_min)
+    seeds = ss.spawn(len(sizes))
+
+    return sizes, seeds, ss
+
+
+def merge_chunks(chunks):
+
+    """
+    Funzione che unisce i risultati dei blocchi nell'ordine originale
+    I tempi delle fasi dei blocchi vengono tolti dai risultati e sommati a quelli del processo principale,
+    quindi unire più volte gli stessi blocchi, come in run_converged(), non li conta due volte
+
+    Parametri:
+    ----------
+    chunks : Lista dei dizionari restituiti da run_chunk()
+
+    Ritorna:
+    --------
+    res : Dizionario con gli array di tutte le particelle
+    """
+
+    for c in chunks:
+        if 'timing' in c:
+            pf.add(c.pop('timing'))
+
+    res = {key: np.concatenate([c[key] for c in chunks]) for key in chunks[0]}
+
+    return res
+
+
+def run_ensemble(params, N_par, seed=None, workers=1, keep_traj=False, progress=False, pool=None, traj_file=None, checkpoint=None, every=60.0):
+
+    """
+    Funzione che simula l'intero ensemble suddividendolo in blocchi di CHUNK_SIZE particelle
+    Ogni blocco riceve un generatore derivato con SeedSequence.spawn dal seme della simulazione,
+    quindi il risultato è identico bit per bit per qualsiasi numero di processi
+
+    Parametri:
+    ----------
+    params    : Dizionario con i parametri della simulazione
+    N_par     : Numero di particelle
+    seed      : Seme della simulazione, intero o np.random.SeedSequence, se None viene generato casualmente (Default: None)
+    workers   : Numero di processi in parallelo (Default: 1)
+    keep_traj : Se True restituisce anche le traiettorie complete (Default: False)
+    progress  : Se True mostra la barra di avanzamento sui blocchi (Default: False)
+    pool      : ProcessPoolExecutor già avviato da riutilizzare, se dato workers viene ignorato (Default: None)
+    traj_file : Cartella delle traiettorie, già creata con trajectories.create_store(), in cui i blocchi scrivono le posizioni (Default: None)
+    checkpoint : Cartella dei checkpoint, già creata con checkpoint.create_checkpoint(), con lo stesso seme la simulazione
+                 riprende dai blocchi completati e dallo stato salvato di quelli interrotti (Default: None)
+    every      : Intervallo tra due salvataggi dello stato di ogni blocco [s] (Default: 60.0)
+
+    Ritorna:
+    --------
+    res  : Dizionario con gli array di tutte le particelle, concatenati nell'ordine dei blocchi
+    seed : Entropia del SeedSequence usato, permette di riprodurre la simulazione
+    """
+
+    if progress:
+        from tqdm import tqdm
+
+    sizes, seeds, ss = split_chunks(N_par, seed, min_blocks(params))
+    n_chunks = len(sizes)
+    starts = np.cumsum([0] + sizes[:-1]).tolist()
+    tasks = ([params] * n_chunks, seeds, sizes, [keep_traj] * n_chunks, [traj_file] * n_chunks, starts,
+             [checkpoint] * n_chunks, range(n_chunks), [every] * n_chunks)
+
+    if pool is not None:
+
+        chunks = pool.map(run_chunk, *tasks)
+        chunks = list(tqdm(chunks, total=n_chunks) if progress else chunks)
+
+    elif workers > 1 and n_chunks > 1:
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = pool.map(run_chunk, *tasks)
+            chunks = list(tqdm(chunks, total=n_chunks) if progress else chunks)
+
+    else:
+
+        chunks = map(run_chunk, *tasks)
+        chunks = list(tqdm(chunks, total=n_chunks) if progress else chunks)
+
+    return merge_chunks(chunks), ss.entropy
+
+
+def run_converged(params, batch, max_par, rtol=None, atol=None, seed=None, workers=1, progress=False):
+
+    """
+    Funzione che simula l'ensemble a lotti di particelle finché l'errore sulla velocità di drift media,
+    calcolato come in analysis.vd_fit(), non scende sotto la tolleranza o finché non si raggiunge max_par
+    I blocchi ricevono i SeedSequence nello stesso ordine di run_ensemble(), quindi con lo stesso seme
+    le prime particelle sono identiche a quelle di una simulazione a numero fisso
+
+    Parametri:
+    ----------
+    params   : Dizionario con i parametri della simulazione
+    batch    : Numero di particelle per lotto, arrotondato a un multiplo di CHUNK_SIZE e, con i campionamenti a varianza
+               ridotta, almeno MIN_BLOCKS blocchi, così l'errore si ricava già dal primo lotto
+    max_par  : Numero massimo di particelle
+    rtol     : Tolleranza relativa sull'errore della velocità di drift media (Default: None)
+    atol     : Tolleranza assoluta sull'errore della velocità di drift media [m/s] (Default: None)
+    seed     : Seme della simulazione, intero o np.random.SeedSequence, se None viene generato casualmente (Default: None)
+    workers  : Numero di processi in parallelo (Default: 1)
+    progress : Se True stampa l'errore raggiunto dopo ogni lotto (Default: False)
+
+    Ritorna:
+    --------
+    res       : Dizionario con gli array delle particelle usate
+    seed      : Entropia del SeedSequence usato, permette di riprodurre la simulazione
+    converged : True se la tolleranza è stata raggiunta prima di max_par
+    """
+
+    ss = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    batch = max(CHUNK_SIZE * min_blocks(params), -(-batch // CHUNK_SIZE) * CHUNK_SIZE)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    chunks = []
+    N_used = 0
+    converged = False
+
+    try:
+        while N_used < max_par and not converged:
+
+            # Lotto successivo, i semi dei blocchi proseguono la sequenza di quelli già usati
+            sizes = chunk_sizes(min(batch, max_par - N_used), min_blocks(params) if N_used == 0 else 1)
+            seeds = ss.spawn(len(sizes))
+            tasks = ([params] * len(sizes), seeds, sizes)
+            chunks += list(pool.map(run_chunk, *tasks) if pool is not None else map(run_chunk, *tasks))
+            N_used += sum(sizes)
+
+            # Errore della velocità di drift media con tutte le particelle simulate finora
+            res = merge_chunks(chunks)
+            stats = an.vd_stats(res['v_drift'], res['v_drift_th'], error_blocks(params, N_used))
+            vd_mean, vd_err = stats['vd_mean'], stats['vd_err_final']
+            converged = (atol is not None and vd_err <= atol) or (rtol is not None and vd_err <= rtol * vd_mean)
+
+            if progress:
+                print(f"Particelle: {N_used:>7}   v_drift = {vd_mean:.2f} ± {vd_err:.2f} [m/s]")
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return res, ss.entropy, converged
+
+
+def check_precision(qm, ref, N_par=512, seed=0, workers=1, integrator='boris', rtol=PRECISION_RTOL):
+
+    """
+    Funzione che controlla l'accuratezza della singola precisione su una configurazione di riferimento
+    Simula le stesse particelle, con lo stesso seme, in doppia e in singola precisione e confronta la velocità
+    di drift di ogni particella: le due simulazioni differiscono solo per gli arrotondamenti, quindi la differenza
+    massima, relativa alla velocità di drift teorica media per particella, deve essere molto piccola
+
+    Parametri:
+    ----------
+    qm         : Rapporto carica massa per particella positiva [C/Kg]
+    ref        : Dizionario della configurazione, con le voci di PRECISION_REFS
+    N_par      : Numero di particelle (Default: 512)
+    seed       : Seme delle due simulazioni (Default: 0)
+    workers    : Numero di processi in parallelo (Default: 1)
+    integrator : Integratore da controllare, 'boris' o 'exact' (Default: 'boris')
+    rtol       : Differenza massima ammessa tra le velocità di drift di una particella, relativa alla teorica (Default: PRECISION_RTOL)
+
+    Ritorna:
+    --------
+    check : Dizionario con vd_double, vd_single, vd_err (errore statistico in doppia precisione), vd_th (modulo medio
+            della velocità di drift teorica per particella), max_diff (differenza massima per particella), rel_diff e passed
+    """
+
+    res, vd = {}, {}
+    for precision in ['double', 'single']:
+        params = build_params(ref['flag'], ref['Bz'], ref['E'], ref['B_grad'], ref['N'], ref['dt'], ref['n_t'], qm,
+                              integrator=integrator, precision=precision)
+        res[precision], _ = run_ensemble(params, N_par, seed=seed, workers=workers)
+        vd[precision] = an.vd_stats(res[precision]['v_drift'], res[precision]['v_drift_th'])
+
+    # Stesse particelle nelle due simulazioni: differenza della velocità di drift di ognuna
+    max_diff = np.max(np.linalg.norm(res['single']['v_drift'] - res['double']['v_drift'], axis=1))
+    vd_th = np.mean(np.linalg.norm(res['double']['v_drift_th'], axis=1))
+    rel_diff = max_diff / vd_th
+
+    check = {
+        'vd_double' : vd['double']['vd_mean'],
+        'vd_single' : vd['single']['vd_mean'],
+        'vd_err'    : vd['double']['vd_err_final'],
+        'vd_th'     : vd_th,
+        'max_diff'  : max_diff,
+        'rel_diff'  : rel_diff,
+        'passed'    : bool(rel_diff <= rtol),
+    }
+
+    return check
@@ -0,0 +1,197 @@
+import numpy as np
+
+# Mappe di campo già lette in questo processo, indicizzate con il percorso del file
+_cache = {}
+
+# Vertici della cella della griglia, nell'ordine (x, y, z) con z più veloce
+CORNERS = np.array([[cx, cy, cz] for cx in (0, 1) for cy in (0, 1) for cz in (0, 1)])
+
+
+def make_field_map(x, y, z, E, B):
+
+    """
+    Funzione che crea una mappa di campo da E e B campionati su una griglia regolare
+    I due campi vengono salvati in un unico array contiguo, con una riga di 6 valori per ogni nodo, così ogni vertice
+    della cella viene letto una sola volta per entrambi i campi
+
+    Parametri:
+    ----------
+    x, y, z : Coordinate dei nodi della griglia lungo ogni asse [m], crescenti ed equispaziate, anche di un solo nodo
+    E       : Campo elettrico sui nodi [V/m], forma (nx, ny, nz, 3)
+    B       : Campo magnetico sui nodi [T], forma (nx, ny, nz, 3)
+
+    Ritorna:
+    --------
+    fmap : Dizionario con origin, spacing, upper e last (ultimo nodo e ultimo vertice inferiore di una cella lungo ogni asse),
+           strides e offsets (indici dei nodi e dei vertici della cella nell'array appiattito) e l'array F dei campi,
+           di forma (nx*ny*nz, 6)
+
+    Solleva ValueError se la griglia non è regolare o le forme dei campi non corrispondono
+    """
+
+    axes = [np.asarray(a, dtype=float).ravel() for a in (x, y, z)]
+    shape = tuple(len(a) for a in axes)
+
+    spacing = np.ones(3)
+    for i, a in enumerate(axes):
+        if len(a) > 1:
+            d = np.diff(a)
+            if np.any(d <= 0) or not np.allclose(d, d[0], rtol=1e-9):
+                raise ValueError(f"i nodi dell'asse {'xyz'[i]} devono essere crescenti ed equispaziati")
+            spacing[i] = d[0]
+
+    E = np.asarray(E, dtype=float)
+    B = np.asarray(B, dtype=float)
+    if E.shape != shape + (3,) or B.shape != shape + (3,):
+        raise ValueError(f"i campi devono avere forma {shape + (3,)}, trovate {E.shape} e {B.shape}")
+
+    # Spostamento nell'array appiattito tra nodi vicini, per i vertici è nullo lungo gli assi con un solo nodo
+    nx, ny, nz = shape
+    strides = np.array([ny * nz, nz, 1])
+
+    fmap = {
+        'origin'  : np.array([a[0] for a in axes]),
+        'spacing' : spacing,
+        'shape'   : np.array(shape),
+        'upper'   : np.array(shape) - 1,
+        'last'    : np.maximum(np.array(shape) - 2, 0),
+        'strides' : strides,
+        'offsets' : CORNERS @ (strides * (np.array(shape) > 1)),
+        'F'       : np.ascontiguousarray(np.concatenate([E, B], axis=-1).reshape(-1, 6)),
+    }
+
+    return fmap
+
+
+def sample_field_map(x, y, z, fields):
+
+    """
+    Funzione che crea una mappa di campo valutando una sola volta su tutti i nodi una funzione vettorizzata dei campi
+
+    Parametri:
+    ----------
+    x, y, z : Coordinate dei nodi della griglia lungo ogni asse [m]
+    fields  : Funzione che riceve gli array X, Y, Z dei nodi e restituisce E e B, ognuno di forma X.shape + (3,)
+
+    Ritorna:
+    --------
+    fmap : Mappa di campo come in make_field_map()
+    """
+
+    X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
+    E, B = fields(X, Y, Z)
+
+    return make_field_map(x, y, z, E, B)
+
+
+def save_field_map(file_map, x, y, z, E, B):
+
+    """
+    Funzione che salva una mappa di campo in un file .npz con le voci x, y, z, E e B
+
+    Parametri:
+    ----------
+    file_map : Percorso del file
+    x, y, z, E, B : Griglia e campi come in make_field_map()
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    make_field_map(x, y, z, E, B)
+    np.savez(file_map, x=x, y=y, z=z, E=E, B=B)
+
+    return
+
+
+def load_field_map(file_map):
+
+    """
+    Funzione che legge una mappa di campo da un file .npz con le voci x, y, z, E e B
+    La mappa viene letta una sola volta per processo e poi riutilizzata, quindi i blocchi di particelle
+    ricevono solo il percorso del file e non una copia dei campi
+
+    Parametri:
+    ----------
+    file_map : Percorso del file
+
+    Ritorna:
+    --------
+    fmap : Mappa di campo come in make_field_map()
+    """
+
+    if file_map not in _cache:
+        with np.load(file_map) as data:
+            _cache[file_map] = make_field_map(data['x'], data['y'], data['z'], data['E'], data['B'])
+
+    return _cache[file_map]
+
+
+def interpolate(fmap, r):
+
+    """
+    Funzione che calcola E e B nelle posizioni di tutte le particelle con l'interpolazione trilineare
+    Gli 8 vertici delle celle di tutte le particelle vengono letti con una sola indicizzazione
+    Fuori dalla griglia si usa il valore sul bordo più vicino
+
+    Parametri:
+    ----------
+    fmap : Mappa di campo come in make_field_map()
+    r    : Array delle posizioni [m], forma (N_par, 3)
+
+    Ritorna:
+    --------
+    E_loc : Array del campo elettrico locale [V/m], forma (N_par, 3)
+    B_loc : Array del campo magnetico locale [T], forma (N_par, 3)
+    """
+
+    # Coordinate della posizione in unità di celle, limitate alla griglia (np.minimum e np.maximum sono più veloci di np.clip)
+    u = np.minimum(np.maximum((r - fmap['origin']) / fmap['spacing'], 0), fmap['upper'])
+
+    # Vertice inferiore della cella, l'ultimo nodo appartiene alla cella precedente
+    i0 = np.minimum(u.astype(np.intp), fmap['last'])
+    f = u - i0
+    g = 1 - f
+    base = i0 @ fmap['strides']
+
+    # Pesi degli 8 vertici nell'ordine di CORNERS, prodotto dei pesi lineari lungo ogni asse
+    w_xy = np.stack([g[:,0] * g[:,1], g[:,0] * f[:,1], f[:,0] * g[:,1], f[:,0] * f[:,1]], axis=1)
+    w = (w_xy[:, :, None] * np.stack([g[:,2], f[:,2]], axis=1)[:, None, :]).reshape(-1, 1, 8)
+
+    # Lettura dei vertici di tutte le particelle e somma pesata, forma (N_par, 6)
+    F = np.take(fmap['F'], base[:, None] + fmap['offsets'], axis=0)
+    EB = np.matmul(w, F)[:, 0]
+
+    return EB[:, :3], EB[:, 3:]
+
+
+def reference_fields(fmap):
+
+    """
+    Funzione che ricava i campi di riferimento nell'origine, usati per il periodo di ciclotrone, i passi per orbita
+    e la velocità di drift teorica
+    Il gradiente del modulo di B è calcolato con le differenze centrate su un passo della griglia
+
+    Parametri:
+    ----------
+    fmap : Mappa di campo come in make_field_map()
+
+    Ritorna:
+    --------
+    E      : Campo elettrico nell'origine [V/m]
+    B      : Campo magnetico nell'origine [T]
+    B_grad : Gradiente del modulo del campo magnetico nell'origine [T/m]
+    """
+
+    E, B = (val[0] for val in interpolate(fmap, np.zeros((1, 3))))
+
+    B_grad = np.zeros(3)
+    for i in range(3):
+        if fmap['shape'][i] > 1:
+            h = np.zeros((1, 3))
+            h[0, i] = fmap['spacing'][i]
+            B_plus, B_minus = interpolate(fmap, h)[1], interpolate(fmap, -h)[1]
+            B_grad[i] = (np.linalg.norm(B_plus) - np.linalg.norm(B_minus)) / (2 * h[0, i])
+
+    return E, B, B_grad
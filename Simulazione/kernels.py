@@ -0,0 +1,256 @@
+import numpy as np
+
+# Numba è opzionale: se non è installato si usa il backend NumPy
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+
+        """
+        Decoratore sostitutivo usato quando Numba non è installato, restituisce la funzione invariata
+        """
+
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+
+        return lambda func: func
+
+
+@njit(cache=True)
+def accumulate_gc(r_gc, gc_sum, p, j, x, y, z, steps_orb, gc_slot):
+
+    """
+    Aggiunge la posizione j della particella p alla somma dell'orbita corrente
+    Quando l'orbita è completa salva la posizione media nel centro di guida, se l'orbita è tra quelle conservate, e azzera la somma
+
+    Parametri:
+    ----------
+    r_gc      : Array dei centri di guida conservati, forma (N_par, len(drift_motions.gc_orbits_kept()), 3) [m]
+    gc_sum    : Array di lavoro con la somma delle posizioni dell'orbita, forma (3,) [m]
+    p         : Indice della particella
+    j         : Indice del passo della posizione
+    x, y, z   : Componenti della posizione [m]
+    steps_orb : Numero di passi per orbita
+    gc_slot   : Array con l'indice in r_gc del centro di guida di ogni orbita, -1 per quelle non conservate, forma (n_orb,)
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    gc_sum[0] += x
+    gc_sum[1] += y
+    gc_sum[2] += z
+
+    o = (j + 1) // steps_orb
+    if (j + 1) % steps_orb == 0 and o <= gc_slot.shape[0]:
+        k = gc_slot[o-1]
+        if k >= 0:
+            r_gc[p, k, 0] = gc_sum[0] / steps_orb
+            r_gc[p, k, 1] = gc_sum[1] / steps_orb
+            r_gc[p, k, 2] = gc_sum[2] / steps_orb
+        gc_sum[:] = 0.0
+
+    return
+
+
+@njit(cache=True)
+def boris_ensemble(r, r_gc, r_n, v, gc_sum, n0, n1, N, dt, B, E, B_grad, qm, ev_ptr, ev_step, ev_dir, steps_orb, gc_slot, keep_traj):
+
+    """
+    Kernel compilato del metodo di Boris per tutte le particelle dell'ensemble
+    Esegue gli stessi passi di drift_motions.drift() con il ciclo temporale compilato, sui soli passi [n0, n1)
+    Gli eventi di scattering della finestra sono generati prima da drift_motions.turbulence_window(), quindi il kernel non usa
+    numeri casuali; posizioni, velocità e somme dei centri di guida restano negli array tra una finestra e la successiva
+
+    Parametri:
+    ----------
+    r         : Array delle posizioni, forma (N_par, N, 3) [m], usato solo se keep_traj è True
+    r_gc      : Array dei centri di guida conservati, forma (N_par, len(drift_motions.gc_orbits_kept()), 3) [m]
+    r_n       : Array delle posizioni al passo n0, forma (N_par, 3) [m], aggiornato al passo n1
+    v         : Array delle velocità al passo n0, forma (N_par, 3) [m/s], aggiornato al passo n1
+    gc_sum    : Array delle somme delle posizioni dell'orbita corrente, forma (N_par, 3) [m], aggiornato sul posto
+    n0, n1    : Primo passo della finestra e primo passo successivo, con n1 = N - 1 viene aggiunta anche l'ultima posizione
+    N         : Numero di passi della simulazione
+    dt        : Intervallo di tempo tra i passi [s]
+    B         : Campo magnetico di riferimento [T]
+    E         : Campo elettrico di riferimento [V/m]
+    B_grad    : Gradiente del campo magnetico [T/m]
+    qm        : Array dei rapporti carica massa, forma (N_par,) [C/Kg]
+    ev_ptr    : Indici degli eventi di scattering di ogni particella, quelli della particella p sono ev_ptr[p]:ev_ptr[p+1]
+    ev_step   : Array dei passi degli eventi, ordinati per particella e per passo
+    ev_dir    : Array delle nuove direzioni degli eventi, forma (M, 3)
+    steps_orb : Numero di passi per orbita, se 0 i centri di guida non vengono calcolati
+    gc_slot   : Array con l'indice in r_gc del centro di guida di ogni orbita, come in accumulate_gc()
+    keep_traj : Se True salva le traiettorie complete in r
+
+    Ritorna:
+    --------
+    Nessuno, gli array r, r_gc, r_n, v e gc_sum vengono aggiornati sul posto
+    """
+
+    N_par = v.shape[0]
+
+    # Con campo uniforme i vettori di rotazione sono calcolati una sola volta per particella
+    uniform = B_grad[0] == 0.0 and B_grad[1] == 0.0
+
+    for p in range(N_par):
+
+        x, y, z = r_n[p, 0], r_n[p, 1], r_n[p, 2]
+        vx, vy, vz = v[p, 0], v[p, 1], v[p, 2]
+        gs = gc_sum[p]
+
+        # Primo evento di scattering della particella nella finestra
+        k = ev_ptr[p]
+        n_ev = ev_step[k] if k < ev_ptr[p+1] else N
+
+        # Accelerazione elettrica su mezzo passo
+        ax = qm[p] * E[0] * dt / 2
+        ay = qm[p] * E[1] * dt / 2
+        az = qm[p] * E[2] * dt / 2
+
+        t = qm[p] * B[2] * dt / 2.0
+        s = 2 * t / (1 + t**2)
+
+        for n in range(n0, n1):
+
+            if steps_orb > 0:
+                accumulate_gc(r_gc, gs, p, n, x, y, z, steps_orb, gc_slot)
+
+            # Campo magnetico locale e vettori di rotazione lungo z
+            if not uniform:
+                B_loc = B[2] + B_grad[0] * x + B_grad[1] * y
+                t = qm[p] * B_loc * dt / 2.0
+                s = 2 * t / (1 + t**2)
+
+            # v_minus, v_prime e v_plus
+            vmx, vmy, vmz = vx + ax, vy + ay, vz + az
+            vpx = vmx + vmy * t
+            vpy = vmy - vmx * t
+            vx = vmx + vpy * s + ax
+            vy = vmy - vpx * s + ay
+            vz = vmz + az
+
+            # Turbolenza
+            if n == n_ev:
+                v_mod = np.sqrt(vx**2 + vy**2 + vz**2)
+                vx, vy, vz = v_mod * ev_dir[k, 0], v_mod * ev_dir[k, 1], v_mod * ev_dir[k, 2]
+                k += 1
+                n_ev = ev_step[k] if k < ev_ptr[p+1] else N
+
+            # Aggiornamento posizione
+            x = x + vx * dt
+            y = y + vy * dt
+            z = z + vz * dt
+
+            if keep_traj:
+                r[p, n+1, 0] = x
+                r[p, n+1, 1] = y
+                r[p, n+1, 2] = z
+
+        # Ultima posizione della simulazione
+        if n1 == N-1 and steps_orb > 0:
+            accumulate_gc(r_gc, gs, p, N-1, x, y, z, steps_orb, gc_slot)
+
+        r_n[p, 0], r_n[p, 1], r_n[p, 2] = x, y, z
+        v[p, 0], v[p, 1], v[p, 2] = vx, vy, vz
+
+    return
+
+
+@njit(cache=True)
+def exact_ensemble(r, r_gc, r_n, v, gc_sum, n0, n1, N, dt, B, E, B_grad, qm, ev_ptr, ev_step, ev_dir, steps_orb, gc_slot, keep_traj):
+
+    """
+    Kernel compilato dell'integratore a girazione esatta per tutte le particelle dell'ensemble
+    Esegue gli stessi passi di drift_motions.exact_step() con il ciclo temporale compilato
+
+    Parametri:
+    ----------
+    Gli stessi di boris_ensemble()
+
+    Ritorna:
+    --------
+    Nessuno, gli array r, r_gc, r_n, v e gc_sum vengono aggiornati sul posto
+    """
+
+    N_par = v.shape[0]
+
+    # Con campo uniforme i coefficienti della rotazione sono calcolati una sola volta per particella
+    uniform = B_grad[0] == 0.0 and B_grad[1] == 0.0
+
+    for p in range(N_par):
+
+        x, y, z = r_n[p, 0], r_n[p, 1], r_n[p, 2]
+        vx, vy, vz = v[p, 0], v[p, 1], v[p, 2]
+        gs = gc_sum[p]
+
+        # Primo evento di scattering della particella nella finestra
+        k = ev_ptr[p]
+        n_ev = ev_step[k] if k < ev_ptr[p+1] else N
+
+        B_loc = B[2]
+        om = qm[p] * B_loc
+        c = np.cos(om * dt)
+        s = np.sin(om * dt)
+        vEx = E[1] / B_loc
+        vEy = -E[0] / B_loc
+        A = s / om
+        C = (1 - c) / om
+
+        for n in range(n0, n1):
+
+            if steps_orb > 0:
+                accumulate_gc(r_gc, gs, p, n, x, y, z, steps_orb, gc_slot)
+
+            # Campo magnetico locale stimato a metà passo e rotazione esatta attorno alla velocità E×B/B²
+            if not uniform:
+                B_loc = B[2] + B_grad[0] * (x + vx * dt / 2) + B_grad[1] * (y + vy * dt / 2)
+                om = qm[p] * B_loc
+                c = np.cos(om * dt)
+                s = np.sin(om * dt)
+                vEx = E[1] / B_loc
+                vEy = -E[0] / B_loc
+                A = s / om
+                C = (1 - c) / om
+
+            ux = vx - vEx
+            uy = vy - vEy
+
+            dx = vEx * dt + ux * A + uy * C
+            dy = vEy * dt + uy * A - ux * C
+            dz = vz * dt + qm[p] * E[2] * dt**2 / 2
+
+            vx = vEx + ux * c + uy * s
+            vy = vEy + uy * c - ux * s
+            vz = vz + qm[p] * E[2] * dt
+
+            # Turbolenza
+            if n == n_ev:
+                v_mod = np.sqrt(vx**2 + vy**2 + vz**2)
+                vx, vy, vz = v_mod * ev_dir[k, 0], v_mod * ev_dir[k, 1], v_mod * ev_dir[k, 2]
+                k += 1
+                n_ev = ev_step[k] if k < ev_ptr[p+1] else N
+
+            # Aggiornamento posizione
+            x = x + dx
+            y = y + dy
+            z = z + dz
+
+            if keep_traj:
+                r[p, n+1, 0] = x
+                r[p, n+1, 1] = y
+                r[p, n+1, 2] = z
+
+        # Ultima posizione della simulazione
+        if n1 == N-1 and steps_orb > 0:
+            accumulate_gc(r_gc, gs, p, N-1, x, y, z, steps_orb, gc_slot)
+
+        r_n[p, 0], r_n[p, 1], r_n[p, 2] = x, y, z
+        v[p, 0], v[p, 1], v[p, 2] = vx, vy, vz
+
+    return
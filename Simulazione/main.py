@@ -1,12 +1,18 @@
 import sys, os
-import pandas as pd
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 import argparse
-from tqdm import tqdm  
-import drift_motions as dm
 import analysis as an
+import ensemble as en
+import sweep as sw
+import trajectories as tj
+import results_store as rs
+import species as sp
 import plots as pt
+import profiling as pf
+import checkpoint as ck
+import cache as ca
+import fields as fl
 
 
 def parser_arguments():
@@ -22,17 +28,74 @@ def parser_arguments():
     parser.add_argument('-E', '--drE', action='store_true', help='Esegue simulazione per drift ExB')
     parser.add_argument('-G', '--drG', action='store_true', help='Esegue simulazione per drift ∇ B')
     parser.add_argument('-T', '--tra', action='store_true', help='Esegue la simulazione per 5 particelle e ne mostra la traiettoria')
-    parser.add_argument('-d', '--data', action='store_true', help='Esegui l\'analisi dei dati nel file drift_data.csv (consultare README)')
-    parser.add_argument('-s', '--save', action='store_true',  help='Se scelto salva i dati della simulazione corrente nel file: drift_data.csv')
-    parser.add_argument('-c', '--clean', action='store_true', help='Cancella il file drift_data.csv (consultare README)')
+    parser.add_argument('-d', '--data', action='store_true', help='Esegui l\'analisi dei dati nel database drift_data.db (consultare README)')
+    parser.add_argument('--fits', action='store_true', help='Stampa il fit lineare di tutti i gruppi di Flag, Bz, passi e specie del database, senza leggerne le righe')
+    parser.add_argument('-s', '--save', action='store_true',  help='Se scelto salva i dati della simulazione corrente nel database: drift_data.db')
+    parser.add_argument('-c', '--clean', action='store_true', help='Cancella il database drift_data.db (consultare README)')
+    parser.add_argument('-i', '--integrator', choices=['boris', 'exact'], default='boris', help='Integratore: metodo di Boris o girazione esatta (Default: boris)')
+    parser.add_argument('--dt', type=float, action='store', default=1e-6, help='Inserisci l\'intervallo di tempo tra i passi [s] (Default: 1e-6)')
+    parser.add_argument('--steps-orb', type=int, action='store', default=None, help='Passi per orbita nel punto di campo più intenso, se dato dt viene scelto automaticamente')
+    parser.add_argument('-e', '--estimator', choices=['endpoint', 'lsq'], default='endpoint', help='Stimatore della velocità di drift: estremi del centro di guida o fit ai minimi quadrati (Default: endpoint)')
+    parser.add_argument('-w', '--workers', type=int, action='store', default=1, help='Inserisci il numero di processi in parallelo (Default: 1)')
+    parser.add_argument('--seed', type=int, action='store', default=None, help='Seme per i generatori casuali, rende la simulazione riproducibile (Default: casuale)')
+    parser.add_argument('--sweep', type=str, action='store', default=None, help='Esegue la scansione delle configurazioni lette da un file .csv o .json e salva i risultati (consultare README)')
+    parser.add_argument('--grid', type=str, action='append', default=None, help='Intervallo di un parametro per la scansione, ad esempio Ex=10:50:5 (ripetibile, consultare README)')
+    parser.add_argument('--traj-out', type=str, action='store', default=None, help='Cartella in cui scrivere le traiettorie durante la simulazione, mappate in memoria (consultare README)')
+    parser.add_argument('--traj-in', type=str, action='store', default=None, help='Cartella delle traiettorie di una simulazione precedente da rianalizzare senza simulare (consultare README)')
+    parser.add_argument('--import-csv', type=str, action='store', default=None, help='Importa nel database le righe di un file .csv con lo schema di drift_data.csv')
+    parser.add_argument('--export-csv', type=str, action='store', default=None, help='Esporta il database in un file .csv con lo schema di drift_data.csv')
+    parser.add_argument('--sampling', choices=['mc', 'antithetic', 'lhs', 'sobol'], default='mc', help='Campionamento delle condizioni iniziali: Monte Carlo, coppie antitetiche, ipercubo latino o Sobol (Default: mc)')
+    parser.add_argument('--balance-charge', action='store_true', help='Simula esattamente metà particelle con carica positiva e metà con carica negativa')
+    parser.add_argument('--rtol', type=float, action='store', default=None, help='Tolleranza relativa sull\'errore della velocità di drift media, simula a lotti finché non è raggiunta')
+    parser.add_argument('--atol', type=float, action='store', default=None, help='Tolleranza assoluta sull\'errore della velocità di drift media [m/s], simula a lotti finché non è raggiunta')
+    parser.add_argument('--max-par', type=int, action='store', default=20000, help='Numero massimo di particelle con --rtol o --atol (Default: 20000)')
+    parser.add_argument('--batch', type=int, action='store', default=256, help='Particelle per lotto con --rtol o --atol (Default: 256)')
+    parser.add_argument('-o', '--out', type=str, action='store', default=None, help='Cartella in cui salvare i grafici come file .png invece di mostrarli, non richiede uno schermo')
+    parser.add_argument('--plot-points', type=int, action='store', default=2000, help='Numero massimo di punti disegnati per ogni traiettoria (Default: 2000)')
+    parser.add_argument('--decimate', choices=['lttb', 'stride'], default='lttb', help='Metodo di riduzione dei punti delle traiettorie (Default: lttb)')
+    parser.add_argument('--field-map', type=str, action='store', default=None, help='File .npz con E e B su una griglia 3D, interpolati nella posizione delle particelle (consultare README)')
+    parser.add_argument('--serve', type=str, action='store', default=None, help='Esegue la scansione come coordinatore in ascolto su HOST:PORTA, i blocchi vengono eseguiti dai worker (consultare README)')
+    parser.add_argument('--worker', type=str, action='store', default=None, help='Esegue i blocchi assegnati dal coordinatore in ascolto su HOST:PORTA, con --workers processi')
+    parser.add_argument('--authkey', type=str, action='store', default=None, help='Chiave condivisa tra coordinatore e worker (Default: variabile d\'ambiente DRIFT_AUTHKEY)')
+    parser.add_argument('--lease', type=float, action='store', default=600.0, help='Tempo massimo per un blocco prima di riassegnarlo a un altro worker [s] (Default: 600)')
+    parser.add_argument('--retries', type=int, action='store', default=3, help='Numero massimo di riassegnazioni di un blocco (Default: 3)')
+    parser.add_argument('--species', type=str, action='append', default=None, help='Specie da simulare nella forma NOME[:N_PAR[:V_SCALA]], può essere ripetuto (specie: ' + ', '.join(sp.SPECIES) + ', consultare README)')
+    parser.add_argument('--precision', choices=['double', 'single'], default='double', help='Precisione di velocità e coefficienti dell\'integratore, le posizioni restano in doppia precisione (Default: double)')
+    parser.add_argument('--check-precision', action='store_true', help='Confronta la velocità di drift media in singola e doppia precisione sulla configurazione di riferimento')
+    parser.add_argument('--no-analytic', action='store_true', help='Integra il moto anche con campi uniformi e senza scattering, invece di usare la soluzione in forma chiusa')
+    parser.add_argument('--cache', type=str, action='store', default=None, help='Cartella della cache dei risultati, le simulazioni già eseguite con lo stesso seme non vengono ripetute (consultare README)')
+    parser.add_argument('--cache-size', type=float, action='store', default=1024, help='Dimensione massima della cache dei risultati [MB] (Default: 1024)')
+    parser.add_argument('--checkpoint', type=str, action='store', default=None, help='Cartella in cui salvare periodicamente lo stato della simulazione (consultare README)')
+    parser.add_argument('--checkpoint-every', type=float, action='store', default=60.0, help='Intervallo tra due salvataggi dello stato [s] (Default: 60)')
+    parser.add_argument('--resume', type=str, action='store', default=None, help='Riprende la simulazione interrotta salvata nella cartella dei checkpoint')
+    parser.add_argument('--profile', action='store_true', help='Misura e stampa i tempi di ogni fase della simulazione (consultare README)')
+    parser.add_argument('--profile-json', type=str, action='store', default=None, help='File .json in cui salvare i tempi delle fasi insieme alla riga dei risultati')
+    parser.add_argument('--profile-out', type=str, action='store', default=None, help='File in cui salvare il profilo di cProfile, da leggere con pstats o snakeviz')
+    parser.add_argument('-b', '--backend', choices=['numpy', 'numba'], default='numpy', help='Backend per l\'integrazione: numpy o numba compilato (Default: numpy)')
     
     return parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
 
-def save_data(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz):	
+def numba_available():
+
+    """
+    Funzione che controlla se Numba è installato
+    I kernel compilati vengono importati solo qui, quando è richiesto il backend numba, perché importare Numba rallenta l'avvio
+
+    Ritorna:
+    --------
+    True se Numba è installato, False altrimenti
+    """
+
+    import kernels as kn
+
+    return kn.NUMBA_AVAILABLE
+
+
+def save_data(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz, N_par=None, species=None):	
     
     """
-    Crea un dataframe con i dati della simulazione e lo salva nel file drift_data.csv
+    Salva i dati della simulazione come nuova riga del database dei risultati drift_data.db
 
     Parametri:
     ----------
@@ -43,35 +106,32 @@ def save_data(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz):
     N            : Numero di passi
     n_t          : Coefficiente turbolenza
     Bz           : Componente z del campo magnetico
+    N_par        : Numero di particelle simulate (Default: None)
+    species      : Nome della specie nelle simulazioni a più specie (Default: None)
 
     Ritorna:
     --------
-    Nessuno
+    row_id : Id della riga nel database
     """
 	
-	# Creazione dataframe vuoto
-    df = pd.DataFrame(data={ 
-        'Flag'              : [flag],
-        'v_drift'           : [vd_mean],
-        'v_drift_err'       : [vd_err_final],
-        'v_drift_theor'     : [vd_th_mean],
-        'Fields_value'      : [fields_val],
-        'Turbulence_coeff'  : [n_t],
-        'Bz'                : [Bz],
-        'N_steps'           : [N]
-	})
-	
-	# Salvataggio del dataframe in file .csv
-    file_exists = os.path.exists(file_data)
-    df.to_csv(file_data, mode='a' if file_exists else 'w', index=False, header=not file_exists)
+    # Inserimento della riga in una transazione, sicuro anche con più simulazioni in contemporanea
+    with pf.stage('save_data'):
+        row = rs.make_row(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz, N_par, species)
+        conn = rs.connect(file_data, file_csv)
+        try:
+            row_id = rs.insert_rows(conn, [row])[0]
+        finally:
+            conn.close()
+
+    pf.annotate(row=row, row_id=row_id)
 	
-    return
+    return row_id
 
 
 def clean_file(file_data):
         
     """
-    Funzione che elimina, se presente il file dei dati
+    Funzione che elimina, se presente il database dei dati, lasciandone uno vuoto
     
     Parametri:
     ----------
@@ -82,9 +142,17 @@ def clean_file(file_data):
     Nessuno
     """
     
-    if os.path.exists(file_data):
+    # Il database viene considerato presente anche se non è ancora stato creato dal file drift_data.csv
+    if os.path.exists(file_data) or os.path.exists(file_csv):
+        
+        # File del database e del suo journal WAL
+        for ext in ['', '-wal', '-shm']:
+            if os.path.exists(file_data + ext):
+                os.remove(file_data + ext)
+        
+        # Il database viene ricreato vuoto, così i dati di drift_data.csv non vengono importati di nuovo
+        rs.connect(file_data).close()
         
-        os.remove(file_data)
         print(f"\nFile '{file_data}' eliminato con successo.\n")
     
     else:
@@ -94,6 +162,119 @@ def clean_file(file_data):
     return
 
 
+def simulation_species(flag, Bz, E, B_grad, fields_val, backend):
+
+    """
+    Funzione che esegue la simulazione in modalità default per più specie di particelle
+    Ogni specie ha il proprio rapporto carica massa, numero di particelle e distribuzione delle velocità iniziali,
+    e suddivide il passo della simulazione nei sottopassi di species.schedule(), quindi le specie lente non vengono
+    integrate con il passo di quelle veloci. I risultati vengono stampati e salvati separatamente per ogni specie
+
+    Parametri:
+    ----------
+    flag          : Tipo di drift, 'ExB' o 'gradB'
+    Bz, E, B_grad : Campi della simulazione
+    fields_val    : Valore caratteristico del campo per il fit lineare
+    backend       : Backend per l'integrazione
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    #--------------------------------------------------------------
+    # Specie e parametri della simulazione di ognuna
+    try:
+        species = sp.parse_species(args.species, N_par)
+        params_list = sp.species_params(species, flag, Bz, E, B_grad, N, dt, n_t, args.steps_orb, backend=backend, integrator=args.integrator,
+                                        estimator=args.estimator, sampling=args.sampling, field_map=args.field_map,
+                                        analytic=not args.no_analytic, precision=args.precision)
+
+    except ZeroDivisionError:
+        print(f"\nErrore: il campo magnetico ha un valore non corretto o i passi sono insufficienti\n")
+        return
+
+    except ValueError as err:
+        print(f"\nErrore: {err}\n")
+        return
+
+    print(f"\n-------------------------------------------------------------")
+    print(f"Specie della simulazione\n")
+    print(f"{'specie':<8} {'q/m [C/Kg]':>11} {'particelle':>10} {'sottopassi':>10} {'dt [s]':>10} {'passi':>10} {'orbite tra centri':>18}")
+    for s, params in zip(species, params_list):
+        print(f"{s['name']:<8} {s['charge'] * s['qm']:11.3e} {s['N_par']:10d} {params['n_sub']:10d} {params['dt']:10.2e} {params['N']:10d} {params['gc_stride']:18d}")
+
+    for s, params in zip(species, params_list):
+        if params['n_orb'] < 2:
+            print(f"\nErrore: i passi non bastano per almeno due centri di guida della specie {s['name']}\n")
+            return
+        if params['steps_orb_min'] < en.MIN_STEPS_ORB:
+            print(f"\nAttenzione: solo {params['steps_orb_min']} passi per orbita per la specie {s['name']}, i centri di guida possono essere poco accurati")
+        blocks = en.error_blocks(params, s['N_par'])
+        if blocks is not None and len(blocks) < en.MIN_BLOCKS:
+            print(f"\nAttenzione: solo {len(blocks)} blocchi indipendenti per la specie {s['name']}, l'errore della velocità di drift media non è affidabile")
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Simulazione di ogni specie con un seme derivato da quello della simulazione
+    print(f"\n-------------------------------------------------------------")
+    print(f"Inizio della simulazione\n")
+
+    ss = np.random.SeedSequence(args.seed)
+    results = []
+    for s, params, seed_sp in zip(species, params_list, ss.spawn(len(species))):
+        print(f"Completamento del processo per {s['N_par']} particelle della specie {s['name']}...")
+        res, _ = en.run_ensemble(params, s['N_par'], seed=seed_sp, workers=args.workers, progress=True)
+        results.append(res)
+
+    pf.annotate(particles=sum(s['N_par'] for s in species), steps=sum(s['N_par'] * params['N'] for s, params in zip(species, params_list)))
+    print(f"\nSimulazione completata! (seed: {ss.entropy})")
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Fit e informazioni della simulazione per ogni specie
+    print(f"\n-------------------------------------------------------------")
+    print(f"Riepilogo della simulazione\n")
+    print(f"Valore dei campi usati:")
+    print(f"Bz = {Bz:.2e} [T]")
+
+    if flag == 'ExB':
+        E_str = ", ".join(f"{comp:.2f}" for comp in E)
+        print(f"E = [{E_str}] [V/m]")
+    else:
+        B_str = ", ".join(f"{comp:.2e}" for comp in B_grad)
+        print(f"∇ B = [{B_str}] [T/m]")
+
+    print(f"\nNumero di passi della specie più lenta: {N}")
+    print(f"Tempo simulato:                         {(N - 1) * params_list[0]['dt'] * params_list[0]['n_sub']:.2e} [s]")
+    print(f"Integratore:                            {args.integrator}")
+    print(f"Coefficiente di turbolenza:             {n_t:.3f}")
+
+    fits = []
+    for s, params, res in zip(species, params_list, results):
+        print(f"\nSpecie {s['name']}: {s['N_par']} particelle, {res['guide_cn'].shape[1]} centri di guida per particella")
+        fits.append(an.vd_fit(res['v_drift'], res['v_drift_th'], blocks=en.error_blocks(params, s['N_par'])))
+
+    # Mantiene aperti i grafici prima della chiusura del programma
+    pt.show()
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Salvataggio di una riga per specie se richiesto
+    if args.save:
+
+        for s, (vd_mean, vd_err_final, vd_th_mean) in zip(species, fits):
+            save_data(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz, s['N_par'], s['name'])
+        print(f"-------------------------------------------------------------")
+        print(f"I dati delle {len(species)} specie sono stati salvati nel file: {file_data}\n")
+    #--------------------------------------------------------------
+
+    return
+
+
 def simulation():
 
     """
@@ -112,6 +293,144 @@ def simulation():
     #--------------------------------------------------------------
     
 
+    #--------------------------------------------------------------
+    # Importa o esporta il database in formato .csv e chiude il programma
+    if args.import_csv or args.export_csv:
+
+        conn = rs.connect(file_data, file_csv)
+        
+        try:
+            if args.import_csv:
+                n_rows = rs.import_csv(conn, args.import_csv)
+                print(f"\nImportate {n_rows} righe da '{args.import_csv}' nel database '{file_data}'\n")
+            
+            if args.export_csv:
+                n_rows = rs.export_csv(conn, args.export_csv)
+                print(f"\nEsportate {n_rows} righe dal database '{file_data}' in '{args.export_csv}'\n")
+        
+        except (FileNotFoundError, KeyError) as err:
+            print(f"\nErrore: file .csv non valido o inesistente: {err}\n")
+
+        conn.close()
+        
+        return
+    #--------------------------------------------------------------
+    
+
+    #--------------------------------------------------------------
+    # Chiave condivisa della scansione distribuita, obbligatoria perché i messaggi sono serializzati con pickle
+    authkey = args.authkey or os.environ.get('DRIFT_AUTHKEY')
+
+    if (args.serve or args.worker) and not authkey:
+        print(f"\nErrore: la scansione distribuita richiede una chiave condivisa, usare --authkey o la variabile d'ambiente DRIFT_AUTHKEY\n")
+        return
+
+    if args.serve and not (args.sweep or args.grid):
+        print(f"\nErrore: il coordinatore è disponibile solo nella modalità scansione, usare --sweep o --grid\n")
+        return
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Cache dei risultati, la chiave dipende dai semi dei blocchi quindi con un seme casuale non verrebbe mai ritrovata
+    if args.cache:
+
+        if args.cache_size <= 0:
+            print(f"\nErrore: la dimensione della cache deve essere positiva\n")
+            return
+
+        if args.seed is None:
+            print(f"\nAttenzione: la cache dei risultati richiede --seed, con un seme casuale non viene usata")
+        else:
+            ca.set_cache(args.cache, args.cache_size)
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Worker della scansione distribuita, esegue i blocchi assegnati dal coordinatore e chiude il programma
+    if args.worker:
+
+        import broker as br
+
+        try:
+            address = br.parse_address(args.worker)
+        except ValueError:
+            print(f"\nErrore: indirizzo '{args.worker}' non valido, usare la forma HOST:PORTA\n")
+            return
+
+        print(f"\n-------------------------------------------------------------")
+        print(f"Worker con {args.workers} processi per il coordinatore {address[0]}:{address[1]}\n")
+
+        try:
+            n_done = br.run_workers(address, authkey.encode(), args.workers)
+        except ConnectionError as err:
+            print(f"\nErrore: {err}\n")
+            return
+
+        print(f"Scansione completata, blocchi eseguiti da questo worker: {n_done}\n")
+
+        return
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Controllo della singola precisione sulle configurazioni di riferimento e chiude il programma
+    if args.check_precision:
+
+        passed = True
+        for ref in en.PRECISION_REFS:
+
+            field = f"E = {ref['E']} [V/m]" if ref['flag'] == 'ExB' else f"∇ B = {ref['B_grad']} [T/m]"
+            print(f"\n-------------------------------------------------------------")
+            print(f"Controllo della singola precisione: drift {ref['flag']} con Bz = {ref['Bz']:.1e} [T], {field}, "
+                  f"turbolenza {ref['n_t']}, {ref['N']} passi, integratore {args.integrator}\n")
+
+            check = en.check_precision(qm, ref, seed=0 if args.seed is None else args.seed, workers=args.workers, integrator=args.integrator)
+            passed = passed and check['passed']
+
+            print(f"Velocità di drift media in doppia precisione:   {check['vd_double']:.4f} ± {check['vd_err']:.4f} [m/s]")
+            print(f"Velocità di drift media in singola precisione:  {check['vd_single']:.4f} [m/s]")
+            print(f"Differenza massima per particella:              {check['max_diff']:.4f} [m/s] su {check['vd_th']:.2f} [m/s] teorici")
+            print(f"Differenza relativa:                            {check['rel_diff']:.2e} (massima {en.PRECISION_RTOL:.0e})")
+
+        print()
+        if not passed:
+            print(f"Errore: la singola precisione non è affidabile su questa macchina, usare --precision double\n")
+            sys.exit(1)
+
+        print(f"La singola precisione riproduce la doppia precisione\n")
+
+        return
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Fit lineare di tutti i gruppi del database dalle sole statistiche sufficienti e chiude il programma
+    # Con -E o -G e --species vengono mostrati solo i gruppi del drift e della specie indicati
+
+    if args.fits:
+
+        if not os.path.exists(file_data) and not os.path.exists(file_csv):
+            print(f"\nIl file non è stato trovato, eseguire la simulazione con salvataggio dei dati per creare il file\n")
+            return
+
+        conn = rs.connect(file_data, file_csv)
+        flag = 'ExB' if args.drE and not args.drG else 'gradB' if args.drG and not args.drE else None
+        groups = rs.fit_stats(conn, flag, species=args.species[0].split(':')[0] if args.species else None)
+        conn.close()
+
+        print(f"\n-------------------------------------------------------------")
+        print(f"Fit lineare v = m x dei gruppi del database: {len(groups)}\n")
+        for group in groups:
+            m_fit, m_err, chi2 = an.fit_from_sums(group)
+            print(f"{group['Flag']:<6} {group['Species'] or '-':<6} Bz = {group['Bz']:.2e} [T]  N = {group['N_steps']}  punti = {group['n']}  "
+                  f"m = {m_fit:.4e} ± {m_err:.2e}  chi quadro = {chi2:.2f} ({group['n'] - 1} gdl)")
+        print()
+
+        return
+    #--------------------------------------------------------------
+
+
     #--------------------------------------------------------------
     # Modalità analisi dati
     # Esegue solo l'analisi dati per ricavare la dipendenza della velocità dai campi
@@ -132,107 +451,126 @@ def simulation():
             print(f"\nErrore: non è possibile salvare i dati in modalità analisi dati\n")
             return
 
-        # Legge il file dei dati se esiste altrimenti termina il programma
-        try:
-                df = pd.read_csv(file_data)
-            
-        except FileNotFoundError:
+        # Apre il database dei dati se esiste (o se può essere creato dal file .csv) altrimenti termina il programma
+        if not os.path.exists(file_data) and not os.path.exists(file_csv):
                 
                 print("\nIl file non è stato trovato, assicurati che esista nella cartella corrente")
                 print("Eseguire la simulazione con salvataggio dei dati per creare il file\n")
                 
                 return
-        #--------------------------------------------------------------
+        
+        # Il database viene chiuso anche quando l'analisi termina in anticipo
+        conn = rs.connect(file_data, file_csv)
+        try:
+            # Con --species si analizzano le righe della prima specie indicata, altrimenti quelle delle simulazioni a una specie
+            data_species = args.species[0].split(':')[0] if args.species else ''
+            #--------------------------------------------------------------
 
         
-        #--------------------------------------------------------------
-        # Esegue l'analisi dati in base al tipo di drift scelto    
+            #--------------------------------------------------------------
+            # Esegue l'analisi dati in base al tipo di drift scelto    
         
-        if args.drE:
+            if args.drE:
             
-            # Estrapola i dati in base al drift scelto
-            flag = 'ExB'
-            data = an.select_data(df, flag)
+                # Estrapola i dati in base al drift scelto
+                flag = 'ExB'
+                data = an.select_data(rs.query(conn, flag, species=data_species), flag)
             
-            # Esegue l'analisi dati per il fit lineare se non ci sono stati problemi con i dati del dataframe
-            if data is None:
-                return
+                # Esegue l'analisi dati per il fit lineare se non ci sono stati problemi con i dati del dataframe
+                if data is None:
+                    return
             
-            else:
-
-                # Estrazione dei dati dall'array
-                fields_value = data[:,3]
-                v_drift_mean = data[:,0]
-                v_drift_err = data[:,1]
-                v_drift_th = data[:,2]
-                Bz = data[0,4]
-                n_t_data = data[:,5]
+                else:
+
+                    # Estrazione dei dati dall'array
+                    fields_value = data[:,3]
+                    v_drift_mean = data[:,0]
+                    v_drift_err = data[:,1]
+                    v_drift_th = data[:,2]
+                    Bz = data[0,4]
+                    n_t_data = data[:,5]
                 
-                # Calcolo del coefficiente m teorico
-                m_th = 1 / Bz
+                    # Calcolo del coefficiente m teorico
+                    m_th = 1 / Bz
                 
-                # Funzione che esegue il fit lineare e funzione che genera il grafico
-                m_fit, m_err = an.linear_fit(fields_value, v_drift_mean, v_drift_err)
-                pt.plots_vd_fit(fields_value, v_drift_mean, v_drift_err, m_fit, m_err, m_th, v_drift_th)
-
-                # Stampa delle informazioni
-                print(f"-------------------------------------------------------------")
-                print(f"\nDati utilizzati per il fit lineare\n")
-                for i, m in enumerate(v_drift_mean):
-                    print(f"Misurazione {i+1}:") 
-                    print(f"Modulo del campo perpendicolare a Bz = {fields_value[i]:.2e} [V/m]")       
-                    print(f"Velocità di drift media =              {v_drift_mean[i]:.2f} ± {v_drift_err[i]:.2f} [m/s]")
-                    print(f"Turbolenza =                           {n_t_data[i]:.2f}\n")
-                print(f"-------------------------------------------------------------")
-                print(f"Risultati del fit lineare delle velocità di drift:\n")
-                print(f"Coefficiente angolare del fit:    {m_fit:.2f} ± {m_err:.2f} [m²/(V·s)]")
-                print(f"Valore teorico del coefficiente:  {m_th:.2f} [m²/(V·s)]\n") 
-                print(f"Errore relativo del coefficiente: {np.abs((m_fit - m_th) / m_th) * 100:.2f} %\n")
+                    # Fit lineare dalle statistiche sufficienti del gruppo, aggiornate dal database ad ogni inserimento, e grafico
+                    with pf.stage('linear_fit'):
+                        group = rs.fit_stats(conn, flag, Bz, species=data_species)
+                    if not group:
+                        print(f"\nNessun dato con errore positivo per il fit del drift {flag}\n")
+                        return
+                    m_fit, m_err, chi2 = an.fit_from_sums(group[0])
+                    with pf.stage('plots'):
+                        pt.plots_vd_fit(fields_value, v_drift_mean, v_drift_err, m_fit, m_err, m_th, v_drift_th)
+
+                    # Stampa delle informazioni
+                    print(f"-------------------------------------------------------------")
+                    print(f"\nDati utilizzati per il fit lineare\n")
+                    for i, m in enumerate(v_drift_mean):
+                        print(f"Misurazione {i+1}:") 
+                        print(f"Modulo del campo perpendicolare a Bz = {fields_value[i]:.2e} [V/m]")       
+                        print(f"Velocità di drift media =              {v_drift_mean[i]:.2f} ± {v_drift_err[i]:.2f} [m/s]")
+                        print(f"Turbolenza =                           {n_t_data[i]:.2f}\n")
+                    print(f"-------------------------------------------------------------")
+                    print(f"Risultati del fit lineare delle velocità di drift:\n")
+                    print(f"Coefficiente angolare del fit:    {m_fit:.2f} ± {m_err:.2f} [m²/(V·s)]")
+                    print(f"Valore teorico del coefficiente:  {m_th:.2f} [m²/(V·s)]")
+                    print(f"Chi quadro:                       {chi2:.2f} con {group[0]['n'] - 1} gradi di libertà\n")
+                    print(f"Errore relativo del coefficiente: {np.abs((m_fit - m_th) / m_th) * 100:.2f} %\n")
 
-        if args.drG:
+            if args.drG:
             
-            # Estrapola i dati in base al drift scelto
-            flag = 'gradB'
-            data = an.select_data(df, flag)
+                # Estrapola i dati in base al drift scelto
+                flag = 'gradB'
+                data = an.select_data(rs.query(conn, flag, species=data_species), flag)
             
-            # Esegue l'analisi dati per il fit lineare se non ci sono stati problemi con i dati del dataframe
-            if data is None:
-                return
+                # Esegue l'analisi dati per il fit lineare se non ci sono stati problemi con i dati del dataframe
+                if data is None:
+                    return
             
-            else:
+                else:
                 
-                # Estrazione dei dati dall'array
-                fields_value = data[:,3]
-                v_drift_mean = data[:,0]
-                v_drift_err = data[:,1]
-                v_drift_th = data[:,2]
-                Bz = data[0,4]
-                n_t_data = data[:,5]
+                    # Estrazione dei dati dall'array
+                    fields_value = data[:,3]
+                    v_drift_mean = data[:,0]
+                    v_drift_err = data[:,1]
+                    v_drift_th = data[:,2]
+                    Bz = data[0,4]
+                    n_t_data = data[:,5]
                 
-                # Calcolo del coefficiente m teorico
-                m_th = ( np.mean(v_drift_th) / Bz**2)
+                    # Calcolo del coefficiente m teorico
+                    m_th = ( np.mean(v_drift_th) / Bz**2)
                 
-                # Funzione che esegue il fit lineare e funzione che genera il grafico
-                m_fit, m_err = an.linear_fit(fields_value, v_drift_mean, v_drift_err)
-                pt.plots_vd_fit(fields_value, v_drift_mean, v_drift_err, m_fit, m_err, m_th, v_drift_th)
-
-                # Stampa delle informazioni
-                print(f"-------------------------------------------------------------")
-                print(f"\nDati utilizzati per il fit lineare\n")
-                for i, m in enumerate(v_drift_mean):
-                    print(f"Misurazione {i+1}:") 
-                    print(f"Modulo del campo perpendicolare a Bz = {fields_value[i]:.2e} [T/m]")       
-                    print(f"Velocità di drift media =              {v_drift_mean[i]:.2f} ± {v_drift_err[i]:.2f} [m/s]")
-                    print(f"Turbolenza =                           {n_t_data[i]:.2f}\n")
-                print(f"-------------------------------------------------------------")
-                print(f"Risultati del fit lineare delle velocità di drift:\n")
-                print(f"Coefficiente angolare del fit:    {m_fit:.2e} ± {m_err:.2e} [m³/(T²·s)]")
-                print(f"Valore teorico del coefficiente:  {m_th:.2e} [m³/(T²·s)]\n")
-                print(f"Errore relativo del coefficiente: {np.abs((m_fit - m_th) / m_th) * 100:.2f} %\n")
-        #--------------------------------------------------------------
+                    # Fit lineare dalle statistiche sufficienti del gruppo, aggiornate dal database ad ogni inserimento, e grafico
+                    with pf.stage('linear_fit'):
+                        group = rs.fit_stats(conn, flag, Bz, species=data_species)
+                    if not group:
+                        print(f"\nNessun dato con errore positivo per il fit del drift {flag}\n")
+                        return
+                    m_fit, m_err, chi2 = an.fit_from_sums(group[0])
+                    with pf.stage('plots'):
+                        pt.plots_vd_fit(fields_value, v_drift_mean, v_drift_err, m_fit, m_err, m_th, v_drift_th)
+
+                    # Stampa delle informazioni
+                    print(f"-------------------------------------------------------------")
+                    print(f"\nDati utilizzati per il fit lineare\n")
+                    for i, m in enumerate(v_drift_mean):
+                        print(f"Misurazione {i+1}:") 
+                        print(f"Modulo del campo perpendicolare a Bz = {fields_value[i]:.2e} [T/m]")       
+                        print(f"Velocità di drift media =              {v_drift_mean[i]:.2f} ± {v_drift_err[i]:.2f} [m/s]")
+                        print(f"Turbolenza =                           {n_t_data[i]:.2f}\n")
+                    print(f"-------------------------------------------------------------")
+                    print(f"Risultati del fit lineare delle velocità di drift:\n")
+                    print(f"Coefficiente angolare del fit:    {m_fit:.2e} ± {m_err:.2e} [m³/(T²·s)]")
+                    print(f"Valore teorico del coefficiente:  {m_th:.2e} [m³/(T²·s)]")
+                    print(f"Chi quadro:                       {chi2:.2f} con {group[0]['n'] - 1} gradi di libertà\n")
+                    print(f"Errore relativo del coefficiente: {np.abs((m_fit - m_th) / m_th) * 100:.2f} %\n")
+            #--------------------------------------------------------------
+        finally:
+            conn.close()
         
         # Mantiene il grafico aperto prima della chiusura del programma
-        plt.show()
+        pt.show()
     #--------------------------------------------------------------
 
         # Analisi completata
@@ -240,6 +578,145 @@ def simulation():
         return
 
 
+    #--------------------------------------------------------------
+    # Modalità rianalisi delle traiettorie salvate
+    # Legge le traiettorie scritte con --traj-out senza ripetere la simulazione
+
+    if args.traj_in:
+
+        try:
+            store = tj.open_store(args.traj_in)
+
+        except (FileNotFoundError, ValueError) as err:
+            print(f"\nErrore: impossibile leggere la cartella delle traiettorie '{args.traj_in}': {err}\n")
+            return
+
+        meta = store['meta']
+        par = meta['params']
+        
+        # Centri di guida e velocità di drift ricavati dalle posizioni su file, a blocchi di particelle
+        guide_cn, v_drift = tj.drift_from_store(store, args.estimator)
+
+        print(f"\n-------------------------------------------------------------")
+        print(f"Rianalisi delle traiettorie salvate in '{args.traj_in}'\n")
+        print(f"Tipo di drift:                    {par['flag']}")
+        print(f"Bz = {par['B'][2]:.2e} [T]")
+        print(f"Numero di particelle:             {meta['N_par']}")
+        print(f"Numero di passi per particella:   {meta['N']}")
+        print(f"Numero di orbite:                 {meta['n_orb']}")
+        print(f"Seme della simulazione:           {meta['seed']}")
+
+        # Le traiettorie disegnate sono viste sul file, non copie
+        with pf.stage('plots'):
+            pt.plots_tra(store['position'][:5], guide_cn[:5])
+        an.vd_fit(v_drift, store['v_drift_th'], blocks=en.error_blocks(par, meta['N_par']) if 'sampling' in par else None)
+        pt.show()
+
+        # Fine modalità rianalisi, chiude il programma
+        return
+    #--------------------------------------------------------------
+
+
+    #--------------------------------------------------------------
+    # Modalità scansione
+    # Esegue senza input da tastiera tutte le configurazioni della griglia e ne salva i risultati
+
+    if args.sweep or args.grid:
+
+        if args.drE and args.drG:
+            print(f"\nErrore: scegliere solo uno dei due modi per il moto di deriva della particella\nUsare --help per informazioni\n")
+            return
+
+        if args.tra:
+            print(f"\nErrore: la modalità traiettoria non è disponibile per la scansione\n")
+            return
+
+        if args.field_map:
+            print(f"\nErrore: la mappa di campo non è disponibile per la scansione\n")
+            return
+
+        if args.species:
+            print(f"\nErrore: la simulazione a più specie non è disponibile per la scansione\n")
+            return
+
+        # Valori usati per i parametri non specificati nella griglia
+        defaults = {
+            'Flag'      : 'ExB' if args.drE else 'gradB' if args.drG else None,
+            'Bz'        : 8e-4,
+            'Ex'        : 0.0,
+            'Ey'        : 0.0,
+            'Ez'        : 0.0,
+            'dBdx'      : 0.0,
+            'dBdy'      : 0.0,
+            'n_t'       : n_t,
+            'N'         : N,
+            'dt'        : dt,
+            'steps_orb' : args.steps_orb,
+        }
+
+        try:
+            configs = sw.read_grid(args.sweep, defaults) if args.sweep else []
+            if args.grid:
+                configs += sw.grid_from_ranges(args.grid, defaults)
+        
+        except FileNotFoundError:
+            print(f"\nErrore: il file '{args.sweep}' non esiste\n")
+            return
+        
+        except (ValueError, KeyError) as err:
+            print(f"\nErrore nella griglia della scansione: {err}\n")
+            return
+
+        # Se Numba non è installato si ritorna al backend NumPy
+        backend = args.backend
+        if backend == 'numba' and not numba_available():
+            print(f"\nAttenzione: Numba non è installato, viene usato il backend NumPy")
+            backend = 'numpy'
+
+        if backend == 'numba' and args.precision == 'single':
+            print(f"\nAttenzione: il backend numba lavora sempre in doppia precisione, --precision viene ignorato")
+
+        print(f"\n-------------------------------------------------------------")
+        print(f"Scansione di {len(configs)} configurazioni con {N_par} particelle ciascuna\n")
+        
+        # Con --serve i blocchi vengono eseguiti dai worker connessi al coordinatore, altrimenti da questa macchina
+        if args.serve:
+
+            import broker as br
+
+            jobs = sw.sweep_jobs(configs, N_par, qm, dt, args.seed, backend, args.integrator, args.estimator, args.sampling, args.balance_charge,
+                                 not args.no_analytic, args.precision)
+            try:
+                rows = br.serve_sweep(jobs, N_par, br.parse_address(args.serve), authkey.encode(), args.lease, args.retries, progress=True)
+            except (RuntimeError, ValueError, OSError) as err:
+                print(f"\nErrore nella scansione distribuita: {err}\n")
+                return
+
+        else:
+            rows = sw.run_sweep(configs, N_par, qm, dt, seed=args.seed, workers=args.workers, backend=backend, integrator=args.integrator, estimator=args.estimator,
+                                sampling=args.sampling, balance=args.balance_charge, analytic=not args.no_analytic, precision=args.precision)
+
+        # Stampa e salvataggio dei risultati
+        print(f"\n-------------------------------------------------------------")
+        print(f"Risultati della scansione\n")
+        with pf.stage('save_data'):
+            conn = rs.connect(file_data, file_csv)
+            try:
+                rs.insert_rows(conn, [rs.make_row(**row) for row in rows])
+            finally:
+                conn.close()
+        pf.annotate(particles=N_par * len(rows), steps=N_par * sum(row['N'] for row in rows))
+        for row in rows:
+            print(f"{row['flag']:<6} Bz = {row['Bz']:.2e} [T]  campo = {row['fields_val']:.2e}  n_t = {row['n_t']:.3f}  N = {row['N']}  "
+                  f"v_drift = {row['vd_mean']:.2f} ± {row['vd_err_final']:.2f} [m/s]  teoria = {row['vd_th_mean']:.2f} [m/s]")
+        
+        print(f"\nI dati di {len(rows)} configurazioni sono stati salvati nel file: {file_data}\n")
+
+        # Fine modalità scansione, chiude il programma
+        return
+    #--------------------------------------------------------------
+
+
     #--------------------------------------------------------------
     # Modalità simulazione default o traiettoria
     # Controllo della scelta del tipo di drift e n_t per la simulazione
@@ -270,14 +747,72 @@ def simulation():
         
         print(f"\nErrore: scegliere uno dei due modi per il moto di deriva della particella\nUsare --help per informazioni\n")
         return
+
+    if args.species and (args.tra or args.traj_out or args.checkpoint or args.rtol is not None or args.atol is not None):
+
+        print(f"\nErrore: la simulazione a più specie è disponibile solo in modalità default, senza --tra, --traj-out, --checkpoint, --rtol e --atol\n")
+        return
+    
+    # Se Numba non è installato si ritorna al backend NumPy
+    backend = args.backend
+    if backend == 'numba' and not numba_available():
+        
+        print(f"\nAttenzione: Numba non è installato, viene usato il backend NumPy")
+        backend = 'numpy'
+
+    # I kernel compilati supportano solo i campi uniformi, con la mappa di campo si usa il ciclo NumPy
+    if backend == 'numba' and args.field_map:
+
+        print(f"\nAttenzione: il backend numba non supporta le mappe di campo, viene usato il backend NumPy")
+        backend = 'numpy'
+
+    # I kernel compilati tengono lo stato di ogni particella nei registri e lavorano sempre in doppia precisione
+    if backend == 'numba' and args.precision == 'single':
+
+        print(f"\nAttenzione: il backend numba lavora sempre in doppia precisione, --precision viene ignorato")
     #--------------------------------------------------------------
 
     
     #--------------------------------------------------------------
     # Configurazione dei campi scelta dall'utente
 
+    # Ripresa di una simulazione interrotta, i campi sono quelli salvati nella cartella dei checkpoint
+    if resume is not None:
+
+        par = resume['params']
+        Bz = par['B'][2]
+        B = par['B']
+        E = par['E']
+        B_grad = par['B_grad']
+        fields_val = par['fields_val']
+
+        print(f"\n-------------------------------------------------------------")
+        print(f"Ripresa della simulazione salvata nella cartella '{args.resume}'")
+
+    # Campi letti dalla mappa, i valori nell'origine sono usati per le orbite e per la velocità di drift teorica
+    elif args.field_map:
+
+        try:
+            E, B, B_grad = fl.reference_fields(fl.load_field_map(args.field_map))
+
+        except (FileNotFoundError, KeyError, ValueError) as err:
+            print(f"\nErrore: mappa di campo '{args.field_map}' non valida o inesistente: {err}\n")
+            return
+
+        Bz = B[2]
+        fields_val = np.linalg.norm(E[:2]) if args.drE else np.linalg.norm(B_grad[:2])
+
+        print(f"\n-------------------------------------------------------------")
+        print(f"Campi letti dalla mappa '{args.field_map}', valori nell'origine:\n")
+        print(f"E = [{', '.join(f'{comp:.2e}' for comp in E)}] [V/m]")
+        print(f"B = [{', '.join(f'{comp:.2e}' for comp in B)}] [T]")
+        print(f"∇ B = [{', '.join(f'{comp:.2e}' for comp in B_grad)}] [T/m]")
+
+        if np.linalg.norm(B[:2]) > 1e-3 * abs(Bz):
+            print(f"\nAttenzione: B nell'origine non è diretto lungo z, centri di guida e velocità teorica usano solo Bz")
+
     # Parametri della simulazione per il drift ExB
-    if args.drE:
+    elif args.drE:
         
         print(f"\n-------------------------------------------------------------")
         print(f"Configurazione iniziale dei campi E e B\n")
@@ -373,94 +908,127 @@ def simulation():
     #--------------------------------------------------------------
 
 
+    #--------------------------------------------------------------
+    # Simulazione a più specie, con parametri e risultati separati per ogni specie
+    if args.species:
+
+        simulation_species(flag, Bz, E, B_grad, fields_val, backend)
+
+        return
+    #--------------------------------------------------------------
+
+
     #-------------------------------------------------------------- 
     # Parametri per centro di guida e velocità di drift
     
     try: 
-        # Calcolo del periodo di ciclotrone
-        B_mod = np.linalg.norm(B)       # Modulo del campo magnetico [T]
-        B_hat = B / B_mod               # Versore del campo magnetico 
-        om_c  = qm * B_mod              # Frequenza di ciclotrone [rad/s]
-        T_c   = 2 * np.pi / om_c        # Periodo di ciclotrone [s]
-
-        # Calcolo del numero di orbite
-        steps_orb = int(T_c / dt)       # Passi per completare un orbita
-        T_orb = steps_orb * dt          # Periodo per completare un orbita [s]
-        n_orb = int(N / steps_orb)      # Numero di orbite completate
-
-        # Creazioni di array per contenere i dati 
-        position = np.zeros((N_par, N, 3))
-        guide_cn = np.zeros((N_par, n_orb, 3))
-        v_drift  = np.zeros((N_par, 3))
-        v_drift_th = np.zeros((N_par, 3))
-        velocity_0 = np.zeros((N_par, 3))
-        r_Larmor = np.zeros(N_par)
-        q_part = [''] * N_par
-    
+        # Parametri della simulazione comuni a tutti i blocchi di particelle
+        params = en.build_params(flag, Bz, E, B_grad, N, dt, n_t, qm, backend, args.integrator, args.estimator, args.steps_orb,
+                                 args.sampling, args.balance_charge, args.field_map, not args.no_analytic, args.precision)
+        n_orb = params['n_orb']
+        om_c  = qm * np.linalg.norm(B)  # Frequenza di ciclotrone [rad/s]
+
     except ZeroDivisionError:
         
         print(f"\nErrore: il campo magnetico ha un valore non corretto o i passi sono insufficienti\n")
         return
+
+    except ValueError as err:
+
+        print(f"\nErrore: {err}\n")
+        return
+
+    if params['steps_orb_min'] < en.MIN_STEPS_ORB:
+        print(f"\nAttenzione: solo {params['steps_orb_min']} passi per orbita dove il campo è più intenso, i centri di guida possono essere poco accurati")
     #--------------------------------------------------------------
         
 
     #--------------------------------------------------------------
     # Inizio della simulazione
     
+    # Con una tolleranza le particelle vengono simulate a lotti finché l'errore non è sufficiente
+    converge = (args.rtol is not None or args.atol is not None) and not args.tra
+
+    if converge and args.traj_out:
+        print(f"\nErrore: non è possibile salvare le traiettorie con --rtol o --atol, il numero di particelle non è noto in anticipo\n")
+        return
+
+    if args.checkpoint and (converge or args.tra):
+        print(f"\nErrore: i checkpoint sono disponibili solo in modalità default senza --rtol o --atol\n")
+        return
+
+    # Con i campionamenti a varianza ridotta l'errore si ricava dalla dispersione dei blocchi, che devono essere abbastanza
+    blocks = en.error_blocks(params, N_par)
+    if blocks is not None and len(blocks) < en.MIN_BLOCKS and not converge:
+        print(f"\nAttenzione: con {N_par} particelle ci sono solo {len(blocks)} blocchi indipendenti, l'errore della velocità di drift media non è affidabile")
+
     try:
         #--------------------------------------------------------------
         print(f"\n-------------------------------------------------------------")
         print(f"Inizio della simulazione\n")
-        print(f"Completamento del processo per {N_par} particelle...")
-        for p in tqdm(range(N_par)):
-            
-            # Inizializzazione della carica per la particella
-            sign = np.sign(np.random.uniform(-1.0, 1.0))
-            qm_tra = sign * qm
-            if qm_tra < 0:
-                q_part[p] = 'Negativa' 
-            else:
-                q_part[p] = 'Positiva'     
-            
-            # Creazione array per la velocità iniziale casuale della particella 
-            v0x = np.random.normal(0.0 , 4e5)
-            v0y = np.random.normal(0.0 , 4e5)
-            v0z = np.random.normal(0.0 , 5e4)
-            v0 = np.array([v0x, v0y, v0z])
+        
+        # Se richiesto le traiettorie vengono scritte su file durante l'integrazione invece che in memoria
+        ss = np.random.SeedSequence(args.seed)
+        if args.traj_out and resume is None:
+            tj.create_store(args.traj_out, params, N_par, ss.entropy)
+
+        # Cartella dei checkpoint, con --resume esiste già e contiene i blocchi completati
+        if args.checkpoint and resume is None:
+            try:
+                ck.create_checkpoint(args.checkpoint, params, N_par, ss.entropy, args.traj_out)
+            except FileExistsError as err:
+                print(f"\nErrore: {err}, usare --resume per riprenderlo\n")
+                return
 
-            # Calcolo del raggio di Larmor della particella
-            v_perp = np.linalg.norm(v0[:2])     # Componente perpendicolare della velocità iniziale [m/s]
-            r_L = v_perp / om_c                 # Raggio di Larmor [m]
+        # Simulazione dell'ensemble, eventualmente su più processi
+        if converge:
+            print(f"Simulazione a lotti di {args.batch} particelle, al massimo {args.max_par}...")
+            res, seed, converged = en.run_converged(params, args.batch, args.max_par, args.rtol, args.atol, seed=ss, workers=args.workers, progress=True)
+            if not converged:
+                print(f"\nAttenzione: tolleranza non raggiunta con il numero massimo di particelle")
 
-            # Calcolo della velocità di drift teorica per ExB
-            if args.drE:
+        else:
+            # Con la cache attiva una simulazione già eseguita viene letta invece che integrata
+            # Le traiettorie e i checkpoint richiedono l'integrazione, quindi in quei casi la cache non viene usata
+            use_cache = ca.CACHE_DIR is not None and not (args.tra or args.traj_out or args.checkpoint)
+            key = ca.result_key(params, N_par, en.split_chunks(N_par, args.seed, en.min_blocks(params))[1]) if use_cache else None
+            hit = ca.load(key)
 
-                v_d_th_vec = np.cross(E, B) / B_mod**2
-
-            # Calcolo della velocità di drift teorica per gradB
-            if args.drG:
+            if hit is not None:
+                print(f"Risultati per {N_par} particelle letti dalla cache, integrazione saltata")
+                res, seed = hit[0], ss.entropy
 
-                v_d_th_vec = ( v_perp**2 / (2 * qm_tra * B_mod**3)) * np.cross(B, B_grad)     
-            #--------------------------------------------------------------
-            
-            # Calcolo della traiettoria e della velocità della particella
-            r = dm.drift(N, dt, B, E, B_grad, qm_tra, v0, n_t)
-
-            # Calcolo della traiettoria del centro di guida
-            r_gc = dm.guide_center(r, n_orb, steps_orb)
-            
-            # Calcolo della velocità di drift vettoriale della particella
-            v_d_vec = dm.v_drift(r_gc, n_orb, T_orb, B_hat)
-            
-            # Salvataggio dei dati negli array
-            position[p] = r
-            guide_cn[p] = r_gc
-            v_drift[p] = v_d_vec
-            v_drift_th[p] = v_d_th_vec
-            r_Larmor[p] = r_L 
-            velocity_0[p] = v0
+            else:
+                print(f"Completamento del processo per {N_par} particelle...")
+                res, seed = en.run_ensemble(params, N_par, seed=ss, workers=args.workers, keep_traj=args.tra and not args.traj_out, progress=True, traj_file=args.traj_out,
+                                            checkpoint=args.checkpoint, every=args.checkpoint_every)
+                ca.store(key, res, an.vd_stats(res['v_drift'], res['v_drift_th'], en.error_blocks(params, N_par)))
+        
+        N_used = len(res['v_drift'])    # Numero di particelle effettivamente simulate
+        pf.annotate(particles=N_used, steps=N_used * N)
+        
+        # Estrazione dei risultati
+        v_drift    = res['v_drift']
+        v_drift_th = res['v_drift_th']
+        
+        # Dati delle singole particelle, mostrati solo con le traiettorie
+        if args.tra:
+            velocity_0 = res['v0']
+            v_drift_err = res['v_drift_err']
+            guide_cn   = res['guide_cn']
+            q_part = np.where(res['qm'] < 0, 'Negativa', 'Positiva')
+        
+            # Calcolo del raggio di Larmor delle particelle
+            v_perp = np.linalg.norm(velocity_0[:,:2], axis=1)     # Componente perpendicolare della velocità iniziale [m/s]
+            r_Larmor = v_perp / om_c                               # Raggio di Larmor [m]
+        
+        if args.traj_out:
+            tj.write_results(args.traj_out, res)
+            position = tj.open_store(args.traj_out)['position']
+        elif args.tra:
+            position = res['position']
         #--------------------------------------------------------------
-        print(f"\nSimulazione completata!")  
+        print(f"\nSimulazione completata! (seed: {seed})")  
     
     except (IndexError or ValueError or ZeroDivisionError):
        
@@ -476,7 +1044,8 @@ def simulation():
 
     if args.tra:
         
-        pt.plots_tra(position, guide_cn)
+        with pf.stage('plots'):
+            pt.plots_tra(position, guide_cn)
  
         print(f"\n---------------------------------------------")
         print(f"Riepilogo della simulazione\n")
@@ -494,6 +1063,8 @@ def simulation():
             print(f"∇ B = [{B_str}] [T/m]")
         
         print(f"\nNumero di passi per particella: {N}")
+        print(f"Intervallo di tempo dei passi:    {params['dt']:.2e} [s]")
+        print(f"Integratore:                      {args.integrator}")
         print(f"Numero di orbite:                 {n_orb}")
         print(f"Coefficiente di turbolenza:       {n_t:.3f}")
 
@@ -507,12 +1078,15 @@ def simulation():
             print(f"Carica della particella:     {q_part[i]}")
             print(f"Velocità iniziale: [{v_str}] [m/s]")
             print(f"Raggio di Larmor:            {r_Larmor[i]:.2f} [m]")
-            print(f"Velocità di drift calcolata: {np.linalg.norm(v_drift[i]):.2f} [m/s]")
+            if args.estimator == 'lsq':
+                print(f"Velocità di drift calcolata: {np.linalg.norm(v_drift[i]):.2f} ± {np.linalg.norm(v_drift_err[i]):.2f} [m/s]")
+            else:
+                print(f"Velocità di drift calcolata: {np.linalg.norm(v_drift[i]):.2f} [m/s]")
             print(f"Velocità di drift teorica:   {np.linalg.norm(v_drift_th[i]):.2f} [m/s]")
             print(f"Differenza percentuale:      {abs(np.linalg.norm(v_drift[i]) - np.linalg.norm(v_drift_th[i])) / np.linalg.norm(v_drift_th[i])*100:.2f} %\n")
         
         # Mantiene aperti i grafici prima della chiusura il programma
-        plt.show() 
+        pt.show() 
 
         if args.save:
 
@@ -539,15 +1113,20 @@ def simulation():
         B_str = ", ".join(f"{comp:.2e}" for comp in B_grad)
         print(f"∇ B = [{B_str}] [T/m]")
     
-    print(f"\nNumero di passi per particella: {N}")
+    print(f"\nNumero di particelle:             {N_used}")
+    print(f"Numero di passi per particella: {N}")
+    print(f"Intervallo di tempo dei passi:    {params['dt']:.2e} [s]")
+    print(f"Integratore:                      {args.integrator}")
+    print(f"Campionamento:                    {args.sampling}{' con cariche bilanciate' if args.balance_charge else ''}")
     print(f"Numero di orbite:                 {n_orb}")
     print(f"Coefficiente di turbolenza:       {n_t:.3f}")
 
     # Calcola il fit delle velocità di drift e stampa i risultati
-    vd_mean, vd_err_final, vd_th_mean = an.vd_fit(v_drift, v_drift_th)
+    # Con i campionamenti a varianza ridotta l'errore è ricavato dai blocchi indipendenti di particelle
+    vd_mean, vd_err_final, vd_th_mean = an.vd_fit(v_drift, v_drift_th, blocks=en.error_blocks(params, N_used))
     
     # Mantiene aperto il grafico prima della chiusura del programma
-    plt.show()
+    pt.show()
     
     # Fine modalità simulazione default
     #--------------------------------------------------------------
@@ -558,7 +1137,7 @@ def simulation():
     
     if args.save:
        
-        save_data(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz)
+        save_data(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz, N_used)
         print(f"-------------------------------------------------------------")
         print(f"I dati della simulazione sono stati salvati nel file: {file_data}\n")
     #--------------------------------------------------------------
@@ -569,8 +1148,9 @@ if __name__ == "__main__":
     # Richiamo della funzione degli argomenti
     args = parser_arguments()
     
-    # Definizione del file dei dati
-    file_data = 'drift_data.csv'
+    # Definizione del database dei dati e del file .csv importato alla sua creazione
+    file_data = 'drift_data.db'
+    file_csv = 'drift_data.csv'
  
     #--------------------------------------------------------------
     # Costanti e parametri per la simulazione
@@ -578,7 +1158,7 @@ if __name__ == "__main__":
     q = 1.6e-19         # Carica della particella [C]
     m = 1.67e-27        # Massa della particella [kg]
     qm = q / m          # Rapporto carica massa per particella positiva [C/Kg]
-    dt = 1e-6           # Intervallo di tempo tra i passi [s]        
+    dt = args.dt        # Intervallo di tempo tra i passi [s]        
     n_t = args.turb     # Coefficiente della turbolenza 
     N = args.step       # Numero di passi per il moto della particella         
     
@@ -589,6 +1169,53 @@ if __name__ == "__main__":
     else:
         N_par = 1000                 
     #--------------------------------------------------------------
+
+    #--------------------------------------------------------------
+    # Con --resume i parametri, il numero di particelle e il seme sono quelli della simulazione interrotta
+    resume = None
+    
+    if args.resume:
+
+        try:
+            resume = ck.open_checkpoint(args.resume)
+
+        except (FileNotFoundError, ValueError) as err:
+            print(f"\nErrore: impossibile riprendere dalla cartella '{args.resume}': {err}\n")
+            sys.exit(1)
+
+        par = resume['params']
+        args.drE, args.drG, args.tra, args.checkpoint = par['flag'] == 'ExB', par['flag'] == 'gradB', False, args.resume
+        args.integrator, args.estimator, args.sampling, args.balance_charge = par['integrator'], par['estimator'], par['sampling'], par['balance']
+        args.seed, args.traj_out, args.steps_orb, args.field_map = int(resume['seed']), resume['traj_out'], None, par.get('field_map')
+        args.no_analytic, args.precision = not par.get('analytic', True), par.get('precision', 'double')
+        dt, n_t, N, N_par = par['dt'], par['n_t'], par['N'], resume['N_par']
+    #--------------------------------------------------------------
+
+    # Grafici a schermo o salvati su file con il backend Agg
+    pt.set_output(args.out, args.plot_points, args.decimate)
+
+    # Misura dei tempi delle fasi, attiva anche se è richiesto solo il file .json o il profilo di cProfile
+    profile = args.profile or args.profile_json is not None or args.profile_out is not None
+    pf.enable(profile)
+    pf.annotate(argv=sys.argv[1:], workers=args.workers)
     
+    if args.profile_out:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+
     # Esecuzione della simulazione
-    simulation()
\ No newline at end of file
+    t_start = time.perf_counter()
+    simulation()
+    wall = time.perf_counter() - t_start
+
+    # Resoconto dei tempi, con più processi cProfile misura solo il processo principale
+    if args.profile_out:
+        prof.disable()
+        prof.dump_stats(args.profile_out)
+        print(f"\nProfilo di cProfile salvato nel file: {args.profile_out}")
+
+    if profile:
+        rep = pf.report(wall)
+        if args.profile_json:
+            pf.write_json(args.profile_json, rep)
\ No newline at end of file
@@ -1,13 +1,174 @@
+import os
+import sys
 import numpy as np
-from scipy.stats import norm
-import matplotlib.pyplot as plt
 import analysis as an
+import profiling as pf
+
+# Matplotlib e SciPy vengono importati solo quando si disegna un grafico, per avviare velocemente il programma
+
+# Cartella in cui salvare i grafici, se None i grafici vengono mostrati a schermo
+OUT_DIR = None
+
+# Numero massimo di punti disegnati per ogni traiettoria e metodo di riduzione, 'lttb' o 'stride'
+MAX_POINTS = 2000
+DECIMATE = 'lttb'
+
+# Numero di grafici salvati con lo stesso nome, per non sovrascriverli
+_saved = {}
+
+
+def set_output(out_dir=None, max_points=None, decimate=None):
+
+    """
+    Funzione che configura l'uscita dei grafici
+    Con una cartella i grafici vengono salvati come file .png con il backend Agg, senza bisogno di uno schermo
+
+    Parametri:
+    ----------
+    out_dir    : Cartella in cui salvare i grafici, se None vengono mostrati a schermo (Default: None)
+    max_points : Numero massimo di punti per traiettoria (Default: None, invariato)
+    decimate   : Metodo di riduzione dei punti, 'lttb' o 'stride' (Default: None, invariato)
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    global OUT_DIR, MAX_POINTS, DECIMATE
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].switch_backend('Agg')
+    OUT_DIR = out_dir
+
+    if max_points is not None:
+        MAX_POINTS = max_points
+    if decimate is not None:
+        DECIMATE = decimate
+
+    return
+
+
+def pyplot():
+
+    """
+    Funzione che importa matplotlib.pyplot alla prima richiesta, con il backend Agg se i grafici vengono salvati su file
+
+    Ritorna:
+    --------
+    plt : Modulo matplotlib.pyplot
+    """
+
+    if OUT_DIR is not None and 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def save_or_show(fig, name):
+
+    """
+    Funzione che salva il grafico nella cartella di uscita, se configurata, altrimenti lo mostra senza bloccare
+    Se un grafico con lo stesso nome è già stato salvato viene aggiunto un numero progressivo
+
+    Parametri:
+    ----------
+    fig  : Figura di Matplotlib
+    name : Nome del file senza estensione
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    plt = pyplot()
+
+    if OUT_DIR is None:
+        plt.show(block=False)
+        return
+
+    _saved[name] = _saved.get(name, 0) + 1
+    suffix = f"_{_saved[name]}" if _saved[name] > 1 else ""
+    file_fig = os.path.join(OUT_DIR, f"{name}{suffix}.png")
+    fig.savefig(file_fig, dpi=150)
+    plt.close(fig)
+    print(f"Grafico salvato nel file: {file_fig}")
+
+    return
+
+
+def show():
+
+    """
+    Funzione che mantiene aperti i grafici a schermo fino alla loro chiusura
+    Non fa nulla se i grafici vengono salvati o se nessun grafico è stato creato, quindi Matplotlib non viene importato
+    """
+
+    # L'attesa della chiusura delle finestre viene misurata a parte, per non contarla nei tempi di calcolo
+    if OUT_DIR is None and 'matplotlib.pyplot' in sys.modules:
+        with pf.stage('show'):
+            sys.modules['matplotlib.pyplot'].show()
+
+    return
+
+
+def decimate(r, n_max=None, method=None):
+
+    """
+    Funzione che riduce i punti di una traiettoria a un numero massimo, mantenendo il primo e l'ultimo
+    'stride' prende punti equispaziati e legge solo quelli, quindi su un file mappato in memoria il costo non dipende da N
+    'lttb' (Largest Triangle Three Buckets) divide la traiettoria in intervalli e da ognuno prende il punto che forma
+    il triangolo di area maggiore con il punto scelto prima e la media dell'intervallo successivo, conservando la forma delle orbite
+
+    Parametri:
+    ----------
+    r      : Array delle posizioni [m], forma (N, 3)
+    n_max  : Numero massimo di punti (Default: None, usa MAX_POINTS)
+    method : 'lttb' o 'stride' (Default: None, usa DECIMATE)
+
+    Ritorna:
+    --------
+    r_dec : Array delle posizioni ridotte [m], forma (min(N, n_max), 3)
+    """
+
+    n_max = MAX_POINTS if n_max is None else n_max
+    method = DECIMATE if method is None else method
+    N = len(r)
+
+    if N <= n_max or n_max < 3:
+        return np.asarray(r)
+
+    if method == 'stride':
+        return np.asarray(r[np.linspace(0, N - 1, n_max).astype(int)])
+
+    r = np.asarray(r)
+    edges = np.linspace(1, N - 1, n_max - 1).astype(int)
+    idx = np.zeros(n_max, dtype=int)
+    idx[-1] = N - 1
+
+    for b in range(n_max - 2):
+
+        # Media dell'intervallo successivo, per l'ultimo intervallo è l'ultimo punto
+        nxt = r[edges[b+1]:edges[b+2]].mean(axis=0) if b < n_max - 3 else r[-1]
+
+        # Area dei triangoli formati dal punto precedente, dai candidati e dalla media successiva
+        cand = r[edges[b]:edges[b+1]]
+        area = np.linalg.norm(np.cross(cand - r[idx[b]], nxt - r[idx[b]]), axis=1)
+        idx[b+1] = edges[b] + np.argmax(area)
+
+    return r[idx]
+
 
 def plots_tra(position, guide_cn):
 
     """
     Funzione che crea i plot delle traiettorie delle particelle e dei centri di guida
     Stampa inoltre informazioni riguardo la simulazione effettuata
+    Ogni traiettoria viene ridotta a MAX_POINTS punti con decimate() prima di essere disegnata
 
     Parametri:
     ----------
@@ -19,6 +180,12 @@ def plots_tra(position, guide_cn):
     Nessuno
     """
 
+    plt = pyplot()
+
+    # Traiettorie ridotte, il tempo di disegno non dipende dal numero di passi
+    position = [decimate(r) for r in position]
+    guide_cn = [decimate(r_gc) for r_gc in guide_cn]
+
     #--------------------------------------------------------------
     # Plot 3D delle traiettorie con drift E×B
     
@@ -46,7 +213,7 @@ def plots_tra(position, guide_cn):
     ax.set_box_aspect((1, 1, 1))
     ax.legend()
     plt.tight_layout()
-    plt.show(block=False)
+    save_or_show(fig, 'traiettorie_3d')
     #--------------------------------------------------------------
 
 
@@ -72,7 +239,7 @@ def plots_tra(position, guide_cn):
     ax2.legend()
     ax2.grid(True)
     plt.tight_layout()
-    plt.show(block=False)
+    save_or_show(fig2, 'traiettorie_2d')
     #--------------------------------------------------------------
     
     return
@@ -96,16 +263,20 @@ def plots_vd_dist(v_drift, v_drift_th, mu, sigma):
     Nessuno
     """
 
+    from scipy.stats import norm
+    plt = pyplot()
+
     components = ['x', 'y']
     fig, axs = plt.subplots(1,2, figsize=(12,5))
 
     for i, comp in enumerate(components):
         
-        # Genera istogramma delle componenti della velocità di drift
-        axs[i].hist(v_drift[:,i], bins=50, density=True, alpha=0.6, color='skyblue', label='Simulazione')
+        # Istogramma delle componenti della velocità di drift calcolato con NumPy, a Matplotlib passano solo i 50 intervalli
+        counts, edges = np.histogram(v_drift[:,i], bins=50, density=True)
+        axs[i].stairs(counts, edges, fill=True, alpha=0.6, color='skyblue', label='Simulazione')
         
         # Disegna la curva gaussiana del fit
-        x_vals = np.linspace(min(v_drift[:,i]), max(v_drift[:,i]), 200)
+        x_vals = np.linspace(edges[0], edges[-1], 200)
         axs[i].plot(x_vals, norm.pdf(x_vals, mu[i], sigma[i]), '--', color='red', label=(f'Fit Gaussiano μ={mu[i]:.1f}'))
         
         # Disegna una linea della media teorica
@@ -117,7 +288,7 @@ def plots_vd_dist(v_drift, v_drift_th, mu, sigma):
 
     plt.suptitle('Distribuzioni componenti della velocità di drift')
     plt.tight_layout()
-    plt.show(block=False)
+    save_or_show(fig, 'distribuzioni_vd')
 
     return
 
@@ -142,7 +313,9 @@ def plots_vd_fit(fields_value, v_drift_mean, v_drift_err, m_fit, m_err, m_th, v_
     Nessuno
     """
 
-    plt.figure(figsize=(8,6))
+    plt = pyplot()
+
+    fig = plt.figure(figsize=(8,6))
     
     # Plot dei dati con barre d'errore
     plt.errorbar(fields_value, v_drift_mean, yerr=v_drift_err, fmt='o', label='Dati Simulazione', color='blue', ecolor='blue', elinewidth=3, capsize=3)
@@ -165,6 +338,6 @@ def plots_vd_fit(fields_value, v_drift_mean, v_drift_err, m_fit, m_err, m_th, v_
     plt.legend()
     plt.grid(True)
     plt.tight_layout()
-    plt.show(block=False)
+    save_or_show(fig, 'fit_vd')
 
     return
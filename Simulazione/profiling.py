@@ -0,0 +1,168 @@
+import time
+import json
+import contextlib
+
+# Se False le fasi non vengono misurate e stage() non fa nulla, quindi la misura può restare nel codice
+ENABLED = False
+
+# Tempo totale [s] e numero di chiamate di ogni fase, nel processo principale
+_times = {}
+
+# Informazioni sulla simulazione usate nel resoconto, come il numero di particelle e passi
+_info = {}
+
+
+def enable(on=True):
+
+    """
+    Funzione che attiva o disattiva la misura dei tempi delle fasi e azzera quelli già misurati
+
+    Parametri:
+    ----------
+    on : Se True attiva la misura (Default: True)
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    global ENABLED
+
+    ENABLED = on
+    _times.clear()
+    _info.clear()
+
+    return
+
+
+@contextlib.contextmanager
+def stage(name, times=None):
+
+    """
+    Gestore di contesto che misura il tempo di una fase e lo somma a quelli delle chiamate precedenti
+    Se la misura non è attiva e times non è dato, il blocco viene eseguito senza misurare nulla
+
+    Parametri:
+    ----------
+    name  : Nome della fase
+    times : Dizionario in cui sommare il tempo, usato dai processi di calcolo, se None si usa quello del
+            processo principale solo se la misura è attiva (Default: None)
+    """
+
+    if times is None:
+        if not ENABLED:
+            yield
+            return
+        times = _times
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        t, n = times.get(name, (0.0, 0))
+        times[name] = (t + time.perf_counter() - t0, n + 1)
+
+
+def add(times):
+
+    """
+    Funzione che somma ai tempi del processo principale quelli misurati in un altro processo
+
+    Parametri:
+    ----------
+    times : Dizionario dei tempi, con le stesse voci di stage()
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    for name, (t, n) in times.items():
+        t0, n0 = _times.get(name, (0.0, 0))
+        _times[name] = (t0 + t, n0 + n)
+
+    return
+
+
+def annotate(**info):
+
+    """
+    Funzione che registra informazioni sulla simulazione da riportare nel resoconto, ad esempio
+    particles (particelle simulate), steps (passi totali di tutte le particelle), row e row_id (riga salvata)
+    Non fa nulla se la misura non è attiva
+    """
+
+    if ENABLED:
+        _info.update(info)
+
+    return
+
+
+def report(wall):
+
+    """
+    Funzione che stampa il resoconto dei tempi delle fasi e delle velocità di calcolo
+    I tempi misurati nei processi di calcolo sono sommati, quindi con più processi la loro somma può superare il tempo totale:
+    i passi al secondo sono riferiti al tempo di integrazione di un singolo processo, le particelle al secondo al tempo totale
+    esclusa l'attesa della chiusura dei grafici (fase show)
+
+    Parametri:
+    ----------
+    wall : Tempo totale dell'esecuzione [s]
+
+    Ritorna:
+    --------
+    rep : Dizionario del resoconto, con tempi, chiamate e frazione del tempo totale di ogni fase
+    """
+
+    stages = {name: {'time_s': t, 'calls': n, 'fraction': t / wall if wall > 0 else float('nan')} for name, (t, n) in _times.items()}
+
+    rep = {'wall_s': wall, 'stages': stages}
+    rep.update(_info)
+
+    t_drift = _times.get('drift', (0.0, 0))[0]
+    if 'steps' in _info and t_drift > 0:
+        rep['steps_per_s'] = _info['steps'] / t_drift
+
+    # L'attesa della chiusura dei grafici a schermo non è tempo di calcolo
+    busy = wall - _times.get('show', (0.0, 0))[0]
+    if 'particles' in _info and busy > 0:
+        rep['particles_per_s'] = _info['particles'] / busy
+
+    print(f"\n-------------------------------------------------------------")
+    print(f"Tempi delle fasi della simulazione\n")
+    print(f"{'fase':<20} {'tempo [s]':>12} {'chiamate':>9} {'frazione':>9}")
+    for name, st in stages.items():
+        print(f"{name:<20} {st['time_s']:12.4f} {st['calls']:9d} {st['fraction']*100:8.1f}%")
+    print(f"\n{'totale':<20} {wall:12.4f}")
+
+    if 'steps_per_s' in rep:
+        print(f"Passi al secondo (per processo):  {rep['steps_per_s']:.3e}")
+    if 'particles_per_s' in rep:
+        print(f"Particelle al secondo:            {rep['particles_per_s']:.3e}")
+    print()
+
+    return rep
+
+
+def write_json(file_json, rep):
+
+    """
+    Funzione che salva il resoconto dei tempi in un file .json
+
+    Parametri:
+    ----------
+    file_json : Percorso del file
+    rep       : Dizionario restituito da report()
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    with open(file_json, 'w') as f:
+        json.dump(rep, f, indent=2, default=float)
+
+    print(f"Resoconto dei tempi salvato nel file: {file_json}\n")
+
+    return
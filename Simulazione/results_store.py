@@ -0,0 +1,419 @@
+import os
+import math
+import sqlite3
+
+# pandas viene importato solo nelle funzioni che lo usano, per avviare velocemente il programma
+
+# Colonne del file drift_data.csv, mantenute identiche nella tabella del database
+# N_particles è il numero di particelle usate, vuoto per le righe salvate prima che venisse registrato
+# Species è la specie delle simulazioni a più specie, vuoto per quelle a una specie con carica di segno casuale
+COLUMNS = ['Flag', 'v_drift', 'v_drift_err', 'v_drift_theor', 'Fields_value', 'Turbulence_coeff', 'Bz', 'N_steps', 'N_particles', 'Species']
+
+# v_drift_err è vuoto quando l'errore non è definito, ad esempio con una sola particella, come nelle celle vuote di drift_data.csv
+TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id               INTEGER PRIMARY KEY,
+    Flag             TEXT    NOT NULL,
+    v_drift          REAL    NOT NULL,
+    v_drift_err      REAL,
+    v_drift_theor    REAL    NOT NULL,
+    Fields_value     REAL    NOT NULL,
+    Turbulence_coeff REAL    NOT NULL,
+    Bz               REAL    NOT NULL,
+    N_steps          INTEGER NOT NULL,
+    N_particles      INTEGER,
+    Species          TEXT
+)
+"""
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_flag_bz_steps ON drift_data (Flag, Bz, N_steps)",
+    "CREATE INDEX IF NOT EXISTS idx_bz            ON drift_data (Bz)",
+    "CREATE INDEX IF NOT EXISTS idx_steps         ON drift_data (N_steps)",
+    "CREATE INDEX IF NOT EXISTS idx_turb          ON drift_data (Turbulence_coeff)",
+]
+
+SCHEMA = ";".join([TABLE.format(table='drift_data')] + INDEXES) + ";"
+
+# Statistiche sufficienti del fit pesato v = m x (analysis.fit_from_sums()) per ogni gruppo Flag, Bz, N_steps, Species,
+# con x = Fields_value, y = v_drift e pesi w = 1 / v_drift_err²; Species è '' per le simulazioni a una specie
+# I trigger le aggiornano nella stessa transazione di ogni inserimento, modifica o cancellazione, quindi restano sempre coerenti
+# con la tabella; le righe senza errore positivo o con errore vuoto non hanno peso e non vengono contate
+FIT_COLUMNS = ['Flag', 'Bz', 'N_steps', 'Species', 'n', 'Swxx', 'Swxy', 'Swyy']
+
+FIT_SCHEMA = [
+    """
+    CREATE TABLE fit_stats (
+        Flag    TEXT    NOT NULL,
+        Bz      REAL    NOT NULL,
+        N_steps INTEGER NOT NULL,
+        Species TEXT    NOT NULL,
+        n       INTEGER NOT NULL,
+        Swxx    REAL    NOT NULL,
+        Swxy    REAL    NOT NULL,
+        Swyy    REAL    NOT NULL,
+        PRIMARY KEY (Flag, Bz, N_steps, Species)
+    )
+    """,
+    """
+    CREATE TRIGGER fit_stats_insert AFTER INSERT ON drift_data WHEN NEW.v_drift_err > 0
+    BEGIN
+        INSERT INTO fit_stats (Flag, Bz, N_steps, Species, n, Swxx, Swxy, Swyy)
+        VALUES (NEW.Flag, NEW.Bz, NEW.N_steps, COALESCE(NEW.Species, ''), 1,
+                NEW.Fields_value * NEW.Fields_value / (NEW.v_drift_err * NEW.v_drift_err),
+                NEW.Fields_value * NEW.v_drift / (NEW.v_drift_err * NEW.v_drift_err),
+                NEW.v_drift * NEW.v_drift / (NEW.v_drift_err * NEW.v_drift_err))
+        ON CONFLICT (Flag, Bz, N_steps, Species) DO UPDATE SET
+            n = n + 1, Swxx = Swxx + excluded.Swxx, Swxy = Swxy + excluded.Swxy, Swyy = Swyy + excluded.Swyy;
+    END
+    """,
+    """
+    CREATE TRIGGER fit_stats_delete AFTER DELETE ON drift_data WHEN OLD.v_drift_err > 0
+    BEGIN
+        UPDATE fit_stats SET
+            n    = n - 1,
+            Swxx = Swxx - OLD.Fields_value * OLD.Fields_value / (OLD.v_drift_err * OLD.v_drift_err),
+            Swxy = Swxy - OLD.Fields_value * OLD.v_drift / (OLD.v_drift_err * OLD.v_drift_err),
+            Swyy = Swyy - OLD.v_drift * OLD.v_drift / (OLD.v_drift_err * OLD.v_drift_err)
+        WHERE Flag = OLD.Flag AND Bz = OLD.Bz AND N_steps = OLD.N_steps AND Species = COALESCE(OLD.Species, '');
+        DELETE FROM fit_stats WHERE n = 0;
+    END
+    """,
+    """
+    CREATE TRIGGER fit_stats_update AFTER UPDATE OF Flag, Bz, N_steps, Species, Fields_value, v_drift, v_drift_err ON drift_data
+    BEGIN
+        UPDATE fit_stats SET
+            n    = n - 1,
+            Swxx = Swxx - OLD.Fields_value * OLD.Fields_value / (OLD.v_drift_err * OLD.v_drift_err),
+            Swxy = Swxy - OLD.Fields_value * OLD.v_drift / (OLD.v_drift_err * OLD.v_drift_err),
+            Swyy = Swyy - OLD.v_drift * OLD.v_drift / (OLD.v_drift_err * OLD.v_drift_err)
+        WHERE OLD.v_drift_err > 0
+          AND Flag = OLD.Flag AND Bz = OLD.Bz AND N_steps = OLD.N_steps AND Species = COALESCE(OLD.Species, '');
+        DELETE FROM fit_stats WHERE n = 0;
+        INSERT INTO fit_stats (Flag, Bz, N_steps, Species, n, Swxx, Swxy, Swyy)
+        SELECT NEW.Flag, NEW.Bz, NEW.N_steps, COALESCE(NEW.Species, ''), 1,
+               NEW.Fields_value * NEW.Fields_value / (NEW.v_drift_err * NEW.v_drift_err),
+               NEW.Fields_value * NEW.v_drift / (NEW.v_drift_err * NEW.v_drift_err),
+               NEW.v_drift * NEW.v_drift / (NEW.v_drift_err * NEW.v_drift_err)
+        WHERE NEW.v_drift_err > 0
+        ON CONFLICT (Flag, Bz, N_steps, Species) DO UPDATE SET
+            n = n + 1, Swxx = Swxx + excluded.Swxx, Swxy = Swxy + excluded.Swxy, Swyy = Swyy + excluded.Swyy;
+    END
+    """,
+    """
+    INSERT INTO fit_stats (Flag, Bz, N_steps, Species, n, Swxx, Swxy, Swyy)
+    SELECT Flag, Bz, N_steps, COALESCE(Species, ''), COUNT(*),
+           SUM(Fields_value * Fields_value / (v_drift_err * v_drift_err)),
+           SUM(Fields_value * v_drift / (v_drift_err * v_drift_err)),
+           SUM(v_drift * v_drift / (v_drift_err * v_drift_err))
+    FROM drift_data WHERE v_drift_err > 0
+    GROUP BY Flag, Bz, N_steps, COALESCE(Species, '')
+    """,
+]
+
+
+def connect(file_db, file_csv=None):
+
+    """
+    Funzione che apre il database dei risultati e crea tabella e indici se non esistono
+    Il database usa il journal WAL, quindi più simulazioni possono scrivere e leggere contemporaneamente
+    Se il database è nuovo e file_csv esiste, i dati del file .csv vengono importati
+
+    Parametri:
+    ----------
+    file_db  : Percorso del file del database
+    file_csv : File .csv con lo schema di drift_data.csv da importare alla creazione (Default: None)
+
+    Ritorna:
+    --------
+    conn : Connessione sqlite3 al database
+    """
+
+    new_db = not os.path.exists(file_db)
+
+    # Transazioni gestite esplicitamente, attesa fino a 60 s se un altro processo sta scrivendo
+    conn = sqlite3.connect(file_db, timeout=60.0, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+
+    # Aggiornamenti dello schema e importazione del file .csv nel database nuovo, nella stessa transazione con il lock di scrittura
+    # I controlli vengono ripetuti con il lock, così di più processi avviati insieme solo il primo aggiorna lo schema
+    # e importa il file .csv, e le righe non vengono mai duplicate né contate due volte in fit_stats
+    load_csv = new_db and file_csv and os.path.exists(file_csv)
+    if load_csv or schema_updates(conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql in schema_updates(conn):
+                conn.execute(sql)
+            if load_csv and conn.execute("SELECT 1 FROM drift_data LIMIT 1").fetchone() is None:
+                execute_inserts(conn, read_csv_rows(file_csv))
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    return conn
+
+
+def schema_updates(conn):
+
+    """
+    Funzione che elenca le istruzioni per aggiornare un database creato da una versione precedente
+    Aggiunge le colonne N_particles e Species, toglie il vincolo NOT NULL da v_drift_err e crea la tabella fit_stats,
+    riempita con le righe già presenti, o il solo trigger delle modifiche se fit_stats esiste già
+
+    Parametri:
+    ----------
+    conn : Connessione al database
+
+    Ritorna:
+    --------
+    updates : Lista delle istruzioni SQL da eseguire, vuota se il database è aggiornato
+    """
+
+    info = {col[1]: col for col in conn.execute("PRAGMA table_info(drift_data)")}
+    has_fit = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fit_stats'").fetchone() is not None
+    has_update = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'fit_stats_update'").fetchone() is not None
+
+    updates = []
+    if 'N_particles' not in info:
+        updates.append("ALTER TABLE drift_data ADD COLUMN N_particles INTEGER")
+    if 'Species' not in info:
+        updates.append("ALTER TABLE drift_data ADD COLUMN Species TEXT")
+
+    # v_drift_err era NOT NULL: SQLite non permette di togliere il vincolo, quindi la tabella viene ricostruita
+    # Eliminare la tabella elimina anche indici e trigger, ricreati subito dopo; fit_stats non cambia
+    if info['v_drift_err'][3]:
+        cols = ', '.join(['id'] + COLUMNS)
+        updates += [TABLE.format(table='drift_data_new'),
+                    f"INSERT INTO drift_data_new ({cols}) SELECT {cols} FROM drift_data",
+                    "DROP TABLE drift_data",
+                    "ALTER TABLE drift_data_new RENAME TO drift_data"] + INDEXES
+        if has_fit:
+            updates += FIT_SCHEMA[1:4]
+
+    elif has_fit and not has_update:
+        updates.append(FIT_SCHEMA[3])
+
+    if not has_fit:
+        updates += FIT_SCHEMA
+
+    return updates
+
+
+def make_row(vd_mean, vd_err_final, vd_th_mean, fields_val, flag, N, n_t, Bz, N_par=None, species=None):
+
+    """
+    Funzione che crea una riga della tabella dei risultati con i nomi delle colonne di drift_data.csv
+    Un errore non definito (NaN), ad esempio con una sola particella, viene salvato vuoto e la riga non entra nel fit
+
+    Parametri:
+    ----------
+    Gli stessi di save_data() in main.py
+
+    Ritorna:
+    --------
+    row : Dizionario della riga
+    """
+
+    row = {
+        'Flag'             : flag,
+        'v_drift'          : float(vd_mean),
+        'v_drift_err'      : None if math.isnan(vd_err_final) else float(vd_err_final),
+        'v_drift_theor'    : float(vd_th_mean),
+        'Fields_value'     : float(fields_val),
+        'Turbulence_coeff' : float(n_t),
+        'Bz'               : float(Bz),
+        'N_steps'          : int(N),
+        'N_particles'      : None if N_par is None else int(N_par),
+        'Species'          : species,
+    }
+
+    return row
+
+
+def insert_rows(conn, rows):
+
+    """
+    Funzione che inserisce più righe nel database con una sola transazione
+    Il lock di scrittura viene preso all'inizio, quindi le righe di due processi non si mescolano mai
+
+    Parametri:
+    ----------
+    conn : Connessione al database
+    rows : Lista dei dizionari delle righe, con le chiavi in COLUMNS
+
+    Ritorna:
+    --------
+    ids : Lista degli id delle righe inserite
+    """
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = execute_inserts(conn, rows)
+        conn.execute("COMMIT")
+
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return ids
+
+
+def execute_inserts(conn, rows):
+
+    """
+    Funzione che inserisce le righe nella transazione già aperta dal chiamante
+
+    Parametri:
+    ----------
+    conn : Connessione al database, con una transazione aperta
+    rows : Lista dei dizionari delle righe, con le chiavi in COLUMNS
+
+    Ritorna:
+    --------
+    ids : Lista degli id delle righe inserite
+    """
+
+    sql = f"INSERT INTO drift_data ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+    ids = [conn.execute(sql, [row[col] for col in COLUMNS]).lastrowid for row in rows]
+
+    return ids
+
+
+def query(conn, flag=None, Bz=None, N_steps=None, n_t=None, species=None):
+
+    """
+    Funzione che legge dal database le sole righe che soddisfano i filtri dati, usando gli indici
+    I filtri non dati non vengono applicati
+
+    Parametri:
+    ----------
+    conn    : Connessione al database
+    flag    : Tipo di drift (Default: None)
+    Bz      : Componente z del campo magnetico [T] (Default: None)
+    N_steps : Numero di passi (Default: None)
+    n_t     : Coefficiente di turbolenza (Default: None)
+    species : Specie, '' per le sole righe delle simulazioni a una specie (Default: None)
+
+    Ritorna:
+    --------
+    df : DataFrame con le colonne di drift_data.csv, nell'ordine di inserimento
+    """
+
+    filters = {'Flag': flag, 'Bz': Bz, 'N_steps': N_steps, 'Turbulence_coeff': n_t}
+    filters = {col: val for col, val in filters.items() if val is not None}
+    conds = [f"{col} = ?" for col in filters]
+
+    if species == '':
+        conds.append("Species IS NULL")
+    elif species is not None:
+        conds.append("Species = ?")
+        filters['Species'] = species
+
+    where = " AND ".join(conds)
+    sql = f"SELECT {', '.join(COLUMNS)} FROM drift_data" + (f" WHERE {where}" if where else "") + " ORDER BY id"
+
+    import pandas as pd
+
+    df = pd.read_sql_query(sql, conn, params=list(filters.values()))
+
+    return df
+
+
+def fit_stats(conn, flag=None, Bz=None, N_steps=None, species=None):
+
+    """
+    Funzione che legge le statistiche sufficienti del fit lineare dei gruppi che soddisfano i filtri dati
+    Non legge le righe della tabella dei risultati, quindi il fit di molti gruppi è immediato anche con database grandi;
+    i filtri non dati non vengono applicati
+
+    Parametri:
+    ----------
+    conn    : Connessione al database
+    flag    : Tipo di drift (Default: None)
+    Bz      : Componente z del campo magnetico [T] (Default: None)
+    N_steps : Numero di passi (Default: None)
+    species : Specie, '' per le sole righe delle simulazioni a una specie (Default: None)
+
+    Ritorna:
+    --------
+    groups : Lista dei dizionari dei gruppi con le chiavi in FIT_COLUMNS, da passare ad analysis.fit_from_sums()
+    """
+
+    filters = {'Flag': flag, 'Bz': Bz, 'N_steps': N_steps, 'Species': species}
+    filters = {col: val for col, val in filters.items() if val is not None}
+
+    where = " AND ".join(f"{col} = ?" for col in filters)
+    sql = f"SELECT {', '.join(FIT_COLUMNS)} FROM fit_stats" + (f" WHERE {where}" if where else "") + " ORDER BY Flag, Species, Bz, N_steps"
+
+    groups = [dict(zip(FIT_COLUMNS, row)) for row in conn.execute(sql, list(filters.values()))]
+
+    return groups
+
+
+def import_csv(conn, file_csv):
+
+    """
+    Funzione che importa nel database le righe di un file .csv con lo schema di drift_data.csv
+    Le colonne mancanti, come N_particles e Species nei file meno recenti, restano vuote
+
+    Parametri:
+    ----------
+    conn     : Connessione al database
+    file_csv : Percorso del file .csv
+
+    Ritorna:
+    --------
+    n_rows : Numero di righe importate
+    """
+
+    rows = read_csv_rows(file_csv)
+    insert_rows(conn, rows)
+
+    return len(rows)
+
+
+def read_csv_rows(file_csv):
+
+    """
+    Funzione che legge le righe di un file .csv con lo schema di drift_data.csv
+    Le colonne mancanti, come N_particles e Species nei file meno recenti, restano vuote
+
+    Parametri:
+    ----------
+    file_csv : Percorso del file .csv
+
+    Ritorna:
+    --------
+    rows : Lista dei dizionari delle righe, con le chiavi in COLUMNS
+    """
+
+    import pandas as pd
+
+    df = pd.read_csv(file_csv).reindex(columns=COLUMNS)
+    df = df.astype(object).where(df.notna(), None)
+
+    return df.to_dict('records')
+
+
+def export_csv(conn, file_csv):
+
+    """
+    Funzione che esporta tutte le righe del database in un file .csv con lo schema di drift_data.csv
+
+    Parametri:
+    ----------
+    conn     : Connessione al database
+    file_csv : Percorso del file .csv
+
+    Ritorna:
+    --------
+    n_rows : Numero di righe esportate
+    """
+
+    df = query(conn)
+    df.to_csv(file_csv, index=False)
+
+    return len(df)
@@ -0,0 +1,159 @@
+import numpy as np
+import ensemble as en
+
+# Specie predefinite: carica [C] e massa [Kg]
+# Le deviazioni standard della velocità iniziale sono quelle di ensemble.V_SIGMA scalate come 1/sqrt(m),
+# cioè tutte le specie hanno la stessa temperatura dei protoni della simulazione a una specie
+SPECIES = {
+    'p'     : {'q':  1.6e-19, 'm': 1.67e-27},
+    'e'     : {'q': -1.6e-19, 'm': 9.11e-31},
+    'alpha' : {'q':  3.2e-19, 'm': 6.64e-27},
+    'O+'    : {'q':  1.6e-19, 'm': 2.66e-26},
+}
+
+# Massa di riferimento per le velocità iniziali [Kg]
+M_REF = 1.67e-27
+
+
+def parse_species(specs, N_par):
+
+    """
+    Funzione che legge le specie della simulazione dagli argomenti nella forma NOME[:N_PAR[:V_SCALA]]
+    NOME è una delle specie di SPECIES, N_PAR il numero di particelle della specie e V_SCALA un fattore
+    che moltiplica le deviazioni standard della sua velocità iniziale
+
+    Parametri:
+    ----------
+    specs : Lista delle stringhe delle specie
+    N_par : Numero di particelle usato per le specie che non lo specificano
+
+    Ritorna:
+    --------
+    species : Lista dei dizionari delle specie con name, q, m, qm (rapporto carica massa positivo), charge (segno),
+              N_par e v_sigma
+
+    Solleva ValueError se una specie non esiste, è ripetuta o ha valori non validi
+    """
+
+    species = []
+    for spec in specs:
+
+        fields = spec.split(':')
+        name = fields[0]
+        if name not in SPECIES:
+            raise ValueError(f"specie '{name}' non valida, scegliere tra {', '.join(SPECIES)}")
+        if name in [s['name'] for s in species]:
+            raise ValueError(f"la specie '{name}' è ripetuta")
+        if len(fields) > 3:
+            raise ValueError(f"specie '{spec}' non valida, usare la forma NOME[:N_PAR[:V_SCALA]]")
+
+        try:
+            n = int(fields[1]) if len(fields) > 1 and fields[1] else N_par
+            scale = float(fields[2]) if len(fields) > 2 else 1.0
+        except ValueError:
+            raise ValueError(f"specie '{spec}' non valida, N_PAR deve essere intero e V_SCALA un numero reale")
+
+        if n <= 0 or scale <= 0:
+            raise ValueError(f"specie '{spec}' non valida, N_PAR e V_SCALA devono essere positivi")
+
+        q, m = SPECIES[name]['q'], SPECIES[name]['m']
+        species.append({
+            'name'    : name,
+            'q'       : q,
+            'm'       : m,
+            'qm'      : abs(q) / m,
+            'charge'  : np.sign(q),
+            'N_par'   : n,
+            'v_sigma' : (en.V_SIGMA * np.sqrt(M_REF / m) * scale).tolist(),
+        })
+
+    return species
+
+
+def schedule(species):
+
+    """
+    Funzione che assegna ad ogni specie il numero di sottopassi per passo della simulazione
+    La specie con il rapporto carica massa minore, la più lenta, usa il passo della simulazione; le altre lo
+    suddividono in n_sub sottopassi, con n_sub il rapporto tra le frequenze di ciclotrone arrotondato per eccesso,
+    così ogni specie ha almeno gli stessi passi per orbita della più lenta senza ridurre il passo di tutte le altre
+    Per lo stesso motivo delle specie veloci viene conservato un centro di guida ogni gc_stride orbite, circa uno per orbita della
+    specie lenta; ogni centro resta la media su una sola orbita, quindi lo stimatore è lo stesso delle simulazioni a una specie
+
+    Parametri:
+    ----------
+    species : Lista dei dizionari delle specie restituita da parse_species()
+
+    Ritorna:
+    --------
+    plan : Lista di tuple (n_sub, gc_stride), una per specie
+    """
+
+    qm_ref = min(s['qm'] for s in species)
+
+    plan = []
+    for s in species:
+        ratio = s['qm'] / qm_ref
+        plan.append((int(np.ceil(ratio - 1e-9)), max(1, int(round(ratio)))))
+
+    return plan
+
+
+def substep_turbulence(n_t, n_sub):
+
+    """
+    Funzione che ricava il coefficiente di scattering di un sottopasso
+    Il coefficiente dà la probabilità di scattering per passo p = (n_t - 0.001) / 0.999 di drift_motions.scatter_prob(),
+    quindi con n_sub sottopassi la probabilità va divisa per n_sub per mantenere la stessa frequenza di scattering nel tempo
+
+    Parametri:
+    ----------
+    n_t   : Coefficiente di scattering per passo della simulazione
+    n_sub : Numero di sottopassi per passo
+
+    Ritorna:
+    --------
+    n_t_sub : Coefficiente di scattering per sottopasso
+    """
+
+    p = min(max((n_t - 0.001) / 0.999, 0.0), 1.0)
+    if p == 0.0:
+        return n_t
+
+    return 0.001 + 0.999 * p / n_sub
+
+
+def species_params(species, flag, Bz, E, B_grad, N, dt, n_t, steps_orb=None, **kwargs):
+
+    """
+    Funzione che crea il dizionario dei parametri di ogni specie con ensemble.build_params()
+    Il passo della simulazione è quello della specie più lenta, eventualmente ricavato da steps_orb; ogni specie
+    lo suddivide nei sottopassi di schedule() e copre lo stesso tempo totale (N - 1) * dt
+
+    Parametri:
+    ----------
+    species : Lista dei dizionari delle specie restituita da parse_species()
+    flag, Bz, E, B_grad, N, dt, n_t, steps_orb : Configurazione della simulazione, come in ensemble.build_params()
+    kwargs  : Scelte di calcolo passate a ensemble.build_params() (backend, integrator, estimator, sampling, ...)
+
+    Ritorna:
+    --------
+    params_list : Lista dei dizionari dei parametri, uno per specie, con in più name, charge, v_sigma e n_sub
+
+    Solleva le stesse eccezioni di ensemble.build_params()
+    """
+
+    # Passo della specie più lenta
+    slow = min(species, key=lambda s: s['qm'])
+    dt = en.build_params(flag, Bz, E, B_grad, N, dt, n_t, slow['qm'], steps_orb=steps_orb, **kwargs)['dt']
+
+    params_list = []
+    for s, (n_sub, gc_stride) in zip(species, schedule(species)):
+
+        # Le cariche sono fissate dalla specie, il bilanciamento non ha effetto
+        params = en.build_params(flag, Bz, E, B_grad, (N - 1) * n_sub + 1, dt / n_sub, substep_turbulence(n_t, n_sub), s['qm'],
+                                 gc_stride=gc_stride, **dict(kwargs, balance=False))
+        params.update({'name': s['name'], 'charge': s['charge'], 'v_sigma': s['v_sigma'], 'n_sub': n_sub})
+        params_list.append(params)
+
+    return params_list
@@ -0,0 +1,350 @@
+import itertools
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import ensemble as en
+import analysis as an
+import cache as ca
+
+# Parametri che possono essere variati in una scansione
+GRID_KEYS = ['Flag', 'Bz', 'Ex', 'Ey', 'Ez', 'dBdx', 'dBdy', 'n_t', 'N', 'dt', 'steps_orb']
+
+
+def make_config(defaults, values):
+
+    """
+    Funzione che crea una configurazione partendo dai valori di default
+    Un dt dato senza steps_orb nella stessa configurazione prevale sui passi per orbita di default
+
+    Parametri:
+    ----------
+    defaults : Dizionario con i valori usati per i parametri assenti
+    values   : Dizionario con i valori della configurazione, le celle vuote (NaN) vengono ignorate
+
+    Ritorna:
+    --------
+    conf : Dizionario della configurazione
+    """
+
+    values = {key: val for key, val in values.items() if not (isinstance(val, float) and np.isnan(val))}
+
+    conf = dict(defaults)
+    conf.update(values)
+    if 'dt' in values and 'steps_orb' not in values:
+        conf['steps_orb'] = None
+
+    return conf
+
+
+def parse_range(text):
+
+    """
+    Funzione che converte un intervallo scritto da linea di comando nella lista dei suoi valori
+    Sono accettati i formati 'inizio:fine:numero' (valori equispaziati), 'a,b,c' (lista) e 'a' (valore singolo)
+
+    Parametri:
+    ----------
+    text : Stringa con l'intervallo
+
+    Ritorna:
+    --------
+    values : Lista dei valori
+    """
+
+    if ':' in text:
+        start, stop, num = text.split(':')
+        values = list(np.linspace(float(start), float(stop), int(num)))
+
+    else:
+        values = [float(x) for x in text.split(',')]
+
+    return values
+
+
+def grid_from_ranges(ranges, defaults):
+
+    """
+    Funzione che crea la griglia di configurazioni come prodotto cartesiano degli intervalli dati
+
+    Parametri:
+    ----------
+    ranges   : Lista di stringhe 'CHIAVE=INTERVALLO', ad esempio ['Ex=10:50:5', 'Bz=8e-4']
+    defaults : Dizionario con i valori usati per i parametri non variati
+
+    Ritorna:
+    --------
+    configs : Lista dei dizionari delle configurazioni
+
+    Solleva ValueError se una chiave non è tra GRID_KEYS o l'intervallo non è valido
+    """
+
+    axes = {}
+    for item in ranges:
+        key, _, text = item.partition('=')
+        if key not in GRID_KEYS or key == 'Flag':
+            raise ValueError(f"parametro '{key}' non valido, scegliere tra {', '.join(GRID_KEYS[1:])}")
+        axes[key] = parse_range(text)
+
+    configs = [make_config(defaults, dict(zip(axes.keys(), values))) for values in itertools.product(*axes.values())]
+
+    return configs
+
+
+def read_grid(file_grid, defaults):
+
+    """
+    Funzione che legge la griglia di configurazioni da un file .csv o .json
+    Il file .csv ha come colonne i nomi in GRID_KEYS, il file .json contiene una lista di dizionari con le stesse chiavi
+    I parametri assenti o le celle vuote assumono i valori di default
+
+    Parametri:
+    ----------
+    file_grid : Percorso del file della griglia
+    defaults  : Dizionario con i valori usati per i parametri assenti
+
+    Ritorna:
+    --------
+    configs : Lista dei dizionari delle configurazioni
+    """
+
+    if file_grid.endswith('.json'):
+        with open(file_grid) as f:
+            rows = json.load(f)
+
+    else:
+        import pandas as pd
+        rows = pd.read_csv(file_grid).to_dict('records')
+
+    configs = [make_config(defaults, {key: row[key] for key in GRID_KEYS if key in row}) for row in rows]
+
+    return configs
+
+
+def config_params(conf, qm, dt, backend, integrator, estimator, sampling='mc', balance=False, analytic=True, precision='double'):
+
+    """
+    Funzione che controlla una configurazione della griglia e ne crea il dizionario dei parametri
+    L'intervallo di tempo è quello della configurazione se presente, ricavato dai passi per orbita se questi sono dati
+
+    Parametri:
+    ----------
+    conf : Dizionario della configurazione
+    qm   : Rapporto carica massa per particella positiva [C/Kg]
+    dt   : Intervallo di tempo tra i passi usato se la configurazione non ha 'dt' [s]
+    backend, integrator, estimator, sampling, balance, analytic, precision : Scelte di calcolo, come in ensemble.build_params()
+
+    Ritorna:
+    --------
+    params : Dizionario con i parametri della simulazione, None se la configurazione non è valida
+    """
+
+    flag = conf['Flag']
+    E = np.array([conf['Ex'], conf['Ey'], conf['Ez']], dtype=float)
+    B_grad = np.array([conf['dBdx'], conf['dBdy'], 0.0], dtype=float)
+
+    # Stessi controlli della configurazione interattiva
+    if flag == 'ExB':
+        B_grad = np.zeros(3)
+        if E[0] == 0.0 and E[1] == 0.0:
+            print(f"\nErrore: configurazione {conf} ignorata, almeno una delle due componenti del campo elettrico deve essere diversa da zero")
+            return None
+
+    elif flag == 'gradB':
+        E = np.zeros(3)
+        if B_grad[0] == 0.0 and B_grad[1] == 0.0:
+            print(f"\nErrore: configurazione {conf} ignorata, almeno una delle due componenti del gradiente deve essere diversa da zero")
+            return None
+
+    else:
+        print(f"\nErrore: configurazione {conf} ignorata, il tipo di drift deve essere ExB o gradB")
+        return None
+
+    if conf['n_t'] > 1.0 or conf['n_t'] < 0.0:
+        print(f"\nErrore: configurazione {conf} ignorata, il coefficiente di turbolenza deve essere compreso tra [1;0]")
+        return None
+
+    dt = float(conf.get('dt', dt))
+    steps_orb = None if conf.get('steps_orb') is None else int(conf['steps_orb'])
+
+    try:
+        params = en.build_params(flag, float(conf['Bz']), E, B_grad, int(conf['N']), dt, float(conf['n_t']), qm, backend, integrator, estimator, steps_orb,
+                                 sampling, balance, analytic=analytic, precision=precision)
+
+    except ZeroDivisionError:
+        print(f"\nErrore: configurazione {conf} ignorata, il campo magnetico ha un valore non corretto o i passi sono insufficienti")
+        return None
+
+    except ValueError as err:
+        print(f"\nErrore: configurazione {conf} ignorata, {err}")
+        return None
+
+    if params['n_orb'] < 2:
+        print(f"\nErrore: configurazione {conf} ignorata, i passi non bastano per almeno due orbite")
+        return None
+
+    if params['steps_orb_min'] < en.MIN_STEPS_ORB:
+        print(f"\nAttenzione: configurazione {conf} con solo {params['steps_orb_min']} passi per orbita dove il campo è più intenso")
+
+    return params
+
+
+def sweep_jobs(configs, N_par, qm, dt, seed=None, backend='numpy', integrator='boris', estimator='endpoint', sampling='mc', balance=False,
+               analytic=True, precision='double'):
+
+    """
+    Funzione che prepara i blocchi di particelle di tutte le configurazioni valide della griglia
+    Ogni configurazione riceve un SeedSequence derivato dal seme della scansione e lo suddivide tra i suoi blocchi,
+    quindi i blocchi sono gli stessi qualunque sia il modo in cui vengono eseguiti
+
+    Parametri:
+    ----------
+    Gli stessi di run_sweep()
+
+    Ritorna:
+    --------
+    jobs : Lista di tuple (params, seeds, sizes) delle configurazioni valide, con i SeedSequence e le particelle di ogni blocco
+    """
+
+    ss = np.random.SeedSequence(seed)
+    conf_seeds = ss.spawn(len(configs))
+
+    jobs = []
+    for conf, conf_ss in zip(configs, conf_seeds):
+
+        params = config_params(conf, qm, dt, backend, integrator, estimator, sampling, balance, analytic, precision)
+        if params is None:
+            continue
+
+        sizes, seeds, _ = en.split_chunks(N_par, conf_ss, en.min_blocks(params))
+        jobs.append((params, seeds, sizes))
+
+    return jobs
+
+
+def sweep_cache(jobs, N_par):
+
+    """
+    Funzione che cerca nella cache i risultati delle configurazioni di una scansione
+    Le chiavi dipendono anche dai semi dei blocchi, quindi riaggiungendo configurazioni in fondo alla griglia
+    con lo stesso seme quelle già simulate vengono ritrovate
+
+    Parametri:
+    ----------
+    jobs  : Lista di tuple (params, seeds, sizes) restituita da sweep_jobs()
+    N_par : Numero di particelle per configurazione
+
+    Ritorna:
+    --------
+    keys : Lista delle chiavi delle configurazioni, None se la cache è disattivata
+    hits : Lista delle tuple (res, stats) trovate nella cache, None per le configurazioni da simulare
+    """
+
+    keys = [ca.result_key(params, N_par, seeds) for params, seeds, sizes in jobs]
+    hits = [ca.load(key) for key in keys]
+
+    n_hits = sum(hit is not None for hit in hits)
+    if n_hits:
+        print(f"Risultati di {n_hits} configurazioni su {len(jobs)} letti dalla cache")
+
+    return keys, hits
+
+
+def sweep_row(params, chunks, N_par, key=None):
+
+    """
+    Funzione che unisce i risultati dei blocchi di una configurazione e ne ricava la riga dei risultati
+    I blocchi vengono uniti nel loro ordine, quindi la riga non dipende da dove e quando sono stati eseguiti
+
+    Parametri:
+    ----------
+    params : Dizionario con i parametri della configurazione
+    chunks : Lista dei risultati dei blocchi nell'ordine di sweep_jobs(), con almeno v_drift e v_drift_th
+    N_par  : Numero di particelle della configurazione
+    key    : Chiave della configurazione con cui salvare i risultati nella cache, se None non vengono salvati (Default: None)
+
+    Ritorna:
+    --------
+    row : Dizionario con i risultati della configurazione, con le stesse voci di save_data()
+    """
+
+    res = en.merge_chunks(chunks)
+    stats = an.vd_stats(res['v_drift'], res['v_drift_th'], en.error_blocks(params, N_par))
+    ca.store(key, res, stats)
+
+    row = {
+        'vd_mean'      : stats['vd_mean'],
+        'vd_err_final' : stats['vd_err_final'],
+        'vd_th_mean'   : stats['vd_th_mean'],
+        'fields_val'   : params['fields_val'],
+        'flag'         : params['flag'],
+        'N'            : params['N'],
+        'n_t'          : params['n_t'],
+        'Bz'           : params['B'][2],
+        'N_par'        : N_par,
+    }
+
+    return row
+
+
+def run_sweep(configs, N_par, qm, dt, seed=None, workers=1, backend='numpy', integrator='boris', estimator='endpoint', sampling='mc', balance=False,
+              analytic=True, precision='double'):
+
+    """
+    Funzione che esegue una dopo l'altra le simulazioni di tutte le configurazioni della griglia
+    Con più processi viene avviato un solo pool per tutta la scansione: i blocchi di particelle di tutte le
+    configurazioni vengono distribuiti insieme, e i processi mantengono import e kernel compilati tra una configurazione e l'altra
+
+    Parametri:
+    ----------
+    configs : Lista dei dizionari delle configurazioni
+    N_par   : Numero di particelle per configurazione
+    qm      : Rapporto carica massa per particella positiva [C/Kg]
+    dt      : Intervallo di tempo tra i passi [s]
+    seed    : Seme della scansione, ogni configurazione riceve un SeedSequence derivato (Default: None)
+    workers : Numero di processi in parallelo (Default: 1)
+    backend, integrator, estimator, sampling, balance, analytic, precision : Scelte di calcolo, come in ensemble.build_params()
+
+    Ritorna:
+    --------
+    rows : Lista dei dizionari con i risultati di ogni configurazione, con le stesse voci di save_data()
+    """
+
+    from tqdm import tqdm
+
+    jobs = sweep_jobs(configs, N_par, qm, dt, seed, backend, integrator, estimator, sampling, balance, analytic, precision)
+    keys, hits = sweep_cache(jobs, N_par)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and None in hits else None
+
+    try:
+        #--------------------------------------------------------------
+        # Invio di tutti i blocchi di tutte le configurazioni valide non presenti nella cache
+        if pool is not None:
+            jobs = [(params, None if hit is not None else [pool.submit(en.run_chunk, params, s, n) for s, n in zip(seeds, sizes)])
+                    for (params, seeds, sizes), hit in zip(jobs, hits)]
+        #--------------------------------------------------------------
+
+        #--------------------------------------------------------------
+        # Raccolta dei risultati nell'ordine delle configurazioni
+
+        rows = []
+        for job, key, hit in zip(tqdm(jobs), keys, hits):
+
+            if hit is not None:
+                rows.append(sweep_row(job[0], [hit[0]], N_par))
+                continue
+
+            if pool is not None:
+                params, chunks = job
+                chunks = [c.result() for c in chunks]
+            else:
+                params, seeds, sizes = job
+                chunks = [en.run_chunk(params, s, n) for s, n in zip(seeds, sizes)]
+
+            rows.append(sweep_row(params, chunks, N_par, key))
+        #--------------------------------------------------------------
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return rows
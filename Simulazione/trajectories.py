@@ -0,0 +1,169 @@
+import os
+import json
+import numpy as np
+import drift_motions as dm
+import profiling as pf
+
+# Versione del formato della cartella delle traiettorie
+STORE_FORMAT = 1
+
+# Parametri salvati come array nel file dei metadati
+ARRAY_KEYS = ['B', 'E', 'B_grad', 'B_hat']
+
+
+def create_store(path, params, N_par, seed=None):
+
+    """
+    Funzione che crea la cartella delle traiettorie con il file position.npy mappato in memoria
+    Il file ha forma (N_par, N, 3) in ordine C, quindi la traiettoria di ogni particella è contigua
+    e i processi possono scrivere ognuno il proprio blocco di particelle durante l'integrazione
+
+    Parametri:
+    ----------
+    path   : Percorso della cartella delle traiettorie
+    params : Dizionario con i parametri della simulazione
+    N_par  : Numero di particelle
+    seed   : Entropia del seme della simulazione (Default: None)
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    # File delle posizioni, creato vuoto e riempito dai blocchi durante la simulazione
+    shape = (N_par, params['N'], 3)
+    position = np.lib.format.open_memmap(os.path.join(path, 'position.npy'), mode='w+', dtype=np.float64, shape=shape)
+    del position
+
+    # Metadati con la disposizione dei dati e i parametri della simulazione
+    meta = {
+        'format' : STORE_FORMAT,
+        'N_par'  : N_par,
+        'N'      : params['N'],
+        'n_orb'  : params['n_orb'],
+        'layout' : {'position': {'shape': list(shape), 'dtype': 'float64', 'order': 'C', 'axes': ['particle', 'step', 'xyz']}},
+        'seed'   : None if seed is None else str(seed),
+        'params' : {key: (np.asarray(val).tolist() if key in ARRAY_KEYS else val) for key, val in params.items()},
+    }
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2, default=float)
+
+    return
+
+
+def block_view(path, start, N_par):
+
+    """
+    Funzione che restituisce la parte del file position.npy di un blocco di particelle, mappata in memoria in scrittura
+    L'integratore può scriverci direttamente senza allocare le traiettorie in RAM
+
+    Parametri:
+    ----------
+    path  : Percorso della cartella delle traiettorie
+    start : Indice della prima particella del blocco
+    N_par : Numero di particelle del blocco
+
+    Ritorna:
+    --------
+    view : Array mappato in memoria di forma (N_par, N, 3)
+    """
+
+    out = np.load(os.path.join(path, 'position.npy'), mmap_mode='r+')
+    view = out[start:start + N_par]
+
+    return view
+
+
+def write_results(path, res):
+
+    """
+    Funzione che salva nella cartella delle traiettorie gli array per particella ricavati dalla simulazione
+
+    Parametri:
+    ----------
+    path : Percorso della cartella delle traiettorie
+    res  : Dizionario con gli array di tutte le particelle (qm, v0, v_drift, v_drift_th, guide_cn, ...)
+
+    Ritorna:
+    --------
+    Nessuno
+    """
+
+    for key, val in res.items():
+        if key != 'position':
+            np.save(os.path.join(path, f'{key}.npy'), val)
+
+    return
+
+
+def open_store(path):
+
+    """
+    Funzione che apre in sola lettura la cartella delle traiettorie
+    Le posizioni non vengono caricate in memoria: le sezioni lette sono viste sul file senza copie
+
+    Parametri:
+    ----------
+    path : Percorso della cartella delle traiettorie
+
+    Ritorna:
+    --------
+    store : Dizionario con 'position' mappato in memoria, gli altri array salvati e i metadati in 'meta'
+    """
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    if meta['format'] != STORE_FORMAT:
+        raise ValueError(f"formato {meta['format']} della cartella '{path}' non supportato")
+
+    for key in ARRAY_KEYS:
+        meta['params'][key] = np.array(meta['params'][key])
+
+    store = {'meta': meta, 'position': np.load(os.path.join(path, 'position.npy'), mmap_mode='r')}
+    for name in os.listdir(path):
+        key, ext = os.path.splitext(name)
+        if ext == '.npy' and key != 'position':
+            store[key] = np.load(os.path.join(path, name))
+
+    return store
+
+
+def drift_from_store(store, estimator='endpoint', block=128):
+
+    """
+    Funzione che ricava centri di guida e velocità di drift dalle traiettorie salvate, senza ripetere la simulazione
+    Le posizioni vengono lette a blocchi di particelle, quindi anche file più grandi della RAM possono essere analizzati
+
+    Parametri:
+    ----------
+    store     : Dizionario restituito da open_store()
+    estimator : Stimatore della velocità di drift, 'endpoint' o 'lsq' (Default: 'endpoint')
+    block     : Numero di particelle lette per volta (Default: 128)
+
+    Ritorna:
+    --------
+    guide_cn : Array dei centri di guida [m], forma (N_par, n_orb, 3)
+    v_drift  : Array delle velocità di drift [m/s], forma (N_par, 3)
+    """
+
+    params = store['meta']['params']
+    position = store['position']
+    n_orb, steps_orb, T_orb, B_hat = params['n_orb'], params['steps_orb'], params['T_orb'], params['B_hat']
+
+    guide_cn = np.zeros((len(position), n_orb, 3))
+    v_drift = np.zeros((len(position), 3))
+
+    for i in range(0, len(position), block):
+        with pf.stage('guide_center'):
+            guide_cn[i:i+block] = dm.guide_center_ensemble(position[i:i+block], n_orb, steps_orb)
+        with pf.stage('v_drift'):
+            if estimator == 'lsq':
+                v_drift[i:i+block] = dm.v_drift_fit(guide_cn[i:i+block], T_orb, B_hat)[0]
+            else:
+                v_drift[i:i+block] = dm.v_drift_ensemble(guide_cn[i:i+block], n_orb, T_orb, B_hat)
+
+    return guide_cn, v_drift